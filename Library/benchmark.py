@@ -0,0 +1,288 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import main as library
+
+# Benchmark harness for main.py: generates a seeded synthetic library in the CSV (or configured) schemas,
+# runs the operations without their input() prompts and reports throughput, latency percentiles and peak
+# memory per operation, optionally against a stored baseline.
+#
+#   python benchmark.py [10k|100k|1m] [--repeat 20] [--seed 0] [--directory DIR]
+#                       [--save-baseline] [--baseline benchmark_baseline.json] [--threshold 1.25] [--no-memory]
+
+SIZES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+REGRESSION_THRESHOLD = 1.25
+
+STORES = {'Store 1': 'Springfield', 'Store 2': 'Shelbyville', 'Store 3': 'Springfield', 'Store 4': 'Capital City'}
+CITIES = ['Springfield', 'Shelbyville', 'Capital City', 'Ogdenville', 'North Haverbrook']
+CATEGORIES = ['fiction', 'classic', 'dystopian', 'fantasy', 'drama', 'romance', 'mystery', 'thriller', 'science',
+              'history', 'biography', 'poetry', 'horror', 'adventure', 'philosophy', 'children', 'travel', 'art',
+              'cooking', 'business']
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'to', 'ne', 'sa', 'vi', 'del', 'mon', 'tar', 'bel', 'cor', 'fin', 'gal', 'hur']
+
+
+# Synthetic data
+def words(rng, count, syllables=(2, 4)):
+    lengths = rng.integers(syllables[0], syllables[1] + 1, count)
+    parts = rng.choice(SYLLABLES, (count, syllables[1]))
+    return [''.join(row[:length]) for row, length in zip(parts.tolist(), lengths.tolist())]
+
+
+def generate_books(rng, count, first_id=1):
+    ids = np.arange(first_id, first_id + count)
+    vocabulary = words(rng, 2000)
+    title_words = rng.integers(0, len(vocabulary), (count, 3))
+    authors = [f"{first.capitalize()} {last.capitalize()}"
+               for first, last in zip(words(rng, max(count // 20, 10)), words(rng, max(count // 20, 10)))]
+    publishers = [f"{name.capitalize()} Press" for name in words(rng, max(count // 1000, 10))]
+    category_counts = rng.integers(1, 4, count)
+    category_choices = rng.choice(CATEGORIES, (count, 3))
+    store_counts = rng.integers(0, 11, (count, len(STORES)))
+    listed = rng.random((count, len(STORES))) < 0.6
+    store_names = list(STORES)
+
+    bookstores = [{store: count for store, count, keep in zip(store_names, counts, keeps) if keep}
+                  for counts, keeps in zip(store_counts.tolist(), listed.tolist())]
+    return pd.DataFrame({
+        'id': ids,
+        'title': [' '.join(vocabulary[word] for word in row).capitalize() + f" {book_id}"
+                  for row, book_id in zip(title_words.tolist(), ids.tolist())],
+        'author': [authors[i] for i in rng.integers(0, len(authors), count).tolist()],
+        'publisher': [publishers[i] for i in rng.integers(0, len(publishers), count).tolist()],
+        'categories': [list(dict.fromkeys(row[:length]))
+                       for row, length in zip(category_choices.tolist(), category_counts.tolist())],
+        'cost': rng.uniform(5, 50, count).round(2),
+        'shipping_cost': rng.uniform(1, 5, count).round(2),
+        'availability': rng.random(count) < 0.9,
+        'copies': [sum(stores.values()) for stores in bookstores],
+        'bookstores': bookstores,
+    })
+
+
+def generate_users(rng, count, book_count):
+    def book_lists(max_length):
+        lengths = rng.integers(0, max_length + 1, count)
+        choices = rng.integers(1, book_count + 1, (count, max_length))
+        return [list(dict.fromkeys(row[:length])) for row, length in zip(choices.tolist(), lengths.tolist())]
+
+    ids = np.arange(1, count + 1)
+    return pd.DataFrame({
+        'id': ids,
+        'username': [f"user{user_id}" for user_id in ids.tolist()],
+        'password': [f"Password{user_id}!" for user_id in ids.tolist()],
+        'address': [f"{number} Main St" for number in rng.integers(1, 1000, count).tolist()],
+        'city': [CITIES[i] for i in rng.integers(0, len(CITIES), count).tolist()],
+        'orders': book_lists(5),
+        'favorites': book_lists(5),
+        # Enough balance for every order the benchmark places
+        'balance': rng.uniform(1000, 5000, count).round(2),
+        'order_stores': [{} for _ in range(count)],
+    })
+
+
+def generate_reviews(rng, count, book_count, user_count):
+    return pd.DataFrame({
+        'id': np.arange(1, count + 1),
+        'book_id': rng.integers(1, book_count + 1, count),
+        'user_id': rng.integers(1, user_count + 1, count),
+        'rating': rng.integers(1, 6, count),
+        'comment': [f"Review {i}" for i in range(1, count + 1)],
+    })
+
+
+def generate_admins():
+    return pd.DataFrame({'id': [1], 'username': ['admin'], 'password': ['Admin2024!'], 'bookstores': [[1, 2]]})
+
+
+# Write a library of the given size into the current directory through main.save_table, so the files have
+# exactly the schema and format main.py reads
+def write_library(size, seed):
+    rng = np.random.default_rng(seed)
+    books = generate_books(rng, size)
+    tables = {'books': books, 'users': generate_users(rng, size, size),
+              'reviews': generate_reviews(rng, size // 2, size, size), 'admins': generate_admins()}
+    for table, df in tables.items():
+        library.save_table(table, df)
+    pd.DataFrame({'store': list(STORES), 'city': list(STORES.values())}).to_csv(library.STORES_FILE, index=False)
+    if os.path.exists(library.JOURNAL_FILE):
+        os.remove(library.JOURNAL_FILE)
+    return books
+
+
+# Measurement
+# setup (e.g. clearing a cache) runs untimed before every call
+def measure(name, operation, arguments, memory=True, traced=None, setup=None):
+    latencies = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        elapsed = 0.0
+        for args in arguments:
+            if setup is not None:
+                setup()
+            began = time.perf_counter()
+            operation(*args)
+            latencies.append(time.perf_counter() - began)
+            elapsed += latencies[-1]
+
+        # Peak memory comes from one extra traced call (with the traced arguments, for operations that cannot
+        # repeat a call), so tracing does not slow down the timed calls
+        peak = None
+        if memory and arguments:
+            if setup is not None:
+                setup()
+            tracemalloc.start()
+            operation(*(traced if traced is not None else arguments[0]))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    latencies = np.array(latencies) * 1000
+    return {'operation': name, 'calls': len(latencies), 'throughput': len(latencies) / elapsed if elapsed else None,
+            'mean_ms': float(latencies.mean()), 'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)), 'p99_ms': float(np.percentile(latencies, 99)),
+            'peak_kb': peak / 1024 if peak is not None else None}
+
+
+def clear_snapshot_cache():
+    shutil.rmtree(library.SNAPSHOT_CACHE_DIRECTORY, ignore_errors=True)
+
+
+def uncached_report(name, consider_availability):
+    library.report_cache.clear()
+    library.report_data(name, consider_availability)
+
+
+def run_benchmarks(size, repeat, seed, memory=True):
+    rng = np.random.default_rng(seed + 1)
+    results = []
+
+    # A cold start parses the snapshot files and builds the indexes, a warm one restores them from the cache
+    loads = [()] * max(repeat // 5, 1)
+    results.append(measure('initialize_dataframes (cold)', library.initialize_dataframes, loads, memory,
+                           setup=clear_snapshot_cache))
+    results.append(measure('initialize_dataframes (warm)', library.initialize_dataframes, loads, memory))
+
+    book_ids = library.books_df['id'].to_numpy()
+    user_ids = library.user_df['id'].to_numpy()
+    titles = library.books_df['title'].sample(repeat, replace=True, random_state=seed).tolist()
+    first_words = [title.split()[0].lower() for title in titles]
+    for mode in ['substring', 'prefix']:
+        results.append(measure(f"search_books(title, {mode})", library.search_books,
+                               [(word, 'title', mode) for word in first_words], memory))
+    results.append(measure('find_available_books(title)', library.find_available_books,
+                           [(word,) for word in first_words], memory))
+
+    for name, report in library.REPORTS.items():
+        for consider_availability in ([True, False] if report.get('availability') else [True]):
+            results.append(measure(f"report {name}{'' if consider_availability else ' (all books)'}",
+                                   uncached_report, [(name, consider_availability)] * repeat, memory))
+
+    results.append(measure('recommend_books', library.recommend_books,
+                           [(int(user_id),) for user_id in rng.choice(user_ids, repeat)], memory))
+
+    # Each order is for a different user and book, so none is refused as already ordered
+    orders = list(zip(rng.choice(user_ids, repeat + 1, replace=False).tolist(),
+                      rng.choice(book_ids, repeat + 1).tolist()))
+    results.append(measure('place_order', library.process_order, orders[:-1], memory, orders[-1]))
+
+    # Every upload is a new file of new books, so all of its rows are imported
+    uploads = []
+    upload_size = max(size // 100, 100)
+    for upload in range(max(repeat // 5, 1) + 1):
+        path = f"upload_{upload}.csv"
+        books = generate_books(rng, upload_size, first_id=int(book_ids.max()) + 1 + upload * upload_size)
+        books['title'] = books['title'] + f" upload {upload}"
+        books.to_csv(path, index=False)
+        uploads.append((path,))
+    results.append(measure('upload_books_from_csv', library.upload_books_from_csv, uploads[:-1], memory,
+                           uploads[-1]))
+
+    results.append(measure('save_dataframes', library.save_dataframes, [()] * max(repeat // 5, 1), memory))
+    return results
+
+
+# Reporting
+def print_results(results, baseline=None, threshold=REGRESSION_THRESHOLD):
+    baseline = {result['operation']: result for result in baseline or []}
+    print(f"{'operation':<48} {'calls':>6} {'ops/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} "
+          f"{'peak KiB':>10}" + (f" {'p50 vs baseline':>16}" if baseline else ''))
+    regressions = []
+    for result in results:
+        line = (f"{result['operation']:<48} {result['calls']:>6} {result['throughput'] or 0:>10.1f} "
+                f"{result['p50_ms']:>10.3f} {result['p95_ms']:>10.3f} {result['p99_ms']:>10.3f} "
+                f"{result['peak_kb'] if result['peak_kb'] is not None else float('nan'):>10.0f}")
+        previous = baseline.get(result['operation'])
+        if previous is not None and previous['p50_ms']:
+            ratio = result['p50_ms'] / previous['p50_ms']
+            line += f" {ratio:>15.2f}x"
+            if ratio > threshold:
+                line += ' SLOWER'
+                regressions.append(result['operation'])
+        print(line)
+    return regressions
+
+
+def load_baseline(path, size):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as handle:
+        return json.load(handle).get(size)
+
+
+def save_baseline(path, size, results):
+    baselines = {}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as handle:
+            baselines = json.load(handle)
+    baselines[size] = results
+    with open(path + '.tmp', 'w', encoding='utf-8') as handle:
+        json.dump(baselines, handle, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the library operations on a synthetic library.")
+    parser.add_argument('size', nargs='?', default='10k', choices=list(SIZES))
+    parser.add_argument('--repeat', type=int, default=20, help="calls per operation")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--directory', help="where the generated library is written (default: a temporary one)")
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true', help="store these results as the baseline")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="p50 ratio to the baseline reported as a regression")
+    parser.add_argument('--no-memory', action='store_true', help="skip the traced calls measuring peak memory")
+    args = parser.parse_args()
+
+    baseline_path = os.path.abspath(args.baseline)
+    directory = args.directory or tempfile.mkdtemp(prefix='library-benchmark-')
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+
+    print(f"Generating {args.size} books and users (seed {args.seed}) in {directory}")
+    started = time.perf_counter()
+    write_library(SIZES[args.size], args.seed)
+    print(f"Generated in {time.perf_counter() - started:.1f}s")
+
+    results = run_benchmarks(SIZES[args.size], args.repeat, args.seed, not args.no_memory)
+    regressions = print_results(results, load_baseline(baseline_path, args.size), args.threshold)
+    if args.save_baseline:
+        save_baseline(baseline_path, args.size, results)
+        print(f"Baseline saved to {baseline_path}")
+    if regressions:
+        print(f"{len(regressions)} operations are slower than the baseline by more than {args.threshold}x.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,51 +1,1793 @@
-import pandas as pd
+import importlib.util
+import numpy as np
 import ast
+import bisect
 import os
 import re
+import sys
 import csv
-import matplotlib.pyplot as plt
+import time
+import threading
+import io
+import itertools
+import functools
+import atexit
+from contextlib import contextmanager, nullcontext
+import json
+import pickle
+import hashlib
+from collections import OrderedDict
+
+
+# Import a module on first attribute access, so the menu appears without waiting for it
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+pd = lazy_import('pandas')
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Write-ahead journal: every mutation appends one line here instead of rewriting the CSV files
+JOURNAL_FILE = 'journal.log'
+# Number of journal entries after which the journal is folded back into the snapshot files
+JOURNAL_COMPACT_THRESHOLD = 500
+journal_entries = 0
+# Journal appends and the in-memory apply of each entry happen under this lock, one entry at a time
+commit_lock = threading.RLock()
+
+# Transactions lock the rows they read and write; rows map onto a fixed set of lock stripes
+ROW_LOCK_STRIPES = 1024
+row_lock_stripes = [threading.Lock() for _ in range(ROW_LOCK_STRIPES)]
+# How often a transaction is retried when another process changed its rows in the meantime
+TRANSACTION_RETRIES = 3
+
+# Shared-storage mode (LIBRARY_SHARED=1) lets several processes use the same files: commits hold an advisory
+# lock on LOCK_FILE and first apply the journal entries other processes appended since this one last looked
+SHARED_STORAGE = os.environ.get('LIBRARY_SHARED') == '1'
+LOCK_FILE = 'library.lock'
+file_lock_depth = 0
+# Version stamps: the journal generation (bumped by every compaction), the bytes of the journal applied by
+# this process, and the number of changes applied to each (table, id) row
+journal_generation = 0
+journal_offset = 0
+journal_seen = None
+row_versions = {}
+
+# Rows per chunk when streaming CSV uploads, so memory stays bounded whatever the size of the file
+IMPORT_CHUNK_SIZE = 50000
+
+# Storage backend for the snapshot files: 'csv' (default) or 'parquet', which stores list and dict columns natively
+STORAGE_BACKEND = os.environ.get('LIBRARY_STORAGE', 'csv')
+STORAGE_EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet'}
+
+# Reviews are saved before books: books.csv only loses its old reviews column once reviews.csv exists
+TABLE_FRAMES = {'users': 'user_df', 'admins': 'admin_df', 'reviews': 'reviews_df', 'books': 'books_df'}
+TABLE_COLUMNS = {
+    'users': ['id', 'username', 'password', 'address', 'city', 'orders', 'favorites', 'balance', 'order_stores'],
+    'admins': ['id', 'username', 'password', 'bookstores'],
+    'reviews': ['id', 'book_id', 'user_id', 'rating', 'comment'],
+    'books': ['id', 'title', 'author', 'publisher', 'categories', 'cost', 'shipping_cost', 'availability',
+              'copies', 'bookstores'],
+}
+# Columns that hold Python lists/dicts: CSV stores them as text, parquet as list<...> and map<string, ...>
+LIST_COLUMNS = {
+    'users': {'orders': 'int', 'favorites': 'int'},
+    'admins': {'bookstores': 'int'},
+    'reviews': {},
+    'books': {'categories': 'string'},
+}
+MAP_COLUMNS = {
+    'users': {'order_stores': 'string'},
+    'admins': {},
+    'reviews': {},
+    'books': {'bookstores': 'int'},
+}
+
+# Compact in-memory dtypes: repeated strings as categoricals and counts as nullable small ints. The strings in
+# the list columns (the categories) are interned, so every book shares one object per category.
+COMPACT_DTYPES = {
+    'users': {'city': 'category'},
+    'admins': {},
+    'reviews': {'rating': 'Int8'},
+    'books': {'author': 'category', 'publisher': 'category', 'copies': 'Int32'},
+}
+
+# Hash indexes: column value -> row label, maintained by apply_change() on every insert, update and delete
+INDEXED_COLUMNS = {
+    'users': ['id', 'username'],
+    'admins': ['id', 'username'],
+    'reviews': ['id'],
+    'books': ['id'],
+}
+table_indexes = {}
+next_row_labels = {}
+
+# Tables are loaded on first use, in groups that are indexed together (the books' indexes need the reviews), so
+# the menu appears without loading anything and an admin login only reads the admins
+TABLE_GROUPS = [['admins'], ['users'], ['books', 'reviews']]
+loaded_tables = set()
+
+# Parsed snapshot files (and for the books group also the indexes built from them) are pickled into this directory
+# and reused while the file's path, size, mtime and content hash are unchanged. A new SNAPSHOT_CACHE_VERSION (or
+# pandas version) invalidates every cached frame.
+SNAPSHOT_CACHE_DIRECTORY = '.snapshot_cache'
+SNAPSHOT_CACHE_VERSION = 2
+
+# Inverted full-text index over these book columns: word beginnings for prefix queries, trigrams for substrings.
+# Per column: the lowercased texts by book id, the postings built on load as arrays (text_postings), the postings
+# of the books added or changed since as sets (text_added) and the books removed or changed since (text_removed).
+TEXT_COLUMNS = ['title', 'author', 'publisher']
+text_values = {}
+text_postings = {}
+text_added = {}
+text_removed = {}
+
+# Category index: category -> set of book ids, and the categories each indexed book was filed under
+category_index = {}
+book_categories = {}
+
+# Review indexes: book id and user id -> {review id: None} in the order the reviews were written, the
+# rating aggregates of every reviewed book as [count, sum], and the reviewed books sorted as
+# [(mean rating, count, book id)] for the top-rated query
+reviews_by_book = {}
+reviews_by_user = {}
+rating_stats = {}
+rated_books = []
+
+# Materialized report aggregates, kept in step with every change by apply_change so the reports and cost totals
+# read them instead of scanning the frames: book counts per (column, available only) and value for the
+# publisher, author and categories columns, the number of available books per cost, [count, sum] of the cost
+# with shipping of the available books per publisher and author ('total' sums all of them under 'all'),
+# the stock per store id and the users per city
+AGGREGATE_COLUMNS = {'books': {'publisher', 'author', 'categories', 'availability', 'cost', 'shipping_cost'},
+                     'users': {'city'}}
+book_counts = {}
+cost_counts = {}
+cost_totals = {'publisher': {}, 'author': {}, 'total': {}}
+store_totals = {}
+city_totals = {}
+
+# Report engine: the data of every report is cached with the versions of the columns it is computed from
+# and only recomputed after one of them changed. column_versions counts the changes per (table, column);
+# (table, None) counts inserted and deleted rows. Reports are drawn on matplotlib's Agg canvas, so they
+# can be written to PNG/SVG/JSON files without a display.
+REPORT_DIRECTORY = 'reports'
+REPORT_FORMATS = ['png', 'svg', 'json']
+column_versions = {}
+report_cache = {}
+rendered_reports = {}
+
+# Store inventory, normalized out of the books' bookstores dicts: one (book_id, store_id, count, level) row per
+# book and store in growable integer arrays, indexed by book and by store; level is the highest count the row has
+# had. Store names map to compact ids through store_ids/store_names. The snapshot files and the journal keep the
+# bookstores dicts, which are converted on load and save, and the copies column of a book is always the sum of
+# its inventory counts.
+inventory = {'book_id': np.zeros(0, dtype=np.int64), 'store_id': np.zeros(0, dtype=np.int32),
+             'count': np.zeros(0, dtype=np.int32), 'level': np.zeros(0, dtype=np.int32)}
+inventory_size = 0
+inventory_free_rows = []
+book_inventory = {}
+store_inventory = {}
+store_ids = {}
+store_names = []
+
+# Store allocation: the store an order takes its copy from. 'city' prefers the stores in the user's city
+# (from STORES_FILE, a CSV of store,city) and otherwise behaves like 'largest', the store with the most
+# copies; 'balanced' takes from the store with the most copies relative to its highest stock level, so all
+# stores run out at the same rate. Returns go back to the store recorded in the user's order_stores.
+ALLOCATION_POLICY = 'city'
+ALLOCATION_POLICIES = ['city', 'largest', 'balanced']
+STORES_FILE = 'stores.csv'
+store_cities = {}
+
+# Recommendation engine: how much favorites and orders count as interest in a book, and how the
+# category score and the co-order score (books other users ordered/favorited together) are mixed
+FAVORITE_WEIGHT = 1.0
+ORDER_WEIGHT = 1.0
+CATEGORY_SCORE_WEIGHT = 1.0
+CO_ORDER_SCORE_WEIGHT = 1.0
+RECOMMENDATIONS_PER_USER = 10
+# Sparse matrices built from the current data. Changes to orders and favorites are folded into the co-order
+# matrix as they happen (through a small pending matrix of up to CO_ORDER_CHANGES_LIMIT entries); a change to
+# the catalogue drops the model, which is built again when it is next needed.
+recommendation_model = None
+CO_ORDER_CHANGES_LIMIT = 100000
+# LRU cache of user id -> {'time', 'books': [(book id, score), ...], 'items', 'categories'}; an entry is
+# dropped after RECOMMENDATION_CACHE_TTL seconds or when a change touches the items/categories it was built from.
+# The reverse maps book id/category -> cached user ids find those entries without scanning the cache.
+RECOMMENDATION_CACHE_SIZE = 10000
+RECOMMENDATION_CACHE_TTL = 3600
+recommendation_cache = OrderedDict()
+cached_by_book = {}
+cached_by_category = {}
+recommendation_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+recommendation_lock = threading.Lock()
+
+# Instrumentation, off unless LIBRARY_METRICS=1 (or enable_metrics()): the @instrumented operations record their
+# calls and time, and the hot paths count rows scanned, bytes written and cache hits/misses into
+# metric_counters[(metric, label)]. LIBRARY_PROFILE=cprofile|tracemalloc also captures a profile of the session.
+metrics_enabled = False
+operation_metrics = {}
+metric_counters = {}
+metrics_lock = threading.Lock()
+PROFILE_MODES = ['cprofile', 'tracemalloc']
+PROFILE_FILE = 'library.prof'
+profiler = None
+
+
+# Instrumentation
+# Time every call of an operation while metrics are enabled; disabled, the wrapper only checks the flag
+def instrumented(function):
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not metrics_enabled:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with metrics_lock:
+                stats = operation_metrics.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+                stats['calls'] += 1
+                stats['seconds'] += elapsed
+                stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+    return wrapper
+
+
+def count_metric(metric, label, amount=1):
+    if not metrics_enabled:
+        return
+    with metrics_lock:
+        metric_counters[(metric, label)] = metric_counters.get((metric, label), 0) + amount
 
 
-# Initialize DataFrames
-def initialize_dataframes():
-    global user_df, admin_df, books_df
+def enable_metrics(profile=None):
+    global metrics_enabled
 
-    user_columns = ['id', 'username', 'password', 'address', 'city', 'orders', 'favorites', 'balance']
-    admin_columns = ['id', 'username', 'password', 'bookstores']
-    books_columns = ['id', 'title', 'author', 'publisher', 'categories', 'cost', 'shipping_cost', 'availability',
-                     'copies', 'bookstores', 'reviews']
+    if not metrics_enabled:
+        metrics_enabled = True
+        atexit.register(print_metrics_summary)
+    if profile:
+        start_profiling(profile)
 
-    if os.path.exists('users.csv'):
-        user_df = pd.read_csv('users.csv', converters={'orders': ast.literal_eval, 'favorites': ast.literal_eval,
-                                                       'reviews': lambda x: ast.literal_eval(x) if pd.notna(x) else []})
-    else:
-        user_df = pd.DataFrame(columns=user_columns)
 
-    if os.path.exists('admins.csv'):
-        admin_df = pd.read_csv('admins.csv', converters={'bookstores': ast.literal_eval})
-    else:
-        admin_df = pd.DataFrame(columns=admin_columns)
+def reset_metrics():
+    with metrics_lock:
+        operation_metrics.clear()
+        metric_counters.clear()
+
 
-    if os.path.exists('books.csv'):
-        books_df = pd.read_csv('books.csv', converters={'categories': ast.literal_eval, 'bookstores': ast.literal_eval})
+def start_profiling(mode):
+    global profiler
+
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode '{mode}'.")
+    if mode == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        import tracemalloc
+        tracemalloc.start()
+        profiler = tracemalloc
+
+
+# Stop the capture and return its report: the cProfile stats are also written to PROFILE_FILE (for pstats or
+# snakeviz), the tracemalloc report lists the lines that allocated the most memory
+def stop_profiling(limit=20):
+    global profiler
+
+    if profiler is None:
+        return None
+    report = io.StringIO()
+    if hasattr(profiler, 'take_snapshot'):
+        snapshot = profiler.take_snapshot()
+        current, peak = profiler.get_traced_memory()
+        profiler.stop()
+        print(f"Traced memory: {current / 1024:.0f} KiB now, {peak / 1024:.0f} KiB at peak", file=report)
+        for stat in snapshot.statistics('lineno')[:limit]:
+            print(stat, file=report)
     else:
-        books_df = pd.DataFrame(columns=books_columns)
+        import pstats
+        profiler.disable()
+        profiler.dump_stats(PROFILE_FILE)
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(limit)
+    profiler = None
+    return report.getvalue()
+
+
+# The registry as plain data: per operation calls and seconds, the counters and the cache hit rates
+def metrics_registry():
+    with metrics_lock:
+        operations = {name: dict(stats, mean_seconds=stats['seconds'] / stats['calls'])
+                      for name, stats in operation_metrics.items()}
+        counters = {}
+        for (metric, label), value in metric_counters.items():
+            counters.setdefault(metric, {})[label] = value
+
+    caches = {'recommendations': dict(recommendation_cache_stats)}
+    for cache, hits in counters.get('cache_hits', {}).items():
+        caches[cache] = {'hits': hits, 'misses': counters.get('cache_misses', {}).get(cache, 0)}
+    for cache, misses in counters.get('cache_misses', {}).items():
+        caches.setdefault(cache, {'hits': 0, 'misses': misses})
+    for stats in caches.values():
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return {'enabled': metrics_enabled, 'operations': operations, 'counters': counters, 'caches': caches}
+
+
+# The registry in the Prometheus text exposition format
+def metrics_prometheus():
+    registry = metrics_registry()
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{prometheus_label(label)}"' for key, label in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}")
+
+    operations = registry['operations'].items()
+    family('library_operation_calls_total', 'counter', 'Calls of each instrumented operation.',
+           [({'operation': name}, stats['calls']) for name, stats in operations])
+    family('library_operation_seconds_total', 'counter', 'Time spent in each instrumented operation.',
+           [({'operation': name}, stats['seconds']) for name, stats in operations])
+    family('library_operation_seconds_max', 'gauge', 'Longest call of each instrumented operation.',
+           [({'operation': name}, stats['max_seconds']) for name, stats in operations])
+    family('library_rows_scanned_total', 'counter', 'Rows read by the operations.',
+           [({'operation': label}, value) for label, value in registry['counters'].get('rows_scanned', {}).items()])
+    family('library_bytes_written_total', 'counter', 'Bytes written to the snapshot files and the journal.',
+           [({'target': label}, value) for label, value in registry['counters'].get('bytes_written', {}).items()])
+    family('library_literals_parsed_total', 'counter', 'List/dict cells parsed with ast.literal_eval.',
+           [({'operation': label}, value) for label, value in registry['counters'].get('literals_parsed', {}).items()])
+    caches = registry['caches'].items()
+    family('library_cache_hits_total', 'counter', 'Cache hits.',
+           [({'cache': name}, stats['hits']) for name, stats in caches])
+    family('library_cache_misses_total', 'counter', 'Cache misses.',
+           [({'cache': name}, stats['misses']) for name, stats in caches])
+    return '\n'.join(lines) + '\n'
+
+
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# A readable summary of the session's metrics, printed at exit while metrics are enabled
+def metrics_summary():
+    registry = metrics_registry()
+    lines = [f"{'operation':<36} {'calls':>8} {'total s':>10} {'mean ms':>10} {'max ms':>10}"]
+    for name, stats in sorted(registry['operations'].items(), key=lambda item: -item[1]['seconds']):
+        lines.append(f"{name:<36} {stats['calls']:>8} {stats['seconds']:>10.3f} "
+                     f"{stats['mean_seconds'] * 1000:>10.3f} {stats['max_seconds'] * 1000:>10.3f}")
+    for metric, values in sorted(registry['counters'].items()):
+        if metric not in ['cache_hits', 'cache_misses']:
+            lines.append(f"{metric}: " + ', '.join(f"{label} {value}" for label, value in sorted(values.items())))
+    for cache, stats in registry['caches'].items():
+        lines.append(f"{cache} cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%})")
+    return '\n'.join(lines)
+
+
+def print_metrics_summary():
+    profile = stop_profiling()
+    print("\nSession metrics:")
+    print(metrics_summary())
+    if profile:
+        print(profile)
+
+
+if os.environ.get('LIBRARY_METRICS') == '1' or os.environ.get('LIBRARY_PROFILE'):
+    enable_metrics(os.environ.get('LIBRARY_PROFILE'))
+
+
+# Initialize DataFrames
+# (Re)load the given tables, or all of them, from the snapshot files and the journal; the other tables are
+# loaded when they are first needed
+@instrumented
+def initialize_dataframes(tables=None):
+    loaded_tables.clear()
+    require_tables(*(TABLE_FRAMES if tables is None else tables))
+
+
+# Make sure the tables are loaded; loads the groups they belong to and replays the journal into them
+def require_tables(*tables):
+    if loaded_tables.issuperset(tables):
+        return
+
+    # Another process must not compact the journal while the snapshot files are being read. Tables that are
+    # already loaded first catch up with the journal, so all of them end up at the same journal position.
+    with storage_locked(sync=bool(loaded_tables)):
+        groups = [group for group in TABLE_GROUPS
+                  if not loaded_tables.issuperset(group) and not set(group).isdisjoint(tables)]
+        if not groups:
+            return
+        first = not loaded_tables
+        new_tables = [table for group in groups for table in group]
+        with data_lock.write_locked():
+            for group in groups:
+                load_table_group(group)
+            loaded_tables.update(new_tables)
+            clear_recommendations()
+            replay_journal(new_tables, first)
+
+    if journal_entries >= JOURNAL_COMPACT_THRESHOLD:
+        compact_journal()
+
+
+def load_table_group(group):
+    global user_df, admin_df, books_df, reviews_df
+
+    # One-shot migration: the first start with a new backend converts the existing snapshot files
+    for table in group:
+        if not os.path.exists(table_path(table)):
+            for backend in STORAGE_EXTENSIONS:
+                if os.path.exists(table_path(table, backend)):
+                    migrate_table(table, backend, STORAGE_BACKEND)
+                    break
+
+    if 'admins' in group:
+        admin_df = load_table('admins')
+        build_indexes('admins')
+    if 'users' in group:
+        user_df = load_table('users')
+        build_indexes('users')
+        build_aggregates('users')
+    if 'books' in group:
+        paths = [table_path('books'), table_path('reviews')]
+        state = read_snapshot_cache('books.group', paths, dict)
+        if state is not None:
+            count_metric('cache_hits', 'snapshots')
+            restore_book_group(state)
+        else:
+            count_metric('cache_misses', 'snapshots')
+            build_book_group()
+            write_snapshot_cache('books.group', paths, book_group_state())
+        load_store_cities()
+        report_cache.clear()
+        rendered_reports.clear()
+
+
+# Everything the books group derives from the books and reviews snapshot files: the frames and the indexes and
+# aggregates built from them. It is cached as a whole, so a warm start restores the indexes instead of
+# rebuilding them; the journal is replayed on top of it as usual.
+BOOK_GROUP_STATE = ['books_df', 'reviews_df', 'inventory', 'inventory_size', 'inventory_free_rows', 'book_inventory',
+                    'store_inventory', 'store_ids', 'store_names', 'store_totals', 'reviews_by_book', 'reviews_by_user',
+                    'rating_stats', 'rated_books', 'text_values', 'text_postings', 'text_added', 'text_removed',
+                    'category_index', 'book_categories', 'book_counts', 'cost_counts', 'cost_totals']
+
+
+def build_book_group():
+    global books_df, reviews_df
+
+    books_df = split_inventory(load_table('books', cache=False))
+    reviews_df = load_table('reviews', cache=False)
+    # Reviews used to be text in a reviews column of the books; they move to their own table on first load
+    if 'reviews' in books_df.columns:
+        if not os.path.exists(table_path('reviews')):
+            reviews_df = compact_frame('reviews', split_reviews(books_df))
+        books_df = books_df.drop(columns='reviews')
+
+    build_indexes('books')
+    build_indexes('reviews')
+    build_review_indexes()
+    build_text_index()
+    build_category_index()
+    build_aggregates('books')
+
+
+def book_group_state():
+    state = {name: globals()[name] for name in BOOK_GROUP_STATE}
+    state['table_indexes'] = {table: table_indexes[table] for table in ['books', 'reviews']}
+    state['next_row_labels'] = {table: next_row_labels[table] for table in ['books', 'reviews']}
+    return state
 
 
+def restore_book_group(state):
+    for name in BOOK_GROUP_STATE:
+        globals()[name] = state[name]
+    table_indexes.update(state['table_indexes'])
+    next_row_labels.update(state['next_row_labels'])
+
+
+@instrumented
 def save_dataframes():
+    require_tables(*TABLE_FRAMES)
     try:
-        user_df.to_csv('users.csv', index=False)
-        admin_df.to_csv('admins.csv', index=False)
-        books_df.to_csv('books.csv', index=False)
+        for table in TABLE_FRAMES:
+            save_table(table, snapshot_frame(table))
         print("Data saved successfully.")
+        return True
     except PermissionError as e:
         print(f"Error: {e}")
         print("Please ensure you have write permissions and the file is not open in another program.")
+        return False
+
+
+# The frame as it is written to the snapshot files: books get their bookstores dicts back from the inventory
+def snapshot_frame(table):
+    df = globals()[TABLE_FRAMES[table]]
+    if table == 'books':
+        df = df.copy(deep=False)
+        df.insert(df.columns.get_loc('copies') + 1, 'bookstores',
+                  [book_bookstores(book_id) for book_id in df['id'].tolist()])
+    return df
+
+
+# Storage backends
+def table_path(table, backend=None):
+    return table + STORAGE_EXTENSIONS[backend or STORAGE_BACKEND]
+
+
+# Load a snapshot file; with cache=False the snapshot cache is left to the caller (the books group caches the
+# frames together with their indexes)
+@instrumented
+def load_table(table, backend=None, cache=True):
+    backend = backend or STORAGE_BACKEND
+    path = table_path(table, backend)
+
+    if not os.path.exists(path):
+        return compact_frame(table, pd.DataFrame(columns=TABLE_COLUMNS[table]))
+    df = read_snapshot_cache(os.path.basename(path), [path], pd.DataFrame) if cache else None
+    if df is not None:
+        count_metric('cache_hits', 'snapshots')
+        return add_missing_columns(table, df)
+    if cache:
+        count_metric('cache_misses', 'snapshots')
+
+    if backend == 'parquet':
+        df = read_parquet_table(table, path)
+    else:
+        converters = {column: ast.literal_eval for column in LIST_COLUMNS[table]}
+        converters.update({column: ast.literal_eval for column in MAP_COLUMNS[table]})
+        df = pd.read_csv(path, converters=converters)
+        count_metric('rows_scanned', 'load_table', len(df))
+        count_metric('literals_parsed', 'load_table', len(df) * len(converters))
+    df = compact_frame(table, df)
+    if cache:
+        write_snapshot_cache(os.path.basename(path), [path], df)
+    return add_missing_columns(table, df)
+
+
+# Snapshot cache: what was parsed or built from some snapshot files, valid while each file has the same path,
+# size, mtime and content (or is still missing). The hash catches rewrites that keep the size within the mtime
+# resolution of the file system.
+def snapshot_cache_path(name):
+    return os.path.join(SNAPSHOT_CACHE_DIRECTORY, name + '.pickle')
+
+
+def snapshot_key(paths):
+    key = [SNAPSHOT_CACHE_VERSION, pd.__version__]
+    for path in paths:
+        if not os.path.exists(path):
+            key.append((os.path.abspath(path), None))
+            continue
+        stat = os.stat(path)
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as handle:
+            for block in iter(lambda: handle.read(1 << 20), b''):
+                digest.update(block)
+        key.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns, digest.hexdigest()))
+    return tuple(key)
+
+
+# The cached value, or None when there is none or it is stale, unreadable or not of the expected type; a stale or
+# corrupt cache file is removed and the snapshot files are parsed again
+def read_snapshot_cache(name, paths, expected_type):
+    cache_path = snapshot_cache_path(name)
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, 'rb') as handle:
+            key, value = pickle.load(handle)
+        if key == snapshot_key(paths) and isinstance(value, expected_type):
+            return value
+    except Exception:
+        pass
+    try:
+        os.remove(cache_path)
+    except OSError:
+        pass
+    return None
+
+
+# Written to a temporary file of this process first, so a crash or another process never leaves a half-written
+# cache file; the cache is only an optimization, so a failure to write it is ignored
+def write_snapshot_cache(name, paths, value):
+    cache_path = snapshot_cache_path(name)
+    try:
+        os.makedirs(SNAPSHOT_CACHE_DIRECTORY, exist_ok=True)
+        temporary_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'wb') as handle:
+            pickle.dump((snapshot_key(paths), value), handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, cache_path)
+    except (OSError, pickle.PicklingError):
+        pass
+
+
+# Columns added after a snapshot file was written start out empty
+def add_missing_columns(table, df):
+    for column in TABLE_COLUMNS[table]:
+        if column not in df.columns:
+            if column in LIST_COLUMNS[table] or column in MAP_COLUMNS[table]:
+                df[column] = [[] if column in LIST_COLUMNS[table] else {} for _ in range(len(df))]
+            else:
+                df[column] = None
+    return df
+
+
+# Convert a freshly loaded frame to the compact dtypes and intern the strings of its list columns
+def compact_frame(table, df):
+    for column, dtype in COMPACT_DTYPES[table].items():
+        if column in df.columns and df[column].dtype != dtype:
+            df[column] = df[column].astype(dtype)
+    return intern_lists(table, df)
+
+
+def intern_lists(table, df):
+    for column, item_type in LIST_COLUMNS[table].items():
+        if item_type == 'string' and column in df.columns:
+            df[column] = [[sys.intern(item) if isinstance(item, str) else item for item in values]
+                          if isinstance(values, list) else values for values in df[column].tolist()]
+    return df
+
+
+# Give rows about to be appended to df the same compact dtypes, so the concat keeps them; categories df does not
+# know yet are added to it first, and a column of df that is not compact yet (e.g. added to an old snapshot
+# file as empty) is converted
+def conform_rows(table, df, rows):
+    for column, dtype in COMPACT_DTYPES[table].items():
+        if column not in rows.columns or column not in df.columns:
+            continue
+        if df[column].dtype != dtype:
+            df[column] = df[column].astype(dtype)
+        if dtype == 'category':
+            add_column_categories(df, column, rows[column].dropna().unique())
+            rows[column] = pd.Categorical(rows[column], dtype=df[column].dtype)
+        else:
+            rows[column] = rows[column].astype(dtype)
+    return intern_lists(table, rows)
+
+
+def add_column_categories(df, column, values):
+    if not isinstance(df[column].dtype, pd.CategoricalDtype):
+        return
+    new = pd.Index(values).difference(df[column].cat.categories)
+    if len(new):
+        df[column] = df[column].cat.add_categories(new)
+
+
+# Memory used by every column of the loaded tables (deep, counting the Python objects of object columns), the
+# inventory arrays and the in-memory indexes
+def memory_report():
+    rows = []
+    for table in TABLE_FRAMES:
+        if table in loaded_tables:
+            df = globals()[TABLE_FRAMES[table]]
+            usage = df.memory_usage(deep=True, index=False)
+            rows += [(table, column, str(df[column].dtype), int(usage[column])) for column in df.columns]
+    rows += [('inventory', column, str(values.dtype), int(values.nbytes)) for column, values in inventory.items()]
+    rows += [('indexes', name, type(globals()[name]).__name__, container_size(globals()[name]))
+             for name in MEMORY_REPORT_INDEXES]
+    return pd.DataFrame(rows, columns=['table', 'column', 'dtype', 'bytes'])
+
+
+MEMORY_REPORT_INDEXES = ['table_indexes', 'text_postings', 'text_added', 'text_values', 'category_index',
+                         'book_categories', 'reviews_by_book', 'reviews_by_user', 'rating_stats', 'book_inventory',
+                         'store_inventory', 'row_versions']
+
+
+# Size of a dict/set/list/tuple structure and the containers and arrays nested in it; the keys and values
+# themselves are mostly shared with the frames and are not counted
+def container_size(value):
+    nested = (dict, set, list, tuple, np.ndarray)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(container_size(item) for item in value.values() if isinstance(item, nested))
+    elif isinstance(value, (set, list, tuple)):
+        size += sum(container_size(item) for item in value if isinstance(item, nested))
+    return size
+
+
+def print_memory_report():
+    report = memory_report()
+    for table, columns in report.groupby('table', sort=False):
+        print(f"{table}: {columns['bytes'].sum() / 1024:,.1f} KiB")
+        for row in columns.sort_values('bytes', ascending=False).itertuples():
+            print(f"  {row.column:<16} {row.dtype:<10} {row.bytes / 1024:>14,.1f} KiB")
+    print(f"Total: {report['bytes'].sum() / 1024:,.1f} KiB")
+
+
+@instrumented
+def save_table(table, df, backend=None):
+    backend = backend or STORAGE_BACKEND
+    path = table_path(table, backend)
+
+    # Write to a temporary file first so a crash never leaves a half-written snapshot
+    if backend == 'parquet':
+        write_parquet_table(table, df, path + '.tmp')
+    else:
+        df.to_csv(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+    if metrics_enabled:
+        count_metric('bytes_written', path, os.path.getsize(path))
+
+
+def migrate_table(table, source, target):
+    save_table(table, load_table(table, source), target)
+    print(f"Migrated {table_path(table, source)} to {table_path(table, target)}.")
+
+
+# Copy every table from one backend to another, e.g. migrate_storage('parquet', 'csv') to export as CSV
+@instrumented
+def migrate_storage(source='csv', target='parquet'):
+    for table in TABLE_FRAMES:
+        if os.path.exists(table_path(table, source)):
+            migrate_table(table, source, target)
+
+
+# Values of list/dict columns may still be text, e.g. rows uploaded from a CSV file
+def as_python_value(value, default):
+    if isinstance(value, str):
+        return ast.literal_eval(value)
+    if isinstance(value, (list, dict)):
+        return value
+    return default
+
+
+def write_parquet_table(table, df, path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    item_types = {'int': pa.int64(), 'string': pa.string()}
+    columns = {}
+    for column in df.columns:
+        if column in LIST_COLUMNS[table]:
+            values = [as_python_value(value, []) for value in df[column]]
+            columns[column] = pa.array(values, type=pa.list_(item_types[LIST_COLUMNS[table][column]]))
+        elif column in MAP_COLUMNS[table]:
+            values = [as_python_value(value, {}) for value in df[column]]
+            columns[column] = pa.array(values, type=pa.map_(pa.string(), item_types[MAP_COLUMNS[table][column]]))
+        else:
+            try:
+                columns[column] = pa.Array.from_pandas(df[column])
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # Mixed object columns (e.g. reviews that are text, lists or NaN) are stored as nullable strings
+                columns[column] = pa.array([None if not isinstance(value, (str, list)) and pd.isna(value)
+                                            else str(value) for value in df[column]], type=pa.string())
+    pq.write_table(pa.table(columns), path)
+
+
+def read_parquet_table(table, path):
+    import pyarrow.parquet as pq
+
+    arrow_table = pq.read_table(path)
+    nested = [column for column in arrow_table.column_names
+              if column in LIST_COLUMNS[table] or column in MAP_COLUMNS[table]]
+    df = arrow_table.drop_columns(nested).to_pandas()
+    for column in nested:
+        df[column] = arrow_table.column(column).to_pylist(maps_as_pydicts='strict')
+    count_metric('rows_scanned', 'load_table', len(df))
+    return add_missing_columns(table, df[arrow_table.column_names])
+
+
+# Indexes
+def build_indexes(table):
+    df = globals()[TABLE_FRAMES[table]]
+    table_indexes[table] = {column: dict(zip(df[column].tolist(), df.index)) for column in INDEXED_COLUMNS[table]}
+    next_row_labels[table] = int(df.index.max()) + 1 if len(df) else 0
+
+
+def find_row(table, column, value):
+    return table_indexes[table][column].get(value)
+
+
+def find_book(book_id):
+    return find_row('books', 'id', book_id)
+
+
+def find_user(user_id):
+    return find_row('users', 'id', user_id)
+
+
+def find_user_by_username(username):
+    return find_row('users', 'username', username)
+
+
+def find_admin_by_username(username):
+    return find_row('admins', 'username', username)
+
+
+# Keep the secondary book indexes in step with a change to some columns of a book (values None = deleted)
+def update_book_indexes(book_id, values):
+    for field in TEXT_COLUMNS:
+        if values is None or field in values:
+            remove_text(field, book_id)
+            if values is not None:
+                add_text(field, book_id, values[field])
+    if values is None or 'categories' in values:
+        remove_categories(book_id)
+        if values is not None:
+            add_categories(book_id, values['categories'])
+    if values is None or 'bookstores' in values:
+        set_book_inventory(book_id, None if values is None else as_python_value(values['bookstores'], {}))
+
+
+# Category index
+def build_category_index():
+    category_index.clear()
+    book_categories.clear()
+    for book_id, categories in zip(books_df['id'].tolist(), books_df['categories'].tolist()):
+        add_categories(book_id, categories)
+
+
+def add_categories(book_id, categories):
+    categories = as_python_value(categories, [])
+    book_categories[book_id] = categories
+    for category in categories:
+        category_index.setdefault(category, set()).add(book_id)
+
+
+def remove_categories(book_id):
+    for category in book_categories.pop(book_id, []):
+        books = category_index.get(category)
+        if books is not None:
+            books.discard(book_id)
+            if not books:
+                del category_index[category]
+
+
+# Reviews
+# Build the reviews table from the old reviews column of the books, text of a list of review dicts
+def split_reviews(books):
+    rows = []
+    for book_id, reviews in zip(books['id'].tolist(), parse_literal_column(books['reviews'], list, []).tolist()):
+        for review in reviews or []:
+            rows.append({'id': len(rows) + 1, 'book_id': book_id, 'user_id': review.get('user_id'),
+                         'rating': review.get('rating'), 'comment': review.get('comment', '')})
+    return pd.DataFrame(rows, columns=TABLE_COLUMNS['reviews'])
+
+
+def build_review_indexes():
+    reviews_by_book.clear()
+    reviews_by_user.clear()
+    rating_stats.clear()
+    rated_books.clear()
+    review_ids, book_ids, user_ids, ratings = (reviews_df[column].tolist()
+                                               for column in ['id', 'book_id', 'user_id', 'rating'])
+    for review_id, book_id, user_id, rating in zip(review_ids, book_ids, user_ids, ratings):
+        reviews_by_book.setdefault(int(book_id), {})[int(review_id)] = None
+        reviews_by_user.setdefault(int(user_id), {})[int(review_id)] = None
+        count, total = rating_stats.get(int(book_id), (0, 0))
+        rating_stats[int(book_id)] = (count + 1, total + int(rating))
+    # Sorted once instead of inserting every review's book into its place
+    rated_books.extend(sorted((total / count, count, book_id) for book_id, (count, total) in rating_stats.items()))
+
+
+# Add a review to the indexes and its rating to the book's aggregates, or take it out again with add=False
+def index_review(review, add=True):
+    review_id, book_id, user_id = int(review['id']), int(review['book_id']), int(review['user_id'])
+    if add:
+        reviews_by_book.setdefault(book_id, {})[review_id] = None
+        reviews_by_user.setdefault(user_id, {})[review_id] = None
+    else:
+        for index, key in [(reviews_by_book, book_id), (reviews_by_user, user_id)]:
+            index[key].pop(review_id, None)
+            if not index[key]:
+                del index[key]
+
+    count, total = rating_stats.pop(book_id, (0, 0))
+    if count:
+        del rated_books[bisect.bisect_left(rated_books, (total / count, count, book_id))]
+    count += 1 if add else -1
+    # Python ints: the ratings are Int8 in the frame and would overflow the sum
+    total += int(review['rating']) if add else -int(review['rating'])
+    if count:
+        rating_stats[book_id] = (count, total)
+        bisect.insort(rated_books, (total / count, count, book_id))
+
+
+# Replace all reviews of a book, for journal entries written while the reviews were a column of the books
+def set_legacy_reviews(book_id, reviews):
+    for review_id in list(reviews_by_book.get(book_id, {})):
+        apply_change(delete_change('reviews', review_id))
+    for review in as_python_value(reviews, []):
+        apply_change(insert_change('reviews', {
+            'id': next_review_id(), 'book_id': book_id, 'user_id': review.get('user_id'),
+            'rating': review.get('rating'), 'comment': review.get('comment', '')}))
+
+
+def next_review_id():
+    return int(reviews_df['id'].max()) + 1 if len(reviews_df) else 1
+
+
+# Count, sum and mean of the ratings of a book
+def book_rating(book_id):
+    count, total = rating_stats.get(book_id, (0, 0))
+    return {'count': count, 'sum': total, 'mean': total / count if count else None}
+
+
+# The reviews of a book, oldest first
+def book_reviews(book_id):
+    return reviews_df.loc[[find_row('reviews', 'id', review_id) for review_id in reviews_by_book.get(book_id, {})]]
+
+
+# The reviews a user wrote, oldest first
+def user_reviews(user_id):
+    return reviews_df.loc[[find_row('reviews', 'id', review_id) for review_id in reviews_by_user.get(user_id, {})]]
+
+
+# The k books with the highest mean rating and at least min_reviews reviews, as (book id, mean, count)
+@instrumented
+def top_rated_books(k=10, min_reviews=1):
+    books = []
+    for mean, count, book_id in reversed(rated_books):
+        if count >= min_reviews:
+            books.append((book_id, mean, count))
+            if len(books) == k:
+                break
+    return books
+
+
+# Store inventory
+def store_id(name):
+    if name not in store_ids:
+        store_ids[name] = len(store_names)
+        store_names.append(name)
+    return store_ids[name]
+
+
+# Move the bookstores dicts of a freshly loaded books frame into the inventory and derive the copies from it
+def split_inventory(df):
+    global inventory_size
+
+    rows = [(book_id, store_id(store), count)
+            for book_id, bookstores in zip(df['id'].tolist(), df['bookstores'].tolist())
+            for store, count in as_python_value(bookstores, {}).items()]
+    book_ids, stores, counts = zip(*rows) if rows else ((), (), ())
+    inventory['book_id'] = np.array(book_ids, dtype=np.int64)
+    inventory['store_id'] = np.array(stores, dtype=np.int32)
+    inventory['count'] = np.array(counts, dtype=np.int32)
+    inventory['level'] = inventory['count'].copy()
+    inventory_size = len(rows)
+    inventory_free_rows.clear()
+    book_inventory.clear()
+    store_inventory.clear()
+    store_totals.clear()
+    for row, (book_id, store, count) in enumerate(rows):
+        book_inventory.setdefault(book_id, {})[store] = row
+        store_inventory.setdefault(store, {})[book_id] = row
+        add_count(store_totals, store, count)
+
+    df = df.drop(columns='bookstores')
+    df['copies'] = inventory_frame().groupby('book_id')['count'].sum().reindex(df['id']).fillna(0).astype('Int32').array
+    return df
+
+
+# Set the stock of a book per store; bookstores=None removes the book from the inventory
+def set_book_inventory(book_id, bookstores):
+    rows = book_inventory.get(book_id, {})
+    counts = {store_id(store): count for store, count in (bookstores or {}).items()}
+    for store, row in rows.items():
+        add_count(store_totals, store, -int(inventory['count'][row]))
+    for store in [store for store in rows if store not in counts]:
+        remove_inventory_row(book_id, store)
+    for store, count in counts.items():
+        row = book_inventory.get(book_id, {}).get(store)
+        if row is None:
+            row = add_inventory_row(book_id, store)
+        inventory['count'][row] = count
+        inventory['level'][row] = max(inventory['level'][row], count)
+        add_count(store_totals, store, count)
+
+
+def add_inventory_row(book_id, store):
+    global inventory_size
+
+    if inventory_free_rows:
+        row = inventory_free_rows.pop()
+    else:
+        # The arrays grow by doubling, so appending rows is amortized O(1)
+        if inventory_size == len(inventory['book_id']):
+            for column, values in inventory.items():
+                inventory[column] = np.concatenate([values, np.zeros(max(len(values), 16), dtype=values.dtype)])
+        row = inventory_size
+        inventory_size += 1
+    inventory['book_id'][row] = book_id
+    inventory['store_id'][row] = store
+    book_inventory.setdefault(book_id, {})[store] = row
+    store_inventory.setdefault(store, {})[book_id] = row
+    return row
+
+
+# Rows of removed stocks are marked with book id -1 and reused by the next new stock
+def remove_inventory_row(book_id, store):
+    row = book_inventory[book_id].pop(store)
+    if not book_inventory[book_id]:
+        del book_inventory[book_id]
+    del store_inventory[store][book_id]
+    inventory['book_id'][row] = -1
+    inventory['count'][row] = 0
+    inventory['level'][row] = 0
+    inventory_free_rows.append(row)
+
+
+# The stock of a book as a {store name: copies} dict
+def book_bookstores(book_id):
+    return {store_names[store]: int(inventory['count'][row]) for store, row in book_inventory.get(book_id, {}).items()}
+
+
+# The live inventory rows as a frame of book_id, store_id and count
+def inventory_frame():
+    live = inventory['book_id'][:inventory_size] >= 0
+    return pd.DataFrame({column: values[:inventory_size][live] for column, values in inventory.items()})
+
+
+# Copies of every book listed in a store, indexed by book id
+def store_stock_counts(store_name):
+    rows = store_inventory.get(store_ids.get(store_name), {})
+    return pd.Series(inventory['count'][list(rows.values())], index=list(rows.keys()), dtype=int)
+
+
+# The frame cells a book change sets: the bookstores live in the inventory and the copies are derived from them
+def book_frame_values(values):
+    frame_values = {column: value for column, value in values.items()
+                    if column not in ['bookstores', 'copies', 'reviews']}
+    if 'bookstores' in values:
+        frame_values['copies'] = sum(as_python_value(values['bookstores'], {}).values())
+    return frame_values
+
+
+# Store allocation
+def load_store_cities():
+    store_cities.clear()
+    if os.path.exists(STORES_FILE):
+        stores = pd.read_csv(STORES_FILE)
+        store_cities.update(zip(stores['store'], stores['city']))
+
+
+# The (rank, store) of the stores that list the book: their copies ('largest', or only the stores in the city
+# for 'city'), or for 'balanced' their copies relative to the highest stock they have had. Ranked per
+# allocation from the book's few inventory rows instead of keeping sorted indexes up to date.
+def stock_ranks(book_id, policy, city=None):
+    ranks = []
+    for store, row in book_inventory.get(book_id, {}).items():
+        name = store_names[store]
+        count, level = int(inventory['count'][row]), int(inventory['level'][row])
+        if policy == 'balanced':
+            ranks.append((count / level if level else 0.0, name))
+        elif policy == 'largest' or (name in store_cities and store_cities[name] == city):
+            ranks.append((count, name))
+    return ranks
+
+
+# The store an order of the book takes its copy from, or None if no store has one left
+def allocate_store(book_id, city=None, policy=None):
+    policy = policy or ALLOCATION_POLICY
+    if policy not in ALLOCATION_POLICIES:
+        raise ValueError(f"Unknown allocation policy '{policy}'.")
+    candidates = [('city', city), ('largest', None)] if policy == 'city' else [(policy, None)]
+    for key, key_city in candidates:
+        ranks = stock_ranks(book_id, key, key_city)
+        # Ties go to the store whose name sorts last
+        if ranks and max(ranks)[0] > 0:
+            return max(ranks)[1]
+    return None
+
+
+# Take one copy of a book for an order; returns the new bookstores and the store it came from
+def take_copy(book_id, city=None, policy=None):
+    bookstores = book_bookstores(book_id)
+    store = allocate_store(book_id, city, policy)
+    if store is not None:
+        bookstores[store] -= 1
+    return bookstores, store
+
+
+# Put copies of a book back into a store; without a known store the most depleted one gets them
+def return_copies(book_id, store=None, count=1):
+    bookstores = book_bookstores(book_id)
+    if store not in bookstores:
+        ranks = stock_ranks(book_id, 'balanced')
+        if not ranks:
+            return bookstores, None
+        store = min(ranks)[1]
+    bookstores[store] += count
+    return bookstores, store
+
+
+# Report aggregates
+# Add delta to counts[key] and drop keys that fall to zero; missing values are not counted, like value_counts
+def add_count(counts, key, delta):
+    if key is None or key != key:
+        return
+    counts[key] = counts.get(key, 0) + delta
+    if not counts[key]:
+        del counts[key]
+
+
+def add_cost_total(column, key, price, sign):
+    if key is None or key != key:
+        return
+    stats = cost_totals[column].setdefault(key, [0, 0.0])
+    stats[0] += sign
+    stats[1] += sign * price
+    if not stats[0]:
+        del cost_totals[column][key]
+
+
+# Add (sign 1) or take back (sign -1) the contribution of a row, a dict or Series, to the aggregates
+def aggregate_row(table, row, sign):
+    if table == 'users':
+        add_count(city_totals, row.get('city'), sign)
+        return
+    if table != 'books':
+        return
+
+    available = bool(row.get('availability', True))
+    categories = as_python_value(row.get('categories'), [])
+    for available_only in [False, True] if available else [False]:
+        for column in ['publisher', 'author']:
+            add_count(book_counts.setdefault((column, available_only), {}), row.get(column), sign)
+        for category in categories:
+            add_count(book_counts.setdefault(('categories', available_only), {}), category, sign)
+    if available:
+        cost = row.get('cost')
+        add_count(cost_counts, cost, sign)
+        # A missing cost or shipping cost adds nothing to the sums, like sum() skips NaN
+        price = sum(float(value) for value in [cost, row.get('shipping_cost')] if value is not None and value == value)
+        add_cost_total('publisher', row.get('publisher'), price, sign)
+        add_cost_total('author', row.get('author'), price, sign)
+        add_cost_total('total', 'all', price, sign)
+
+
+# Count everything in one vectorized pass on load; later changes go through aggregate_row
+@instrumented
+def build_aggregates(table):
+    if table == 'users':
+        city_totals.clear()
+        city_totals.update(observed_counts(user_df['city']))
+        return
+
+    available = books_df['availability'].astype(bool)
+    categories = books_df['categories'].map(lambda value: as_python_value(value, []))
+    for available_only, rows in [(False, slice(None)), (True, available)]:
+        for column in ['publisher', 'author']:
+            book_counts[(column, available_only)] = observed_counts(books_df.loc[rows, column])
+        book_counts[('categories', available_only)] = categories[rows].explode().value_counts().to_dict()
+
+    books = books_df[available]
+    cost_counts.clear()
+    cost_counts.update(books['cost'].value_counts().to_dict())
+    price = books['cost'].fillna(0).astype(float) + books['shipping_cost'].fillna(0).astype(float)
+    for column in ['publisher', 'author']:
+        sums = price.groupby(books[column], observed=True).agg(['size', 'sum'])
+        cost_totals[column] = {key: [int(count), float(total)]
+                               for key, count, total in zip(sums.index, sums['size'], sums['sum'])}
+    cost_totals['total'] = {'all': [len(price), float(price.sum())]} if len(price) else {}
+
+
+# value_counts without the unused categories of a categorical column
+def observed_counts(column):
+    counts = column.value_counts()
+    return counts[counts > 0].to_dict()
+
+
+# Counts as a Series sorted by decreasing count, like value_counts
+def count_series(counts):
+    return pd.Series(dict(sorted(counts.items(), key=lambda item: -item[1])), dtype=int)
+
+
+# Total cost with shipping of the available books whose publisher or author contains the text (case-insensitive,
+# like search_books), or of all available books without a column
+def available_cost(column=None, text=''):
+    if column is None:
+        return cost_totals['total'].get('all', [0, 0.0])[1]
+    query = text.lower().strip()
+    return sum((total for value, (count, total) in cost_totals[column].items() if query in str(value).lower()), 0.0)
+
+
+# Full-text search
+def tokenize(text):
+    return re.findall(r'\w+', text)
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+# Up to three characters packed into one integer of 21 bits per character (enough for every code point)
+def text_key(text):
+    key = 0
+    for character in text[:3].ljust(3, '\x00'):
+        key = key << 21 | ord(character)
+    return key
+
+
+# The trigram keys and the word-beginning keys (the first one to three characters of every word) of a text
+def text_keys(text):
+    grams = {text_key(gram) for gram in trigrams(text)}
+    prefixes = {text_key(token[:length]) for token in tokenize(text) for length in range(1, min(len(token), 3) + 1)}
+    return grams, prefixes
+
+
+@instrumented
+def build_text_index():
+    ids = books_df['id'].to_numpy(dtype=np.int64)
+    order = np.argsort(ids, kind='stable')
+    ids = ids[order]
+    for field in TEXT_COLUMNS:
+        values = books_df[field].to_numpy(dtype=object)[order]
+        present = np.fromiter((isinstance(value, str) for value in values), dtype=bool, count=len(values))
+        texts = [value.lower() for value in values[present]]
+        text_values[field] = dict(zip(ids[present].tolist(), texts))
+        text_postings[field] = build_postings(ids[present], texts)
+        text_added[field] = {'grams': {}, 'prefixes': {}}
+        text_removed[field] = set()
+
+
+# The keys of all texts at once: the texts are joined with NULs into one array of code points, from which the
+# trigrams and the word beginnings are packed with array operations. The book ids must be ascending.
+def build_postings(book_ids, texts):
+    if not texts:
+        empty = postings_arrays(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32))
+        return {'grams': empty, 'prefixes': empty}
+    codes = np.frombuffer('\x00'.join(texts).encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    books = np.repeat(book_ids.astype(np.int32 if book_ids[-1] < 2 ** 31 else np.int64), lengths + 1)[:len(codes)]
+
+    valid = (codes[:-2] != 0) & (codes[1:-1] != 0) & (codes[2:] != 0)
+    grams = (codes[:-2] << 42 | codes[1:-1] << 21 | codes[2:])[valid]
+    gram_books = books[:-2][valid]
+
+    # Word characters as tokenize() sees them, decided once per distinct character
+    characters = np.unique(codes)
+    is_word = np.array([re.match(r'\w', chr(code)) is not None for code in characters.tolist()])
+    word = np.append(is_word[np.searchsorted(characters, codes)], [False, False])
+    padded = np.append(codes, [0, 0])
+    starts = np.flatnonzero(word[:-2] & ~np.append(False, word[:-3]))
+    key = np.zeros(len(starts), dtype=np.int64)
+    inside = np.ones(len(starts), dtype=bool)
+    prefixes, prefix_books = [], []
+    for length in range(3):
+        inside &= word[starts + length]
+        key |= padded[starts + length] << (42 - 21 * length)
+        prefixes.append(key[inside])
+        prefix_books.append(books[starts[inside]])
+
+    return {'grams': postings_arrays(grams, gram_books),
+            'prefixes': postings_arrays(np.concatenate(prefixes), np.concatenate(prefix_books))}
+
+
+# Postings as three arrays: the sorted distinct keys, the offset of every key's books and the books themselves,
+# ascending within a key. The stable sort keeps the books in the ascending order they came in.
+def postings_arrays(keys, books):
+    order = np.argsort(keys, kind='stable')
+    keys, books = keys[order], books[order]
+    distinct = np.ones(len(keys), dtype=bool)
+    distinct[1:] = (keys[1:] != keys[:-1]) | (books[1:] != books[:-1])
+    keys, books = keys[distinct], books[distinct]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    offsets = np.flatnonzero(first)
+    return keys[offsets], np.append(offsets, len(keys)), books
+
+
+def add_text(field, book_id, value):
+    if not isinstance(value, str):
+        return
+    text = value.lower()
+    text_values[field][book_id] = text
+
+    for kind, keys in zip(['grams', 'prefixes'], text_keys(text)):
+        added = text_added[field][kind]
+        for key in keys:
+            added.setdefault(key, set()).add(book_id)
+
+
+# The arrays built on load are not changed: a removed book is masked out of them (and one that is added again
+# comes back through text_added)
+def remove_text(field, book_id):
+    text = text_values[field].pop(book_id, None)
+    if text is None:
+        return
+
+    text_removed[field].add(book_id)
+    for kind, keys in zip(['grams', 'prefixes'], text_keys(text)):
+        added = text_added[field][kind]
+        for key in keys:
+            postings = added.get(key)
+            if postings is not None:
+                postings.discard(book_id)
+                if not postings:
+                    del added[key]
+
+
+def array_postings(field, kind, key):
+    keys, offsets, books = text_postings[field][kind]
+    position = np.searchsorted(keys, key)
+    if position < len(keys) and keys[position] == key:
+        return books[offsets[position]:offsets[position + 1]]
+    return books[:0]
+
+
+# The books whose text has all the given keys: the intersection of their array postings (smallest first) without
+# the books removed since the arrays were built, plus the intersection of the postings of the books added since
+def text_candidates(field, kind, keys):
+    postings = sorted((array_postings(field, kind, key) for key in keys), key=len)
+    books = postings[0]
+    for other in postings[1:]:
+        books = np.intersect1d(books, other, assume_unique=True)
+    added = sorted((text_added[field][kind].get(key, set()) for key in keys), key=len)
+    return (set(books.tolist()) - text_removed[field]) | added[0].intersection(*added[1:])
+
+
+def prefix_matches(field, prefix):
+    matches = text_candidates(field, 'prefixes', [text_key(prefix)])
+    if len(prefix) > 3:
+        matches &= text_candidates(field, 'grams', [text_key(gram) for gram in trigrams(prefix)])
+        matches = {book_id for book_id in matches
+                   if any(token.startswith(prefix) for token in tokenize(text_values[field][book_id]))}
+    return matches
+
+
+# Search one of the TEXT_COLUMNS and return the matching book ids, best matches first.
+# mode 'substring' matches anywhere in the text (like str.contains), 'prefix' matches the start of every word
+@instrumented
+def search_books(query, field='title', mode='substring', limit=None):
+    query = query.lower().strip()
+    values = text_values[field]
+
+    if mode == 'prefix':
+        words = tokenize(query)
+        matches = None
+        for word in words:
+            word_matches = prefix_matches(field, word)
+            matches = word_matches if matches is None else matches & word_matches
+        matches = matches if matches is not None else set(values)
+    elif len(query) >= 3:
+        # Intersect the trigram postings, then confirm the candidates
+        matches = text_candidates(field, 'grams', [text_key(gram) for gram in trigrams(query)])
+        matches = {book_id for book_id in matches if query in values[book_id]}
+    else:
+        matches = {book_id for book_id, text in values.items() if query in text}
+
+    # Exact matches first, then texts starting with the query, then word matches, then the rest
+    def rank(book_id):
+        text = values[book_id]
+        if text == query:
+            position = 0
+        elif text.startswith(query):
+            position = 1
+        elif any(token.startswith(query) for token in tokenize(text)):
+            position = 2
+        else:
+            position = 3
+        return position, len(text), book_id
+
+    count_metric('rows_scanned', 'search_books', len(matches))
+    ranked = sorted(matches, key=rank)
+    return ranked[:limit] if limit is not None else ranked
+
+
+# Journal changes
+def insert_change(table, row):
+    return {'op': 'insert', 'table': table, 'row': row}
+
+
+def insert_rows_change(table, rows):
+    return {'op': 'insert_rows', 'table': table, 'rows': rows}
+
+
+def update_change(table, row_id, values):
+    return {'op': 'update', 'table': table, 'id': row_id, 'values': values}
+
+
+def delete_change(table, row_id):
+    return {'op': 'delete', 'table': table, 'id': row_id}
+
+
+# Convert numpy scalars (e.g. ids read from the DataFrames) to plain Python values for JSON
+def to_builtin(value):
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def apply_change(change):
+    table = change['table']
+    frame_name = TABLE_FRAMES[table]
+    df = globals()[frame_name]
+    indexes = table_indexes[table]
+    if change['op'] in ['insert', 'insert_rows']:
+        rows = change['rows'] if change['op'] == 'insert_rows' else [change['row']]
+        new_rows = []
+        for row in rows:
+            if row['id'] in indexes['id']:
+                # Inserts replace an existing row with the same id so replaying an entry twice is harmless
+                apply_change(update_change(table, row['id'], row))
+            else:
+                new_rows.append(row)
+
+        # All new rows are appended with a single concat
+        if new_rows:
+            labels = range(next_row_labels[table], next_row_labels[table] + len(new_rows))
+            next_row_labels[table] += len(new_rows)
+            if table == 'books':
+                frame_rows = [book_frame_values({'bookstores': {}, **row}) for row in new_rows]
+            else:
+                frame_rows = new_rows
+            df = pd.concat([df, conform_rows(table, df, pd.DataFrame(frame_rows, index=labels))])
+            for row, label in zip(new_rows, labels):
+                for column, index in indexes.items():
+                    index[row[column]] = label
+                aggregate_row(table, row, 1)
+                if table == 'books':
+                    update_book_indexes(row['id'], row)
+                    if 'reviews' in row:
+                        set_legacy_reviews(row['id'], row['reviews'])
+                elif table == 'reviews':
+                    index_review(row)
+    elif change['op'] == 'update':
+        label = indexes['id'].get(change['id'])
+        if label is not None:
+            values = book_frame_values(change['values']) if table == 'books' else change['values']
+            # Only changes to the aggregated columns are taken out of and put back into the aggregates
+            aggregated = not AGGREGATE_COLUMNS.get(table, set()).isdisjoint(values)
+            if aggregated:
+                aggregate_row(table, df.loc[label], -1)
+            if table == 'reviews':
+                index_review(df.loc[label], add=False)
+            for column, value in values.items():
+                if column in indexes:
+                    indexes[column].pop(df.at[label, column], None)
+                    indexes[column][value] = label
+                if COMPACT_DTYPES[table].get(column) == 'category' and not pd.isna(value):
+                    add_column_categories(df, column, [value])
+                df.at[label, column] = value
+            if table == 'books':
+                update_book_indexes(change['id'], change['values'])
+                if 'reviews' in change['values']:
+                    set_legacy_reviews(change['id'], change['values']['reviews'])
+            elif table == 'reviews':
+                index_review(df.loc[label])
+            if aggregated:
+                aggregate_row(table, df.loc[label], 1)
+    elif change['op'] == 'delete':
+        label = indexes['id'].get(change['id'])
+        if label is not None:
+            for column, index in indexes.items():
+                index.pop(df.at[label, column], None)
+            if table == 'reviews':
+                index_review(df.loc[label], add=False)
+            aggregate_row(table, df.loc[label], -1)
+            df = df.drop(index=label)
+            if table == 'books':
+                update_book_indexes(change['id'], None)
+
+    globals()[frame_name] = df
+    if change['op'] in ['insert', 'insert_rows']:
+        changed_ids = [row['id'] for row in rows]
+    else:
+        changed_ids = [change['id']]
+    for row_id in changed_ids:
+        row_versions[(table, int(row_id))] = row_versions.get((table, int(row_id)), 0) + 1
+    for column in change['values'] if change['op'] == 'update' else [None]:
+        column_versions[(table, column)] = column_versions.get((table, column), 0) + 1
+
+
+# Apply the changes of one journal entry with the readers held off, so none of them sees the entry half-applied.
+# What they make stale (and the interests of the users they change) is read before the old values are
+# overwritten, and the recommendations are only updated after all of them are applied.
+def apply_changes(changes):
+    with data_lock.write_locked():
+        stale = [dependencies for dependencies in map(recommendation_dependencies, changes)
+                 if dependencies is not None]
+        users = sorted({user_id for dependencies in stale for user_id in dependencies[0]})
+        interests = user_interests(users)
+        for change in changes:
+            apply_change(change)
+        # Only user changes name users; the others change the catalogue the model was built from
+        if any(not dependencies[0] for dependencies in stale):
+            drop_recommendation_model()
+        elif users:
+            update_recommendation_model(users, interests)
+        for dependencies in stale:
+            invalidate_recommendations(*dependencies)
+
+
+class TransactionConflict(Exception):
+    pass
+
+
+# Append one journal entry for a mutation, fsync it, then apply it to the DataFrames.
+# The journal line is the unit of atomicity: a torn line is ignored on replay, a complete one is re-applied.
+# With expected version stamps (from version_stamps()) the commit is refused if those rows changed meanwhile.
+@instrumented
+def commit_changes(changes, expected=None):
+    global journal_entries, journal_offset, journal_seen
+
+    require_tables(*{change['table'] for change in changes})
+    entry = (json.dumps(changes, default=to_builtin) + '\n').encode('utf-8')
+    with storage_locked():
+        # Besides changed rows, a new row whose id another process has taken in the meantime is a conflict
+        if expected is not None and (expected != version_stamps(*expected[1]) or any(
+                change['op'] == 'insert' and change['row']['id'] in table_indexes[change['table']]['id']
+                for change in changes)):
+            raise TransactionConflict("The data changed since it was read.")
+
+        with open(JOURNAL_FILE, 'ab') as journal:
+            start = journal.tell()
+            journal.write(entry)
+            journal.flush()
+            os.fsync(journal.fileno())
+            journal_offset = journal.tell()
+        journal_seen = journal_stat()
+        count_metric('bytes_written', JOURNAL_FILE, len(entry))
+
+        try:
+            apply_changes(changes)
+        except Exception:
+            # An entry that cannot be applied would fail every replay as well: it is taken back out of the
+            # journal, and the tables it may have half-changed are loaded again
+            truncate_journal(start)
+            initialize_dataframes(sorted(loaded_tables))
+            raise
+
+        journal_entries += 1
+        if journal_entries >= JOURNAL_COMPACT_THRESHOLD:
+            compact_journal()
+
+
+def version_stamps(*rows):
+    return journal_generation, {row: row_versions.get(row, 0) for row in rows}
+
+
+# Run prepare() against the current data with the given (table, id) rows locked and commit the changes it
+# returns; prepare() returns (changes, result), with no changes when there is nothing to commit. prepare()
+# only reads, sharing data_lock with the other readers; the commit applies the changes with data_lock held
+# exclusively. When another process changed the rows in the meantime, its changes are applied and prepare()
+# runs again; after TRANSACTION_RETRIES such conflicts the last attempt holds the storage lock throughout.
+def run_transaction(rows, prepare):
+    rows = [(table, int(row_id)) for table, row_id in rows]
+    for attempt in range(TRANSACTION_RETRIES + 1):
+        with row_locked(*rows), (storage_locked() if attempt == TRANSACTION_RETRIES else nullcontext()):
+            expected = version_stamps(*rows)
+            with data_lock.read_locked():
+                changes, result = prepare()
+            if not changes:
+                return result
+            try:
+                commit_changes(changes, expected)
+                return result
+            except TransactionConflict:
+                continue
+
+
+# Hold the storage lock: commit_lock within this process and, in shared-storage mode, the advisory file lock
+# across processes. The outermost holder first catches up with the changes of other processes.
+@contextmanager
+def storage_locked(sync=True):
+    global file_lock_depth
+
+    with commit_lock:
+        if not SHARED_STORAGE or file_lock_depth:
+            file_lock_depth += 1
+            try:
+                yield
+            finally:
+                file_lock_depth -= 1
+            return
+
+        with open(LOCK_FILE, 'a+') as handle:
+            lock_file(handle)
+            file_lock_depth += 1
+            try:
+                if sync:
+                    sync_journal()
+                yield
+            finally:
+                file_lock_depth -= 1
+                unlock_file(handle)
+
+
+def lock_file(handle):
+    if fcntl is not None:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+    else:
+        handle.seek(0)
+        msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+
+
+def unlock_file(handle):
+    if fcntl is not None:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+    else:
+        handle.seek(0)
+        msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+# Hold the locks of the given (table, id) rows for a read-validate-commit transaction.
+# Stripes are always taken in ascending order, so two transactions can never deadlock.
+@contextmanager
+def row_locked(*rows):
+    stripes = sorted({hash((table, int(row_id))) % ROW_LOCK_STRIPES for table, row_id in rows})
+    for stripe in stripes:
+        row_lock_stripes[stripe].acquire()
+    try:
+        yield
+    finally:
+        for stripe in reversed(stripes):
+            row_lock_stripes[stripe].release()
+
+
+# Read the journal from a byte offset: returns its generation, the (start offset, changes) of the complete entries
+# after the offset and the offset just past the last complete entry. The first line of a compacted journal is
+# {"generation": n}.
+def read_journal(offset):
+    entries = []
+    with open(JOURNAL_FILE, 'rb') as journal:
+        header = journal.readline()
+        try:
+            generation = json.loads(header).get('generation', 0)
+        except (ValueError, AttributeError):
+            generation = 0
+        journal.seek(offset)
+
+        for line in journal:
+            try:
+                record = json.loads(line) if line.endswith(b'\n') else None
+            except ValueError:
+                record = None
+            if record is None:
+                # A torn last line means the process died mid-write; that mutation never completed
+                break
+            if isinstance(record, list):
+                entries.append((offset, record))
+            offset += len(line)
+    return generation, entries, offset
+
+
+# Re-apply the changes recorded since the last compaction on top of the snapshot files
+@instrumented
+def replay_journal(tables=TABLE_FRAMES, first=True):
+    global journal_entries, journal_generation, journal_offset, journal_seen
+
+    # Tables loaded after others only catch up with the entries the others have already seen
+    if first:
+        journal_entries = 0
+        journal_generation = 0
+        journal_offset = 0
+        journal_seen = journal_stat()
+    if not os.path.exists(JOURNAL_FILE):
+        return
+
+    generation, entries, offset = read_journal(0)
+    for start, changes in entries:
+        try:
+            apply_changes([change for change in changes if change['table'] in tables])
+        except Exception as error:
+            reject_journal_entries(start, error)
+            return
+        if first:
+            journal_entries += 1
+    if not first:
+        return
+    journal_generation = generation
+
+    # Cut off a torn last line so that new entries start on a line of their own
+    if os.path.getsize(JOURNAL_FILE) > offset:
+        truncate_journal(offset)
+    journal_offset = offset
+    journal_seen = journal_stat()
+
+
+# Cut the journal back to a byte offset; with rejected=True the entries cut off are kept in journal.log.rejected
+def truncate_journal(offset, rejected=False):
+    global journal_offset, journal_seen
+
+    with open(JOURNAL_FILE, 'r+b') as journal:
+        if rejected:
+            journal.seek(offset)
+            with open(JOURNAL_FILE + '.rejected', 'ab') as rejected_file:
+                rejected_file.write(journal.read())
+                rejected_file.flush()
+                os.fsync(rejected_file.fileno())
+        journal.truncate(offset)
+        journal.flush()
+        os.fsync(journal.fileno())
+    journal_offset = offset
+    journal_seen = journal_stat()
+
+
+# An entry that cannot be applied (e.g. damaged on disk) would make every start fail the same way. It is set
+# aside together with the entries after it, which may depend on it, and the loaded tables are loaded again from
+# the snapshot files and the rest of the journal.
+def reject_journal_entries(offset, error):
+    print(f"A journal entry could not be applied ({error!r}); it and the entries after it are moved to "
+          f"{JOURNAL_FILE}.rejected.")
+    truncate_journal(offset, rejected=True)
+    initialize_dataframes(sorted(loaded_tables))
+
+
+# Apply the journal entries other processes appended since this process last looked; after another process
+# compacted the journal the snapshot files are loaded again. Cheap when nothing changed.
+def sync_journal():
+    global journal_entries, journal_offset, journal_seen
+
+    if not loaded_tables or not os.path.exists(JOURNAL_FILE):
+        return False
+    generation, entries, offset = read_journal(journal_offset)
+    # A compacted journal, or one cut back after an entry was rejected, is read again from the snapshot files
+    if generation != journal_generation or os.path.getsize(JOURNAL_FILE) < journal_offset:
+        initialize_dataframes(sorted(loaded_tables))
+        return True
+
+    # Changes to tables that are not loaded yet are replayed when they are loaded
+    for start, changes in entries:
+        try:
+            apply_changes([change for change in changes if change['table'] in loaded_tables])
+        except Exception as error:
+            reject_journal_entries(start, error)
+            return True
+        journal_entries += 1
+    journal_offset = offset
+    journal_seen = journal_stat()
+    return bool(entries)
+
+
+def journal_stat():
+    try:
+        stat = os.stat(JOURNAL_FILE)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+# Pick up the changes of other processes in shared-storage mode, e.g. before showing a menu
+def refresh_shared_storage():
+    if SHARED_STORAGE:
+        with storage_locked():
+            pass
+
+
+# Fold the journal back into the snapshot files and start a new journal of the next generation
+@instrumented
+def compact_journal():
+    global journal_entries, journal_generation, journal_offset, journal_seen
+
+    with storage_locked():
+        if save_dataframes():
+            header = (json.dumps({'generation': journal_generation + 1}) + '\n').encode('utf-8')
+            with open(JOURNAL_FILE, 'wb') as journal:
+                journal.write(header)
+                journal.flush()
+                os.fsync(journal.fileno())
+            journal_generation += 1
+            journal_offset = len(header)
+            journal_entries = 0
+            journal_seen = journal_stat()
 
 
 # User validation
 def validate_username(username):
-    return username not in user_df['username'].values
+    return find_user_by_username(username) is None
 
 
 def validate_password(password):
@@ -55,6 +1797,7 @@ def validate_password(password):
 # User account creation
 def create_user_account():
     global user_df
+    require_tables('users')
     username = input("Enter a unique username: ")
     while not validate_username(username):
         print("Username already exists or is invalid.")
@@ -69,25 +1812,29 @@ def create_user_account():
     city = input("Enter your city: ")
     balance = float(input("Enter your starting balance: "))
 
-    new_user = {
-        'id': len(user_df) + 1,
-        'username': username,
-        'password': password,
-        'address': address,
-        'city': city,
-        'orders': [],
-        'favorites': [],
-        'balance': balance
-    }
-
-    user_df = user_df.append(new_user, ignore_index=True)
-    save_dataframes()
+    # The new id is taken under the storage lock so another process cannot hand out the same one
+    with storage_locked():
+        if not validate_username(username):
+            print("Username already exists or is invalid.")
+            return
+        new_user = {
+            'id': int(user_df['id'].max()) + 1 if not user_df.empty else 1,
+            'username': username,
+            'password': password,
+            'address': address,
+            'city': city,
+            'orders': [],
+            'favorites': [],
+            'balance': balance,
+            'order_stores': {}
+        }
+        commit_changes([insert_change('users', new_user)])
     print("User account created successfully!")
 
 
 # Admin validation
 def validate_admin_username(username):
-    return username not in admin_df['username'].values
+    return find_admin_by_username(username) is None
 
 
 def validate_admin_password(password):
@@ -103,7 +1850,9 @@ def admin_login():
     username = input("Enter your admin username: ")
     password = input("Enter your admin password: ")
 
-    if (admin_df['username'] == username).any() and (admin_df['password'] == password).any():
+    require_tables('admins')
+    admin_index = find_admin_by_username(username)
+    if admin_index is not None and admin_df.at[admin_index, 'password'] == password:
         print(f"Welcome, {username}! You are logged in as an admin.")
         admin_menu(username)
         failed_attempts = 0
@@ -121,12 +1870,13 @@ def user_login():
     username = input("Enter your username: ")
     password = input("Enter your password: ")
 
+    require_tables('users')
     try:
         # Try to find the user based on username
-        user_row = user_df[user_df['username'] == username]
-        if not user_row.empty:  # Check if any user was found
-            user_id = user_row['id'].values[0]
-            if user_row['password'].values[0] == password:
+        user_index = find_user_by_username(username)
+        if user_index is not None:  # Check if any user was found
+            user_id = int(user_df.at[user_index, 'id'])
+            if user_df.at[user_index, 'password'] == password:
                 print(f"Welcome, {username}! You are logged in as a user.")
                 print(user_id)
                 user_menu(user_id)
@@ -147,44 +1897,164 @@ def user_login():
 
 
 # View books
-def view_books():
-    global books_df, user_df
+# Catalogue browsing
+BROWSE_PAGE_SIZE = 20
+BROWSE_SORT_KEYS = ['id', 'title', 'author', 'publisher', 'cost', 'price', 'copies', 'rating']
+
+
+# One page of the catalogue: the books matching the filters, ordered by sort_by (ties by id). The cursor
+# from the previous page continues where it stopped, so pages stay consistent while books are added or
+# removed. Filters: title/author/publisher (text search), category, store, min_cost, max_cost, min_rating,
+# available. Returns {'books': frame of the page, 'next_cursor': None on the last page, 'total': matches}.
+@instrumented
+def browse_books(page_size=BROWSE_PAGE_SIZE, cursor=None, sort_by='id', descending=False, filters=None):
+    if sort_by not in BROWSE_SORT_KEYS:
+        raise ValueError(f"Cannot sort by '{sort_by}'.")
+    if isinstance(page_size, bool) or not isinstance(page_size, int) or page_size < 1:
+        raise ValueError(f"Invalid page size: {page_size!r}.")
+    if cursor is not None:
+        cursor = browse_cursor(cursor, sort_by)
+
+    # Only the sort key and the filtered columns are computed over the whole catalogue
+    ids = books_df['id']
+    mask = browse_filter_mask(filters or {})
+    keys = browse_sort_key(sort_by)
+    total = int(mask.sum())
+    count_metric('rows_scanned', 'browse_books', len(books_df))
+    if cursor is not None:
+        after_key = keys < cursor[0] if descending else keys > cursor[0]
+        mask &= after_key | ((keys == cursor[0]) & (ids > cursor[1]))
+
+    keys, ids = keys[mask], ids[mask]
+    codes = pd.factorize(keys, sort=True)[0]
+    order = np.lexsort((ids.to_numpy(), -codes if descending else codes))[:page_size]
+    page = books_df.loc[keys.index[order]]
+
+    next_cursor = None
+    if len(order) == page_size and len(keys) > page_size:
+        last = page.index[-1]
+        key = keys[last]
+        next_cursor = (key.item() if hasattr(key, 'item') else key, int(ids[last]))
+    return {'books': page, 'next_cursor': next_cursor, 'total': total}
+
+
+# A cursor is the [sort value, id] pair of the last book of a page, e.g. the next_cursor sent back by a client
+def browse_cursor(cursor, sort_by):
+    if not isinstance(cursor, (list, tuple)) or len(cursor) != 2:
+        raise ValueError(f"Invalid cursor: {cursor!r}.")
+    key, book_id = cursor
+    key_type = str if sort_by in ['title', 'author', 'publisher'] else (int, float)
+    if (isinstance(key, bool) or not isinstance(key, key_type)
+            or isinstance(book_id, bool) or not isinstance(book_id, int)):
+        raise ValueError(f"Invalid cursor for sorting by '{sort_by}': {cursor!r}.")
+    return key, book_id
+
+
+def browse_sort_key(sort_by):
+    if sort_by == 'price':
+        return books_df['cost'] + books_df['shipping_cost']
+    if sort_by == 'rating':
+        means = {book_id: total / count for book_id, (count, total) in rating_stats.items()}
+        return books_df['id'].map(means).fillna(0.0)
+    if sort_by in ['title', 'author', 'publisher']:
+        return books_df[sort_by].astype(object).fillna('').astype(str)
+    return books_df[sort_by]
+
+
+def browse_filter_mask(filters):
+    mask = pd.Series(True, index=books_df.index)
+    for field in TEXT_COLUMNS:
+        if filters.get(field):
+            mask &= books_df['id'].isin(search_books(filters[field], field))
+    if filters.get('category'):
+        mask &= books_df['id'].isin(category_index.get(filters['category'], set()))
+    if filters.get('store'):
+        stock = store_stock_counts(filters['store'])
+        mask &= books_df['id'].isin(stock.index[stock > 0])
+    if filters.get('min_cost') is not None:
+        mask &= books_df['cost'] >= filters['min_cost']
+    if filters.get('max_cost') is not None:
+        mask &= books_df['cost'] <= filters['max_cost']
+    if filters.get('min_rating') is not None:
+        rated = [book_id for book_id, (count, total) in rating_stats.items() if total / count >= filters['min_rating']]
+        mask &= books_df['id'].isin(rated)
+    if filters.get('available'):
+        mask &= books_df['availability'].astype(bool) & (books_df['copies'] > 0)
+    return mask
+
+
+# One line per book of a page, formatted column-wise
+def format_books(books):
+    if books.empty:
+        return []
+    ratings = books['id'].map(lambda book_id: book_rating(book_id)['mean'])
+    price = books['cost'] + books['shipping_cost']
+    lines = (books['id'].astype(str).str.rjust(6) + '  '
+             + books['title'].astype(str).str.slice(0, 38).str.ljust(38) + '  '
+             + books['author'].astype(str).str.slice(0, 24).str.ljust(24) + '  $'
+             + price.map('{:.2f}'.format).str.rjust(7) + '  '
+             + books['copies'].astype(str).str.rjust(4) + ' copies  '
+             + ratings.map(lambda rating: f"rating {rating:.1f}" if pd.notna(rating) else 'no reviews'))
+    return lines.tolist()
+
+
+def print_book_details(book_id):
+    book_index = find_book(book_id)
+    if book_index is None:
+        print("Book ID not found.")
+        return
+    row = books_df.loc[book_index]
+    print(f"Book ID: {row['id']}")
+    print(f"Title: {row['title']}")
+    print(f"Author: {row['author']}")
+    print(f"Publisher: {row['publisher']}")
+    print(f"Categories: {as_python_value(row['categories'], [])}")
+    print(f"Cost: ${row['cost']}")
+    print(f"Shipping Cost: ${row['shipping_cost']}")
+    print(f"Availability: {row['availability']}")
+    print(f"Copies: {row['copies']}")
+    print("Reviews:")
+
+    rating = book_rating(book_id)
+    if rating['count']:
+        print(f"Average rating: {rating['mean']:.1f} ({rating['count']} reviews)")
+        for review in book_reviews(book_id).itertuples():
+            print(f"User ID: {review.user_id}, Rating: {review.rating}, Comment: {review.comment}")
+    else:
+        print("No reviews yet.")
+    print("-" * 30)
+
 
+# Browse the catalogue page by page
+def view_books():
     print("\nAvailable Books:")
     if books_df.empty:
         print("No books available.")
-    else:
-        for index, row in books_df.iterrows():
-            print(f"Book ID: {row['id']}")
-            print(f"Title: {row['title']}")
-            print(f"Author: {row['author']}")
-            print(f"Publisher: {row['publisher']}")
-            categories = row['categories']
-            if isinstance(categories, str):
-                categories = ast.literal_eval(categories)  # Convert categories string to list
-            print(f"Categories: {categories}")
-            print(f"Cost: ${row['cost']}")
-            print(f"Shipping Cost: ${row['shipping_cost']}")
-            print(f"Availability: {row['availability']}")
-            print(f"Copies: {row['copies']}")
-            print("Reviews:")
-
-            if pd.notna(row['reviews']):
-                try:
-                    reviews = ast.literal_eval(row['reviews'])
-                    if isinstance(reviews, list):
-                        for review in reviews:
-                            print(
-                                f"User ID: {review['user_id']}, Rating: {review['rating']}, Comment: {review['comment']}")
-                    else:
-                        print("Error: Reviews should be stored as a list of dictionaries.")
-                except ValueError:
-                    print("Error: Reviews format is invalid.")
-            else:
-                print("No reviews yet.")
+        return
 
-            print("-" * 30)
+    sort_by = input(f"Sort by ({'/'.join(BROWSE_SORT_KEYS)}) [id]: ").strip().lower() or 'id'
+    if sort_by not in BROWSE_SORT_KEYS:
+        print("Unknown sort key, sorting by id.")
+        sort_by = 'id'
+    category = input("Only books of category (leave empty for all): ").strip()
+    filters = {'category': category} if category else {}
 
+    cursor = None
+    while True:
+        page = browse_books(cursor=cursor, sort_by=sort_by, descending=sort_by == 'rating', filters=filters)
+        if cursor is None:
+            print(f"{page['total']} books found.")
+        for line in format_books(page['books']):
+            print(line)
+        cursor = page['next_cursor']
+
+        prompt = "Enter a book ID for details, " + ("Enter for the next page, " if cursor else "") + "q to go back: "
+        choice = input(prompt).strip()
+        while choice.isdigit():
+            print_book_details(int(choice))
+            choice = input(prompt).strip()
+        if choice.lower() == 'q' or cursor is None:
+            break
 
 
 # Add book
@@ -193,23 +2063,24 @@ def add_book(admin_username):
     title = input("Enter book title: ")
     author = input("Enter book author: ")
     publisher = input("Enter book publisher: ")
-    categories = input("Enter book categories (comma separated): ").split(',')
+    categories = [category.strip() for category in input("Enter book categories (comma separated): ").split(',')]
     cost = float(input("Enter book cost: "))
     shipping_cost = float(input("Enter shipping cost: "))
     availability = input("Enter book availability (True/False): ").lower() == 'true'
-    copies = int(input("Enter number of copies: "))
 
-    admin_row = admin_df[admin_df['username'] == admin_username]
-    admin_bookstores = admin_row['bookstores'].values[0]
+    admin_bookstores = admin_df.at[find_admin_by_username(admin_username), 'bookstores']
 
     bookstores = {}
     for store in admin_bookstores:
-        store_copies = int(input(f"Enter number of copies at {store}: "))
-        bookstores[store] = store_copies
+        store_copies = int(input(f"Enter number of copies at Store {store}: "))
+        bookstores[f"Store {store}"] = store_copies
 
-    if books_df[books_df['title'] == title].empty:
+    with storage_locked():
+        if not books_df[books_df['title'] == title].empty:
+            print("Book already exists. Use the update functionality.")
+            return
         new_book = {
-            'id': len(books_df) + 1,
+            'id': int(books_df['id'].max()) + 1 if not books_df.empty else 1,
             'title': title,
             'author': author,
             'publisher': publisher,
@@ -217,14 +2088,11 @@ def add_book(admin_username):
             'cost': cost,
             'shipping_cost': shipping_cost,
             'availability': availability,
-            'copies': copies,
+            'copies': sum(bookstores.values()),
             'bookstores': bookstores,
         }
-        books_df = books_df.append(new_book, ignore_index=True)
-        save_dataframes()
-        print("Book added successfully!")
-    else:
-        print("Book already exists. Use the update functionality.")
+        commit_changes([insert_change('books', new_book)])
+    print("Book added successfully!")
 
 
 def delete_book_entry(admin_username):
@@ -235,35 +2103,35 @@ def delete_book_entry(admin_username):
         book_id = int(input("Enter the Book ID to delete: "))
 
         # Check if the book ID exists in the library
-        if book_id not in books_df['id'].values:
+        book_index = find_book(book_id)
+        if book_index is None:
             print(f"Book ID {book_id} does not exist in the library.")
             return
 
         # Get the admin's bookstores
-        admin_row = admin_df[admin_df['username'] == admin_username]
-        admin_bookstores = admin_row['bookstores'].values[0]
+        admin_bookstores = admin_df.at[find_admin_by_username(admin_username), 'bookstores']
 
         # Convert admin_bookstores from list of IDs to list of store names
         admin_store_names = [f"Store {store_id}" for store_id in admin_bookstores]
 
         # Get the bookstores where the book is listed
-        book_row = books_df[books_df['id'] == book_id]
-        book_bookstores = eval(book_row.iloc[0]['bookstores']) if isinstance(book_row.iloc[0]['bookstores'], str) else \
-            book_row.iloc[0]['bookstores']
-        # ================================================== Mporoume na to kanoume kai etsi gia pio apla
-        # book_bookstores = book_row.iloc[0]['bookstores']
-        # if isinstance(book_bookstores, str):
-        #     book_bookstores = eval(book_bookstores)
+        listed_stores = book_bookstores(book_id)
 
         # Check if the admin has access to any of the bookstores where the book is listed
-        if not any(store in admin_store_names for store in book_bookstores):
+        if not any(store in admin_store_names for store in listed_stores):
             print("You do not own any of the bookstores where this book is listed. Deletion not allowed.")
             return
 
         # If access is granted, delete the book entry
-        books_df = books_df[books_df['id'] != book_id]
-        print(f"Book ID {book_id} has been successfully deleted.")
-        save_dataframes()
+        def prepare():
+            if find_book(book_id) is None:
+                return None, f"Book ID {book_id} does not exist in the library."
+            # The reviews of the book go with it
+            return [delete_change('books', book_id)] + [
+                delete_change('reviews', review_id) for review_id in reviews_by_book.get(book_id, {})
+            ], f"Book ID {book_id} has been successfully deleted."
+
+        print(run_transaction([('books', book_id)], prepare))
 
     except Exception as e:
         print(f"Error: {e}")
@@ -273,23 +2141,22 @@ def delete_book_entry(admin_username):
 def update_book(admin_username):
     global books_df
     book_id = int(input("Enter the book ID to update: "))
-    book_row = books_df[books_df['id'] == book_id]
+    book_index = find_book(book_id)
 
-    if book_row.empty:
+    if book_index is None:
         print("Book ID not found.")
         return
 
     # Get the admin's bookstores
-    admin_row = admin_df[admin_df['username'] == admin_username]
-    admin_bookstores = admin_row['bookstores'].values[0]
+    admin_bookstores = admin_df.at[find_admin_by_username(admin_username), 'bookstores']
 
     # Convert admin_bookstores from list of IDs to list of store names
     admin_store_names = [f"Store {store_id}" for store_id in admin_bookstores]
 
     # Check if the admin owns any of the bookstores where the book is listed
-    book_bookstores = book_row.iloc[0]['bookstores']
-    print(book_bookstores)
-    if not any(store in admin_store_names for store in book_bookstores):
+    listed_stores = book_bookstores(book_id)
+    print(listed_stores)
+    if not any(store in admin_store_names for store in listed_stores):
         print("You do not own any of the bookstores where this book is listed. Update not allowed.")
         return
 
@@ -298,23 +2165,32 @@ def update_book(admin_username):
     title = input("Enter new book title: ")
     author = input("Enter new book author: ")
     publisher = input("Enter new book publisher: ")
-    categories = input("Enter new book categories (comma separated): ").split(',')
+    categories = [category.strip() for category in input("Enter new book categories (comma separated): ").split(',')]
     cost = float(input("Enter new book cost: "))
     shipping_cost = float(input("Enter new shipping cost: "))
     availability = input("Enter new book availability (True/False): ").lower() == 'true'
-    copies = int(input("Enter new number of copies: "))
+    # The copies of the book are the sum of its stock in all stores; the admin sets the stock of their own
+    store_copies = {f"Store {store}": int(input(f"Enter new number of copies at Store {store}: "))
+                    for store in admin_bookstores}
 
     # Update the book details in the dataframe
-    books_df.loc[books_df['id'] == book_id, 'title'] = title
-    books_df.loc[books_df['id'] == book_id, 'author'] = author
-    books_df.loc[books_df['id'] == book_id, 'publisher'] = publisher
-    books_df.loc[books_df['id'] == book_id, 'categories'] = categories
-    books_df.loc[books_df['id'] == book_id, 'cost'] = cost
-    books_df.loc[books_df['id'] == book_id, 'shipping_cost'] = shipping_cost
-    books_df.loc[books_df['id'] == book_id, 'availability'] = availability
-    books_df.loc[books_df['id'] == book_id, 'copies'] = copies
-    save_dataframes()
-    print("Book updated successfully!")
+    def prepare():
+        if find_book(book_id) is None:
+            return None, "Book ID not found."
+        bookstores = dict(book_bookstores(book_id), **store_copies)
+        return [update_change('books', book_id, {
+            'title': title,
+            'author': author,
+            'publisher': publisher,
+            'categories': categories,
+            'cost': cost,
+            'shipping_cost': shipping_cost,
+            'availability': availability,
+            'copies': sum(bookstores.values()),
+            'bookstores': bookstores,
+        })], "Book updated successfully!"
+
+    print(run_transaction([('books', book_id)], prepare))
 
 
 # Add review
@@ -329,39 +2205,42 @@ def add_review(user_id):
 
     comment = input("Enter your review comment: ")
 
-    # Check if book_id is in user's orders
-    user_orders = user_df.at[user_id - 1, 'orders']  # Assuming user_id is 1-based index
-    if book_id not in user_orders:
-        print("You can only review books that you have ordered.")
-        return
-
-    # Construct review entry
-    review_entry = {
-        'user_id': user_id,
-        'rating': rating,
-        'comment': comment
-    }
-
-    # Append review to books_df
-    if 'reviews' not in books_df.columns:
-        books_df['reviews'] = [[] for _ in range(len(books_df))]
+    ok, message = submit_review(user_id, book_id, rating, comment)
+    print(message)
 
-    books_index = books_df.index[books_df['id'] == book_id].tolist()[0]
-    books_reviews = books_df.at[books_index, 'reviews']
 
-    if not isinstance(books_reviews, list):
-        books_reviews = ast.literal_eval(books_reviews) if pd.notna(books_reviews) else []
+# Add a review without prompting; returns (success, message)
+@instrumented
+def submit_review(user_id, book_id, rating, comment):
+    global books_df
 
-    books_reviews.append(review_entry)
-    books_df.at[books_index, 'reviews'] = books_reviews
+    if not 1 <= rating <= 5:
+        return False, "Rating must be between 1 and 5."
+
+    def prepare():
+        # Check if book_id is in user's orders
+        user_index = find_user(user_id)
+        if user_index is None or book_id not in user_df.at[user_index, 'orders']:
+            return None, (False, "You can only review books that you have ordered.")
+        if find_book(book_id) is None:
+            return None, (False, "Book ID does not exist.")
+
+        # Construct review entry; it is appended to the reviews table
+        review_entry = {
+            'id': next_review_id(),
+            'book_id': book_id,
+            'user_id': user_id,
+            'rating': rating,
+            'comment': comment
+        }
+        return [insert_change('reviews', review_entry)], (True, "Review and comment added successfully!")
 
-    # Save DataFrame to CSV
-    books_df.to_csv('books.csv', index=False)  # Ensure index=False to avoid extra commas
+    return run_transaction([('users', user_id), ('books', book_id)], prepare)
 
-    print("Review and comment added successfully!")
 
 # Admin functions
 def admin_menu(username):
+    require_tables(*TABLE_FRAMES)
     while True:
         print("\nAdmin Menu")
         print("1. View Books")
@@ -379,6 +2258,7 @@ def admin_menu(username):
         print("13. Remove Review")
         print("14. Logout")
         choice = input("Enter your choice: ")
+        refresh_shared_storage()
 
         if choice == '1':
             view_books()
@@ -414,29 +2294,163 @@ def admin_menu(username):
             print("Invalid choice. Please try again.")
 
 
-def upload_books_from_csv(file_path):
-    global books_df
+# Print how far a streamed CSV file has been read
+def print_progress(rows, fraction):
+    print(f"Read {rows} rows ({fraction:.0%})")
 
-    # Read the CSV file into a DataFrame
-    new_books_df = pd.read_csv(file_path)
 
-    # Iterate through each row in the new books DataFrame
-    for index, new_book in new_books_df.iterrows():
-        # Check if the book ID already exists in books_df
-        if new_book['title'] in books_df['title'].values:
-            # If the book exists, print a message and do not update
-            print(f"Book ID {new_book['id']} ({new_book['title']}) already exists. Skipping update.")
-        else:
-            # If the book does not exist, append it to books_df
-            books_df = pd.concat([books_df, pd.DataFrame([new_book])], ignore_index=True)
-            print(f"Added new book ID {new_book['id']}: {new_book['title']}")
+# Stream a CSV file as DataFrames of at most chunksize rows; progress(rows, fraction) is called after each chunk
+def read_csv_chunks(file_path, chunksize=None, usecols=None, progress=print_progress):
+    total_bytes = os.path.getsize(file_path) or 1
+    rows = 0
+    with open(file_path, 'rb') as handle:
+        for chunk in pd.read_csv(handle, chunksize=chunksize or IMPORT_CHUNK_SIZE, usecols=usecols):
+            rows += len(chunk)
+            if progress:
+                progress(rows, min(handle.tell() / total_bytes, 1.0))
+            yield chunk
+
 
+# Upload books from a CSV file, streamed and imported in chunks of chunksize rows.
+# Returns a report with the status ('skipped' or 'error') and reason for every row that was not added.
+@instrumented
+def upload_books_from_csv(file_path, chunksize=None, progress=print_progress):
+    known_titles = set(books_df['title'].tolist())
+    added = 0
+    reports = []
+    try:
+        for chunk in read_csv_chunks(file_path, chunksize, progress=progress):
+            # Each chunk is validated and committed under the storage lock, against the latest catalogue
+            with storage_locked():
+                if SHARED_STORAGE:
+                    known_titles.update(books_df['title'])
+                report = import_books(chunk, known_titles)
+            added += (report['status'] == 'added').sum()
+            # Only the rejected rows are kept, so the report does not grow with the size of the file
+            report = report[report['status'] != 'added']
+            for row in report.itertuples():
+                print(f"Row {row.row}: Book ID {row.id} ({row.title}) {row.status}: {row.reason}.")
+            reports.append(report)
+    except FileNotFoundError:
+        print(f"File '{file_path}' not found.")
+        return None
+    except ValueError as e:
+        print(f"Error: {e}")
+        return None
+
+    report = pd.concat(reports) if reports else pd.DataFrame(columns=['row', 'id', 'title', 'status', 'reason'])
+    print(f"Added {added} new books, skipped {(report['status'] == 'skipped').sum()}, "
+          f"{(report['status'] == 'error').sum()} rows with errors.")
     print("Book information has been successfully uploaded.")
-    save_dataframes()
+    return report
+
+
+# Parse list/dict cells given as text; every distinct text is parsed only once and invalid cells become None
+@instrumented
+def parse_literal_column(column, expected_type, default):
+    parsed = {}
+
+    def parse(value):
+        if isinstance(value, expected_type):
+            return value
+        if not isinstance(value, str):
+            return default if pd.isna(value) else None
+        if value not in parsed:
+            try:
+                result = ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                result = None
+            parsed[value] = result if isinstance(result, expected_type) else None
+        return parsed[value]
+
+    column = column.map(parse)
+    count_metric('rows_scanned', 'parse_literal_column', len(column))
+    count_metric('literals_parsed', 'parse_literal_column', len(parsed))
+    return column
+
+
+# Validate and dedupe a frame of new books in one pass, then append the accepted rows as a single change
+@instrumented
+def import_books(new_books_df, known_titles):
+    if 'id' not in new_books_df.columns or 'title' not in new_books_df.columns:
+        raise ValueError("The CSV file must have 'id' and 'title' columns.")
+    count_metric('rows_scanned', 'import_books', len(new_books_df))
+
+    df = new_books_df
+    reasons = pd.Series('', index=df.index, dtype=object)
+    skipped = pd.Series(False, index=df.index)
+
+    def reject(mask, reason, skip=False):
+        mask = mask & (reasons == '')
+        reasons[mask] = reason
+        skipped[mask] = skip
+
+    def column_or(column, default):
+        return df[column] if column in df.columns else pd.Series([default] * len(df), index=df.index, dtype=object)
+
+    ids = pd.to_numeric(df['id'], errors='coerce')
+    reject(ids.isna() | (ids % 1 != 0), 'invalid id')
+    reject(df['title'].isna(), 'missing title')
+
+    costs = pd.to_numeric(column_or('cost', None), errors='coerce')
+    reject(costs.isna() | (costs < 0), 'invalid cost')
+    shipping_costs = pd.to_numeric(column_or('shipping_cost', 0.0), errors='coerce')
+    reject(shipping_costs.isna() | (shipping_costs < 0), 'invalid shipping cost')
+    copies = pd.to_numeric(column_or('copies', 0), errors='coerce')
+    reject(copies.isna() | (copies < 0) | (copies % 1 != 0), 'invalid copies')
+
+    availability = column_or('availability', True).map(
+        lambda value: value if isinstance(value, bool) else {'true': True, 'false': False}.get(str(value).lower()))
+    reject(availability.isna(), 'invalid availability')
+    categories = parse_literal_column(column_or('categories', []), list, [])
+    reject(categories.isna(), 'invalid categories')
+    bookstores = parse_literal_column(column_or('bookstores', {}), dict, {})
+    reject(bookstores.isna(), 'invalid bookstores')
+    # The copies of a book are the sum of its stock in the stores
+    store_totals = bookstores.map(lambda stores: sum(stores.values()) if isinstance(stores, dict) and all(
+        isinstance(count, int) and count >= 0 for count in stores.values()) else None)
+    reject(store_totals.isna(), 'invalid bookstores')
+    if 'copies' in df.columns:
+        reject(copies != store_totals, 'copies do not match bookstores')
+
+    # Dedupe against the catalogue and within the file itself
+    reject(df['title'].isin(known_titles), 'title already exists', skip=True)
+    reject(ids.map(lambda book_id: find_book(book_id) is not None), 'id already exists', skip=True)
+    valid = reasons == ''
+    reject(df['title'].where(valid).duplicated() & valid, 'duplicate title in file', skip=True)
+    valid = reasons == ''
+    reject(ids.where(valid).duplicated() & valid, 'duplicate id in file', skip=True)
+
+    accepted = reasons == ''
+    if accepted.any():
+        new_books = pd.DataFrame({
+            'id': ids[accepted].astype(int),
+            'title': df.loc[accepted, 'title'],
+            'author': column_or('author', '')[accepted],
+            'publisher': column_or('publisher', '')[accepted],
+            'categories': categories[accepted],
+            'cost': costs[accepted].astype(float),
+            'shipping_cost': shipping_costs[accepted].astype(float),
+            'availability': availability[accepted].astype(bool),
+            'copies': store_totals[accepted].astype(int),
+            'bookstores': bookstores[accepted],
+        })
+        # The whole batch is journaled and appended as a single change
+        commit_changes([insert_rows_change('books', new_books.to_dict('records'))])
+        known_titles.update(new_books['title'])
+
+    return pd.DataFrame({
+        'row': df.index,
+        'id': df['id'],
+        'title': df['title'],
+        'status': ['added' if accepted[index] else 'skipped' if skipped[index] else 'error' for index in df.index],
+        'reason': reasons,
+    })
 
 
 # User functions
 def user_menu(user_id):
+    require_tables(*TABLE_FRAMES)
     while True:
         print("\nUser Menu")
         print("1. View Books")
@@ -451,6 +2465,7 @@ def user_menu(user_id):
         print("10. Get Book Recommendation")
         print("11. Logout")
         choice = input("Enter your choice: ")
+        refresh_shared_storage()
 
         if choice == '1':
             view_books()
@@ -485,7 +2500,7 @@ def check_account_balance(user_id):
     global user_df
 
     try:
-        balance = user_df.at[user_id - 1, 'balance']
+        balance = user_df.at[find_user(user_id), 'balance']
         print(f"\nYour account balance is: ${balance:.2f}")
 
     except Exception as e:
@@ -500,12 +2515,15 @@ def remove_from_favorites(user_id):
         print("\nRemove Book from Favorites")
         book_id = int(input("Enter the book ID to remove from favorites: "))
 
-        if book_id in user_df.at[user_id - 1, 'favorites']:
-            user_df.at[user_id - 1, 'favorites'].remove(book_id)
-            save_dataframes()
-            print(f"Book ID {book_id} removed from favorites successfully.")
-        else:
-            print(f"Book ID {book_id} is not in your favorites list.")
+        def prepare():
+            favorites = user_df.at[find_user(user_id), 'favorites']
+            if book_id not in favorites:
+                return None, f"Book ID {book_id} is not in your favorites list."
+            favorites = [favorite for favorite in favorites if favorite != book_id]
+            return [update_change('users', user_id, {'favorites': favorites})], \
+                f"Book ID {book_id} removed from favorites successfully."
+
+        print(run_transaction([('users', user_id)], prepare))
 
     except ValueError:
         print("Invalid input. Please enter a valid book ID.")
@@ -517,7 +2535,7 @@ def check_favorites_availability(user_id):
     global user_df, books_df
 
     try:
-        favorites = user_df.loc[user_df['id'] == user_id, 'favorites'].values[0]
+        favorites = user_df.at[find_user(user_id), 'favorites']
 
         if not favorites:
             print("No favorite books found.")
@@ -525,13 +2543,13 @@ def check_favorites_availability(user_id):
 
         print("\nFavorites Availability and Price Check")
         for book_id in favorites:
-            book = books_df.loc[books_df['id'] == book_id]
+            book_index = find_book(book_id)
 
-            if not book.empty:
-                book_title = book.iloc[0]['title']
-                book_price = book.iloc[0]['cost']
-                book_price += book.iloc[0]['shipping_cost']
-                book_availability = book.iloc[0]['availability']
+            if book_index is not None:
+                book_title = books_df.at[book_index, 'title']
+                book_price = books_df.at[book_index, 'cost']
+                book_price += books_df.at[book_index, 'shipping_cost']
+                book_availability = books_df.at[book_index, 'availability']
                 availability_text = "Available" if book_availability else "Not Available"
                 print(
                     f"Book ID: {book_id}, Title: {book_title}, Price+Shipping: ${book_price:.2f}, Availability: {availability_text}")
@@ -544,7 +2562,7 @@ def view_orders(user_id):
     global user_df, books_df
 
     try:
-        orders = user_df.loc[user_df['id'] == user_id, 'orders'].values[0]
+        orders = user_df.at[find_user(user_id), 'orders']
 
         if not orders:
             print("No orders found.")
@@ -559,12 +2577,12 @@ def view_orders(user_id):
 
         print("\nYour Orders")
         for book_id in orders:
-            book = books_df.loc[books_df['id'] == book_id]
+            book_index = find_book(book_id)
 
-            if not book.empty:
-                book_title = book.iloc[0]['title']
-                book_price = book.iloc[0]['cost']
-                book_price += book.iloc[0]['shipping_cost']
+            if book_index is not None:
+                book_title = books_df.at[book_index, 'title']
+                book_price = books_df.at[book_index, 'cost']
+                book_price += books_df.at[book_index, 'shipping_cost']
                 print(f"Book ID: {book_id}, Title: {book_title}, Price+Shipping: ${book_price:.2f}")
 
         ask = input(
@@ -585,66 +2603,80 @@ def view_orders(user_id):
 
 
 def remove_review():
-    global books_df
-
     book_id = int(input("Enter the Book ID to remove a review: "))
-    books_index = books_df.index[books_df['id'] == book_id].tolist()[0]
+    if find_book(book_id) is None:
+        print("Book ID not found.")
+        return
 
-    if pd.notna(books_df.at[books_index, 'reviews']):
-        reviews = ast.literal_eval(books_df.at[books_index, 'reviews'])
+    reviews = book_reviews(book_id)
+    if reviews.empty:
+        print("No reviews found for this book.")
+        return
 
-        if reviews:
-            print("Current Reviews:")
-            for i in range(len(reviews)):
-                review = reviews[i]
-                print(
-                    f"{i + 1}. User ID: {review['user_id']}, Rating: {review['rating']}, Comment: {review['comment']}")
+    print("Current Reviews:")
+    for i, review in enumerate(reviews.itertuples()):
+        print(f"{i + 1}. User ID: {review.user_id}, Rating: {review.rating}, Comment: {review.comment}")
 
-            review_index = int(input("Enter the index of the review to remove(Not the UserID): ")) - 1
+    review_index = int(input("Enter the index of the review to remove(Not the UserID): ")) - 1
+    if not 0 <= review_index < len(reviews):
+        print("Invalid review index.")
+        return
+    review_id = int(reviews['id'].iloc[review_index])
 
-            if 0 <= review_index < len(reviews):
-                reviews.pop(review_index)
-                books_df.at[books_index, 'reviews'] = str(reviews)
-                print("Review removed successfully.")
-                save_dataframes()
-            else:
-                print("Invalid review index.")
-        else:
-            print("No reviews found for this book.")
-    else:
-        print("No reviews found for this book.")
+    def prepare():
+        # Another process may have removed the review while the index was entered
+        if find_row('reviews', 'id', review_id) is None:
+            return None, "The review no longer exists."
+        return [delete_change('reviews', review_id)], "Review removed successfully."
+
+    print(run_transaction([('reviews', review_id)], prepare))
 
 
 def delete_order(user_id, book_id):
     try:
-        orders = user_df.loc[user_df['id'] == user_id, 'orders'].values[0]
-        if book_id in orders:
-            orders.remove(book_id)
-            user_df.at[user_df[user_df['id'] == user_id].index[0], 'orders'] = orders
-
-            book_price = books_df.loc[books_df['id'] == book_id, 'cost'].values[0]
-            book_price += books_df.loc[books_df['id'] == book_id, 'shipping_cost'].values[0]
-            user_df.loc[user_df['id'] == user_id, 'balance'] += book_price
-
-            # Increment the general copies column
-            books_df.loc[books_df['id'] == book_id, 'copies'] += 1
-
-            # Increment the count in the bookstores dictionary
-            bookstores = books_df.loc[books_df['id'] == book_id, 'bookstores'].values[0]
-            for store, count in bookstores.items():
-                bookstores[store] += 1
-                break
-
-            save_dataframes()
-            print(
-                f"Book ID {book_id} has been removed from your orders. ${book_price:.2f} has been refunded to your "f"balance.")
-        else:
-            print(f"Book ID {book_id} is not in your orders.")
-
+        ok, message = process_order_cancellation(user_id, book_id)
+        print(message)
     except Exception as e:
         print(f"Error: {e}")
 
 
+# Cancel an order as one transaction: refund, orders list and stock change together or not at all
+@instrumented
+def process_order_cancellation(user_id, book_id):
+    return run_transaction([('users', user_id), ('books', book_id)],
+                           lambda: prepare_order_cancellation(user_id, book_id))
+
+
+# Check a cancellation against the current data; returns (changes, (success, message))
+def prepare_order_cancellation(user_id, book_id):
+    user_index = find_user(user_id)
+    if user_index is None:
+        return None, (False, f"User with ID {user_id} not found.")
+    orders = user_df.at[user_index, 'orders']
+    if book_id not in orders:
+        return None, (False, f"Book ID {book_id} is not in your orders.")
+    orders = [order for order in orders if order != book_id]
+    order_stores = dict(as_python_value(user_df.at[user_index, 'order_stores'], {}))
+
+    changes = []
+    book_index = find_book(book_id)
+    book_price = 0.0
+    if book_index is not None:
+        book_price = books_df.at[book_index, 'cost']
+        book_price += books_df.at[book_index, 'shipping_cost']
+
+        # Put the copy back into the store it was taken from; the copies column follows the stores
+        bookstores, store = return_copies(book_id, order_stores.get(str(book_id)))
+        changes.append(update_change('books', book_id, {'bookstores': bookstores}))
+    order_stores.pop(str(book_id), None)
+    balance = user_df.at[user_index, 'balance'] + book_price
+
+    return [update_change('users', user_id, {'orders': orders, 'balance': balance,
+                                             'order_stores': order_stores})] + changes, \
+        (True, f"Book ID {book_id} has been removed from your orders. ${book_price:.2f} has been refunded to your "
+               f"balance.")
+
+
 def add_individual_entries(user_id):
     while True:
         print("\nAdd individual Entries:")
@@ -653,13 +2685,18 @@ def add_individual_entries(user_id):
         print("3. Adjust Balance")
         print("4. Back to User Menu")
         choice = input("Enter your choice: ")
+        refresh_shared_storage()
 
         if choice == '1':
             book_id = input("Enter the ID of the book to add to favorites: ")
             add_to_favorites(user_id, int(book_id))
         elif choice == '2':
-            book_id = input("Enter the ID of the book to order: ")
-            place_order(user_id, int(book_id))
+            book_ids = input("Enter the ID of the book to order (or several IDs separated by commas): ").split(',')
+            if len(book_ids) == 1:
+                place_order(user_id, int(book_ids[0]))
+            else:
+                for book_id, ok, message in place_orders(user_id, [int(book_id) for book_id in book_ids]):
+                    print(f"Book ID {book_id}: {message}")
         elif choice == '3':
             amount = float(input("Enter the amount to adjust balance (positive for increase, negative for decrease): "))
             adjust_balance(user_id, amount)
@@ -671,130 +2708,475 @@ def add_individual_entries(user_id):
 
 
 def add_to_favorites(user_id, book_id):
-    global user_df
-    if book_id not in user_df.at[user_id - 1, 'favorites']:
-        user_df.at[user_id - 1, 'favorites'].append(book_id)
-        save_dataframes()
-        print("Book added to favorites successfully!")
-    else:
-        print("Book is already in favorites.")
+    def prepare():
+        favorites = user_df.at[find_user(user_id), 'favorites']
+        if book_id in favorites:
+            return None, "Book is already in favorites."
+        return [update_change('users', user_id, {'favorites': favorites + [book_id]})], \
+            "Book added to favorites successfully!"
+
+    print(run_transaction([('users', user_id)], prepare))
 
 
 def place_order(user_id, book_id):
-    global user_df, books_df
-    if book_id in books_df['id'].values:
-        if book_id not in user_df.at[user_id - 1, 'orders']:
-            user_df.at[user_id - 1, 'orders'].append(book_id)
-            book_price = books_df.loc[books_df['id'] == book_id, 'cost'].values[0]
-            book_price += books_df.loc[books_df['id'] == book_id, 'shipping_cost'].values[0]
-            user_df.at[user_id - 1, 'balance'] -= book_price
-            # Remove one copy from the store
-            bookstores = books_df.loc[books_df['id'] == book_id, 'bookstores'].values[0]
-            for store, count in bookstores.items():
-                if count > 0:
-                    bookstores[store] -= 1
-                    break
-            # Decrement the general copies column
-            books_df.loc[books_df['id'] == book_id, 'copies'] -= 1
-            save_dataframes()
-            print("Order placed successfully!")
-        else:
-            print("You have already ordered this book.")
+    ok, message = process_order(user_id, book_id)
+    print(message)
+    return ok
+
+
+# Place an order without printing; returns (success, message)
+# The user's and the book's rows stay locked from the stock and balance checks until the commit, so
+# concurrent buyers cannot oversell, and balance, orders, copies and bookstores change in one journal entry
+@instrumented
+def process_order(user_id, book_id, policy=None):
+    return run_transaction([('users', user_id), ('books', book_id)],
+                           lambda: prepare_order(user_id, book_id, policy))
+
+
+# Check an order against the current data; returns (changes, (success, message))
+def prepare_order(user_id, book_id, policy=None):
+    book_index = find_book(book_id)
+    if book_index is None:
+        return None, (False, "Book ID does not exist.")
+    user_index = find_user(user_id)
+    if user_index is None:
+        return None, (False, f"User with ID {user_id} not found.")
+    orders = user_df.at[user_index, 'orders']
+    if book_id in orders:
+        return None, (False, "You have already ordered this book.")
+
+    copies = books_df.at[book_index, 'copies']
+    if copies <= 0:
+        return None, (False, "No copies of this book are left.")
+    book_price = books_df.at[book_index, 'cost']
+    book_price += books_df.at[book_index, 'shipping_cost']
+    balance = user_df.at[user_index, 'balance'] - book_price
+    if balance < 0:
+        return None, (False, "Insufficient balance for this order.")
+
+    # Take the copy from the store chosen by the allocation policy and remember it for returns
+    bookstores, store = take_copy(book_id, user_df.at[user_index, 'city'], policy)
+    order_stores = dict(as_python_value(user_df.at[user_index, 'order_stores'], {}))
+    if store is not None:
+        order_stores[str(book_id)] = store
+
+    # User and book changes go into the same journal entry
+    return [
+        update_change('users', user_id, {'orders': orders + [book_id], 'balance': balance,
+                                         'order_stores': order_stores}),
+        update_change('books', book_id, {'bookstores': bookstores}),
+    ], (True, "Order placed successfully!")
+
+
+# Add copies of a book to a store, e.g. returned or delivered copies; without a store (or for a store that
+# no longer lists the book) they go to the most depleted one. Returns (success, message).
+@instrumented
+def restock_book(book_id, count=1, store=None):
+    def prepare():
+        book_index = find_book(book_id)
+        if book_index is None:
+            return None, (False, "Book ID does not exist.")
+        bookstores, target = return_copies(book_id, store, count)
+        if target is None:
+            return None, (False, "The book is not listed in any store.")
+        return [update_change('books', book_id, {'bookstores': bookstores})], \
+            (True, f"Added {count} copies of Book ID {book_id} to {target}.")
+
+    return run_transaction([('books', book_id)], prepare)
+
+
+# Order a cart of books at once. Returns a list of (book_id, success, message), one per requested book.
+# Books that are unknown, already ordered, repeated in the cart or out of stock are refused on their own;
+# the rest are ordered together if the balance covers their total, as a single transaction and journal
+# entry. With all_or_nothing=True one refused book cancels the whole cart.
+@instrumented
+def place_orders(user_id, book_ids, all_or_nothing=False, policy=None):
+    book_ids = [int(book_id) for book_id in book_ids]
+    rows = [('users', user_id)] + [('books', book_id) for book_id in set(book_ids)]
+    return run_transaction(rows, lambda: prepare_orders(user_id, book_ids, all_or_nothing, policy))
+
+
+# Check a cart against the current data; returns (changes, per-book results)
+def prepare_orders(user_id, book_ids, all_or_nothing, policy=None):
+    user_index = find_user(user_id)
+    if user_index is None:
+        return None, [(book_id, False, f"User with ID {user_id} not found.") for book_id in book_ids]
+
+    # Cost and stock of the whole cart are looked up and checked in one pass over the book rows
+    labels = pd.Series([find_book(book_id) for book_id in book_ids], dtype=object)
+    known = labels.notna().to_numpy()
+    cart = books_df.loc[labels[known].tolist(), ['cost', 'shipping_cost', 'copies']]
+    prices = np.zeros(len(book_ids))
+    copies = np.zeros(len(book_ids), dtype=int)
+    prices[known] = (cart['cost'] + cart['shipping_cost']).to_numpy()
+    copies[known] = cart['copies'].to_numpy()
+
+    orders = user_df.at[user_index, 'orders']
+    ordered = np.array([book_id in orders for book_id in book_ids], dtype=bool)
+    repeated = pd.Series(book_ids).duplicated().to_numpy()
+    reasons = np.select([~known, ordered, repeated, copies <= 0],
+                        ["Book ID does not exist.", "You have already ordered this book.",
+                         "This book is already in the cart.", "No copies of this book are left."], '')
+    accepted = reasons == ''
+    reasons = reasons.tolist()
+
+    balance = user_df.at[user_index, 'balance'] - prices[accepted].sum()
+    if not accepted.any() or (all_or_nothing and not accepted.all()):
+        return None, [(book_id, False, reason or "The cart was not ordered.")
+                      for book_id, reason in zip(book_ids, reasons)]
+    if balance < 0:
+        return None, [(book_id, False, reason or "Insufficient balance for this cart.")
+                      for book_id, reason in zip(book_ids, reasons)]
+
+    # User and book changes of the whole cart go into the same journal entry
+    new_orders = [book_id for book_id, ok in zip(book_ids, accepted) if ok]
+    order_stores = dict(as_python_value(user_df.at[user_index, 'order_stores'], {}))
+    changes = []
+    for book_id, ok in zip(book_ids, accepted):
+        if ok:
+            bookstores, store = take_copy(book_id, user_df.at[user_index, 'city'], policy)
+            if store is not None:
+                order_stores[str(book_id)] = store
+            changes.append(update_change('books', book_id, {'bookstores': bookstores}))
+    changes.insert(0, update_change('users', user_id, {'orders': orders + new_orders, 'balance': balance,
+                                                       'order_stores': order_stores}))
+    return changes, [(book_id, bool(ok), reason or "Order placed successfully!")
+                     for book_id, ok, reason in zip(book_ids, accepted, reasons)]
+
+
+# Recommendations
+# The book ids of a user's favorites and orders
+def user_items(user_id):
+    user_index = find_user(user_id)
+    if user_index is None:
+        return set()
+    return set(user_df.at[user_index, 'favorites']) | set(user_df.at[user_index, 'orders'])
+
+
+# Which cached recommendations a change makes stale, as (user ids, book ids, categories), or None if it
+# does not affect recommendations. Both the old and the new favorites/orders/categories count.
+def recommendation_dependencies(change):
+    if change['op'] == 'insert_rows':
+        rows = change['rows']
+    elif change['op'] == 'insert':
+        rows = [change['row']]
+    elif change['op'] == 'update':
+        rows = [dict(change['values'], id=change['id'])]
     else:
-        print("Book ID does not exist.")
+        rows = [{'id': change['id']}]
+
+    users, items, categories = set(), set(), set()
+    for row in rows:
+        if change['table'] == 'users':
+            if change['op'] == 'update' and 'orders' not in row and 'favorites' not in row:
+                continue
+            users.add(row['id'])
+            items |= user_items(row['id'])
+            items |= set(as_python_value(row.get('favorites'), [])) | set(as_python_value(row.get('orders'), []))
+        elif change['table'] == 'books':
+            if change['op'] == 'update' and 'categories' not in row:
+                continue
+            items.add(row['id'])
+            categories |= set(book_categories.get(row['id'], []))
+            categories |= set(as_python_value(row.get('categories'), []))
+
+    if not users and not items:
+        return None
+    return users, items, categories
+
+
+# Drop the cached recommendations of the given users, of users whose favorites/orders or recommendations
+# contain one of the changed books (their co-order scores change) and of users interested in the changed
+# categories, as found by the reverse maps
+def invalidate_recommendations(users=(), items=(), categories=()):
+    with recommendation_lock:
+        stale = {user_id for user_id in users if user_id in recommendation_cache}
+        for book_id in items:
+            stale |= cached_by_book.get(book_id, set())
+        for category in categories:
+            stale |= cached_by_category.get(category, set())
+        for user_id in stale:
+            drop_cached_recommendations(user_id)
+        recommendation_cache_stats['invalidations'] += len(stale)
+
+
+# Forget the model and every cached recommendation, e.g. after the tables were loaded again
+def clear_recommendations():
+    drop_recommendation_model()
+    with recommendation_lock:
+        recommendation_cache.clear()
+        cached_by_book.clear()
+        cached_by_category.clear()
+
+
+def cache_recommendations(user_id, recommendations):
+    items = user_items(user_id)
+    entry = {
+        'time': time.monotonic(),
+        'books': recommendations,
+        'items': items,
+        'categories': {category for book_id in items for category in book_categories.get(book_id, [])},
+    }
+    # Service readers share the cache, so it is only touched under its own lock
+    with recommendation_lock:
+        if user_id in recommendation_cache:
+            drop_cached_recommendations(user_id)
+        recommendation_cache[user_id] = entry
+        for book_id in entry['items'].union(book_id for book_id, score in recommendations):
+            cached_by_book.setdefault(book_id, set()).add(user_id)
+        for category in entry['categories']:
+            cached_by_category.setdefault(category, set()).add(user_id)
+        while len(recommendation_cache) > RECOMMENDATION_CACHE_SIZE:
+            drop_cached_recommendations(next(iter(recommendation_cache)))
+            recommendation_cache_stats['evictions'] += 1
+
+
+# Remove a cache entry and its reverse map entries; called with recommendation_lock held
+def drop_cached_recommendations(user_id):
+    entry = recommendation_cache.pop(user_id)
+    for index, keys in [(cached_by_book, entry['items'].union(book_id for book_id, score in entry['books'])),
+                        (cached_by_category, entry['categories'])]:
+        for key in keys:
+            users = index.get(key)
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del index[key]
+
+
+def cached_recommendations(user_id):
+    with recommendation_lock:
+        entry = recommendation_cache.get(user_id)
+        if entry is not None and time.monotonic() - entry['time'] > RECOMMENDATION_CACHE_TTL:
+            drop_cached_recommendations(user_id)
+            recommendation_cache_stats['evictions'] += 1
+            entry = None
+
+        if entry is None:
+            recommendation_cache_stats['misses'] += 1
+            return None
+        recommendation_cache_stats['hits'] += 1
+        recommendation_cache.move_to_end(user_id)
+        return entry['books']
+
+
+def recommendation_cache_info():
+    lookups = recommendation_cache_stats['hits'] + recommendation_cache_stats['misses']
+    return dict(recommendation_cache_stats, size=len(recommendation_cache),
+                hit_rate=recommendation_cache_stats['hits'] / lookups if lookups else 0.0)
+
+
+# The sparse user x book interest matrix of the given users, one row each in their order, with a column per
+# book of book_ids (an Index); unknown users have no interests
+def interest_matrix(user_ids, book_ids):
+    from scipy import sparse
+
+    labels = [find_user(user_id) for user_id in user_ids]
+    known = np.array([row for row, label in enumerate(labels) if label is not None], dtype=np.int64)
+    positions = user_df.index.get_indexer([label for label in labels if label is not None])
+    rows, cols, weights = [], [], []
+    for column, weight in [('favorites', FAVORITE_WEIGHT), ('orders', ORDER_WEIGHT)]:
+        books = user_df[column].to_numpy()[positions]
+        lengths = np.fromiter(map(len, books), dtype=np.int64, count=len(books))
+        book_positions = book_ids.get_indexer(np.fromiter(itertools.chain.from_iterable(books), dtype=np.int64,
+                                                          count=int(lengths.sum())))
+        listed = book_positions >= 0
+        rows.append(np.repeat(known, lengths)[listed])
+        cols.append(book_positions[listed])
+        weights.append(np.full(int(listed.sum()), weight))
+    return sparse.csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(len(user_ids), len(book_ids)), dtype=np.float32)
+
+
+# Build the book x category matrix and the book x book co-occurrence matrix (how often two books appear
+# together in the orders/favorites of the same user)
+@instrumented
+def build_recommendation_model():
+    from scipy import sparse
+
+    book_ids = pd.Index(books_df['id'].to_numpy())
+    interests = interest_matrix(user_df['id'].tolist(), book_ids)
+
+    categories = pd.Series([book_categories.get(book_id, []) for book_id in book_ids]).explode().dropna()
+    category_codes, category_names = pd.factorize(categories)
+    book_category = sparse.csr_matrix((np.ones(len(category_codes), dtype=np.float32),
+                                       (categories.index.to_numpy(), category_codes)),
+                                      shape=(len(book_ids), len(category_names)))
+
+    co_orders = (interests.T @ interests).tocsr()
+    co_orders.setdiag(0)
+    co_orders.eliminate_zeros()
+
+    return {
+        'book_ids': book_ids,
+        'book_category': book_category,
+        'co_orders': co_orders,
+        'co_order_changes': None,
+    }
 
 
-def recommend_books(user_id):
-    # Retrieve the list of favorite book IDs for the given user
-    favorites = user_df.loc[user_df['id'] == user_id, 'favorites'].values[0]
+def get_recommendation_model():
+    global recommendation_model
+    if recommendation_model is None:
+        recommendation_model = build_recommendation_model()
+    return recommendation_model
 
-    # If the user has no favorite books, print a message and exit the function
-    if not favorites:
-        print("No favorite books found for recommendations.")
-        return
 
-    # Initialize an empty dictionary to count the occurrences of each category in the favorite books
-    category_counts = {}
+def drop_recommendation_model():
+    global recommendation_model
+    recommendation_model = None
 
-    # Iterate over each favorite book ID
-    for book_id in favorites:
-        # Retrieve the book information from books_df for the current book_id
-        book = books_df.loc[books_df['id'] == book_id]
 
-        # Evaluate the string representation of the categories list to convert it to an actual list
-        categories = eval(str(book.iloc[0]['categories']))
+# The interest rows of the given users as the model sees them, read before a change to their orders or favorites
+def user_interests(user_ids):
+    if recommendation_model is None or not user_ids:
+        return None
+    return interest_matrix(user_ids, recommendation_model['book_ids'])
 
-        # Iterate over each category in the list
-        for category in categories:
-            # Increment the category count in the dictionary, or initialize it if not already present
-            if category in category_counts:
-                category_counts[category] += 1
-            else:
-                category_counts[category] = 1
 
-    # If no categories were found in the favorite books, print a message and exit the function
-    if not category_counts:
-        print("No categories found in favorite books for recommendations.")
-        return
+# Fold a change to the given users' orders/favorites into the co-order matrix: their old co-occurrences
+# (before, from user_interests()) are taken out and their new ones put in. Only the pending changes matrix
+# grows; it is added to the co-order matrix once it holds CO_ORDER_CHANGES_LIMIT entries.
+def update_recommendation_model(user_ids, before):
+    from scipy import sparse
 
-    # Find the category with the highest count (most common category)
-    most_common_category = max(category_counts, key=category_counts.get)
+    model = recommendation_model
+    if model is None:
+        return
+    after = interest_matrix(user_ids, model['book_ids'])
+    change = (after.T @ after - before.T @ before).tocsr()
+    change -= sparse.diags(change.diagonal(), format='csr')
+    change.eliminate_zeros()
+
+    pending = change if model['co_order_changes'] is None else model['co_order_changes'] + change
+    if pending.nnz >= CO_ORDER_CHANGES_LIMIT:
+        model['co_orders'] = model['co_orders'] + pending
+        model['co_orders'].eliminate_zeros()
+        pending = None
+    model['co_order_changes'] = pending
+
+
+# Divide each row by its largest value so both scores are on the same 0..1 scale
+def scale_rows(scores):
+    largest = scores.max(axis=1, keepdims=True)
+    return np.divide(scores, largest, out=np.zeros_like(scores), where=largest > 0)
+
+
+# Score every book for a block of users and return the top k (book id, score) pairs of each user
+def score_recommendations(model, user_ids, k):
+    interests = interest_matrix(user_ids, model['book_ids'])
+
+    # Category affinity: share of the user's interest in each category, spread over the books of that category
+    affinity = (interests @ model['book_category']).toarray()
+    affinity /= np.maximum(affinity.sum(axis=1, keepdims=True), 1e-9)
+    category_scores = np.asarray(model['book_category'] @ affinity.T).T
+    co_order_scores = (interests @ model['co_orders']).toarray()
+    if model['co_order_changes'] is not None:
+        co_order_scores += (interests @ model['co_order_changes']).toarray()
+
+    scores = CATEGORY_SCORE_WEIGHT * scale_rows(category_scores) + CO_ORDER_SCORE_WEIGHT * scale_rows(co_order_scores)
+    # Books the user already ordered or favorited are never recommended
+    seen_rows, seen_cols = interests.nonzero()
+    scores[seen_rows, seen_cols] = 0
+
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return [[] for _ in user_ids]
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+    return [[(int(model['book_ids'][book]), float(score)) for book, score in zip(books, book_scores) if score > 0]
+            for books, book_scores in zip(top, top_scores)]
+
+
+# Top recommendations for one user, from the cache when they were already computed
+@instrumented
+def recommend_for_user(user_id, k=RECOMMENDATIONS_PER_USER):
+    recommendations = cached_recommendations(user_id)
+    if recommendations is None:
+        if find_user(user_id) is None:
+            return []
+        recommendations = score_recommendations(get_recommendation_model(), [user_id], RECOMMENDATIONS_PER_USER)[0]
+        cache_recommendations(user_id, recommendations)
+    return recommendations[:k]
+
+
+# Batch mode: compute the recommendations of all users, batch_size users per vectorized pass
+@instrumented
+def precompute_recommendations(batch_size=256):
+    model = get_recommendation_model()
+    user_ids = user_df['id'].tolist()
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        for user_id, recommendations in zip(batch, score_recommendations(model, batch, RECOMMENDATIONS_PER_USER)):
+            cache_recommendations(user_id, recommendations)
+    print(f"Recommendations computed for {len(user_ids)} users.")
 
-    # Retrieve the list of order book IDs for the given user
-    orders = user_df.loc[user_df['id'] == user_id, 'orders'].values[0]
 
-    # Create a set of book IDs that are either in favorites or orders to exclude them from recommendations
-    excluded_books = set(favorites) | set(orders)
+def recommend_books(user_id):
+    user_index = find_user(user_id)
+    favorites = user_df.at[user_index, 'favorites']
+    orders = user_df.at[user_index, 'orders']
 
-    # Filter the books_df to find books that are not in the excluded_books set and belong to the most common category
-    possible_recommendations = books_df[
-        (books_df['id'].apply(lambda x: x not in excluded_books)) &  # Exclude books in favorites and orders
-        (books_df['categories'].apply(lambda x: most_common_category in eval(str(x))))
-        # Include books in the most common category
-        ]
+    # If the user has no favorite or ordered books, print a message and exit the function
+    if not favorites and not orders:
+        print("No favorite books found for recommendations.")
+        return
 
-    # If no possible recommendations are found, print a message
-    if possible_recommendations.empty:
-        print(f"No new recommendations available for the category '{most_common_category}'.")
-    else:
-        # Randomly select up to 3 books from the possible recommendations
-        recommendations = possible_recommendations.sample(n=min(3, len(possible_recommendations))).iloc
+    recommendations = recommend_for_user(user_id, 3)
+    if not recommendations:
+        print("No new recommendations available.")
+        return
 
-        # Print the recommended books
-        print(f"\nRecommended Books based on your favorites in the category '{most_common_category}':")
-        for recommendation in recommendations:
-            print(
-                f"Book ID: {recommendation['id']}, Title: {recommendation['title']}, Price: ${recommendation['cost']:.2f}")
+    # Print the recommended books
+    print("\nRecommended Books based on your favorites and orders:")
+    for book_id, score in recommendations:
+        book_index = find_book(book_id)
+        title, cost = books_df.at[book_index, 'title'], books_df.at[book_index, 'cost']
+        categories = ', '.join(book_categories.get(book_id, []))
+        print(f"Book ID: {book_id}, Title: {title}, Price: ${cost:.2f}, Categories: {categories}")
 
 
 def adjust_balance(user_id, amount):
-    global user_df
-    user_df.at[user_id - 1, 'balance'] += amount
-    save_dataframes()
-    print(f"Balance adjusted by {amount}.")
+    def prepare():
+        balance = user_df.at[find_user(user_id), 'balance'] + amount
+        return [update_change('users', user_id, {'balance': balance})], f"Balance adjusted by {amount}."
+
+    print(run_transaction([('users', user_id)], prepare))
 
 
-def upload_favorites_csv(user_id, file_path):
+@instrumented
+def upload_favorites_csv(user_id, file_path, chunksize=None, progress=print_progress):
     global user_df, books_df
 
     try:
-        # Read the CSV file
-        favorites_data = pd.read_csv(file_path)
-
-        # Extract book IDs as a list
-        favorite_books = favorites_data['book_id'].tolist()
-
         # Validate and update favorites for the user
-        if user_id <= len(user_df):
-            current_favorites = user_df.at[user_id - 1, 'favorites']  # Assuming user_id is 1-based index
-            new_favorites = list(set(current_favorites + favorite_books))  # Ensure no duplicates
-
-            # Update the favorites column in user_df
-            user_df.at[user_id - 1, 'favorites'] = new_favorites
-
-            # Save the updated DataFrame
-            save_dataframes()
-
+        user_index = find_user(user_id)
+        if user_index is not None:
+            # A dict keeps the order of the favorites and ensures no duplicates
+            uploaded = {}
+            skipped = 0
+
+            # Stream the CSV file, keeping only the book IDs that exist in the library
+            for chunk in read_csv_chunks(file_path, chunksize, usecols=['book_id'], progress=progress):
+                book_ids = pd.to_numeric(chunk['book_id'], errors='coerce').dropna().drop_duplicates()
+                known = book_ids.map(lambda book_id: find_book(book_id) is not None)
+                skipped += len(chunk) - known.sum()
+                uploaded.update(dict.fromkeys(book_ids[known].astype(int).tolist()))
+
+            if skipped:
+                print(f"Skipped {skipped} rows with unknown or duplicate book IDs.")
+
+            # Update the favorites column in user_df, merged with the favorites as they are at commit time
+            def prepare():
+                new_favorites = dict.fromkeys(user_df.at[find_user(user_id), 'favorites'])
+                new_favorites.update(uploaded)
+                return [update_change('users', user_id, {'favorites': list(new_favorites)})], None
+
+            run_transaction([('users', user_id)], prepare)
             print("Favorites updated successfully!")
         else:
             print(f"User with ID {user_id} not found.")
@@ -807,25 +3189,19 @@ def upload_favorites_csv(user_id, file_path):
 
 def modify_personal_details(user_id, field_to_change, new_value):
     try:
-        if user_id <= len(user_df):
-            # Update the user details based on the chosen field
-            if field_to_change.lower() == 'username':
-                user_df.at[user_id - 1, 'username'] = new_value
-            elif field_to_change.lower() == 'password':
-                user_df.at[user_id - 1, 'password'] = new_value
-            elif field_to_change.lower() == 'address':
-                user_df.at[user_id - 1, 'address'] = new_value
-            elif field_to_change.lower() == 'city':
-                user_df.at[user_id - 1, 'city'] = new_value
+        # Usernames are checked and changed under the storage lock so two processes cannot take the same one
+        with storage_locked():
+            if find_user(user_id) is not None:
+                # Update the user details based on the chosen field
+                if field_to_change.lower() == 'username' and not validate_username(new_value):
+                    print("Username already exists or is invalid.")
+                elif field_to_change.lower() in ['username', 'password', 'address', 'city']:
+                    commit_changes([update_change('users', user_id, {field_to_change.lower(): new_value})])
+                    print(f"{field_to_change.capitalize()} updated successfully!")
+                else:
+                    print("Invalid field name. Please choose from 'Username', 'Password', 'Address', or 'City'.")
             else:
-                print("Invalid field name. Please choose from 'Username', 'Password', 'Address', or 'City'.")
-
-            # Save the updated DataFrame
-            save_dataframes()
-
-            print(f"{field_to_change.capitalize()} updated successfully!")
-        else:
-            print(f"User with ID {user_id} not found.")
+                print(f"User with ID {user_id} not found.")
 
     except Exception as e:
         print(f"Error: {e}")
@@ -867,7 +3243,8 @@ def generate_reports():
         print("6. Number of Books by Store (considering availability)")
         print("7. Distribution of Available Book Costs")
         print("8. Number of Users by City")
-        print("9. Back to Admin Menu")
+        print("9. Save All Reports to Files")
+        print("10. Back to Admin Menu")
         choice = input("Enter your choice: ")
 
         if choice == '1':
@@ -887,120 +3264,214 @@ def generate_reports():
         elif choice == '8':
             users_by_city()
         elif choice == '9':
+            paths = generate_all_reports()
+            print(f"Saved {len(paths)} report files to '{REPORT_DIRECTORY}'.")
+        elif choice == '10':
             break
         else:
             print("Invalid choice. Please try again.")
 
 
-def books_by_publisher(consider_availability=True):
-    if consider_availability:
-        df = books_df[books_df['availability']]
-    else:
-        df = books_df
-    publisher_counts = df['publisher'].value_counts()
-
-    plt.figure(figsize=(10, 6))
-    publisher_counts.plot(kind='bar')
-    plt.title('Number of Books by Publisher')
-    plt.xlabel('Publisher')
-    plt.ylabel('Number of Books')
-    plt.xticks(rotation=45, ha='right')
-    plt.tight_layout()
-    plt.show()
+# Report data: the Series each report plots, also returned by the service layer. They are read from the
+# materialized aggregates instead of being counted from books_df.
+def publisher_counts(consider_availability=True):
+    return count_series(book_counts.get(('publisher', consider_availability), {}))
 
 
-def books_by_author(consider_availability=True):
-    if consider_availability:
-        df = books_df[books_df['availability']]
-    else:
-        df = books_df
-    author_counts = df['author'].value_counts()
-
-    plt.figure(figsize=(10, 6))
-    author_counts.plot(kind='bar')
-    plt.title('Number of Books by Author')
-    plt.xlabel('Author')
-    plt.ylabel('Number of Books')
-    plt.xticks(rotation=45, ha='right')
-    plt.tight_layout()
-    plt.show()
+def author_counts(consider_availability=True):
+    return count_series(book_counts.get(('author', consider_availability), {}))
 
 
-def books_by_category(consider_availability=True):
-    if consider_availability:
-        df = books_df[books_df['availability']]
+def category_counts(consider_availability=True):
+    return count_series(book_counts.get(('categories', consider_availability), {}))
+
+
+def store_counts():
+    return pd.Series({store_names[store]: store_totals[store] for store in sorted(store_totals)}, dtype=int)
+
+
+def city_counts():
+    return count_series(city_totals)
+
+
+# The histogram of the available books' costs, binned from the distinct costs weighted by their counts
+def cost_histogram(consider_availability=True):
+    costs = np.array(list(cost_counts), dtype=float)
+    counts, edges = np.histogram(costs, bins=10, weights=np.array(list(cost_counts.values()), dtype=float))
+    return {'counts': counts.astype(int).tolist(), 'bins': edges.tolist()}
+
+
+# The reports: how their data is computed, which columns it depends on and how it is labelled.
+# 'availability' marks the reports that can be limited to available books.
+REPORTS = {
+    'books_by_publisher': {'data': publisher_counts, 'columns': [('books', 'publisher'), ('books', 'availability')],
+                           'title': 'Number of Books by Publisher', 'xlabel': 'Publisher', 'availability': True},
+    'books_by_author': {'data': author_counts, 'columns': [('books', 'author'), ('books', 'availability')],
+                        'title': 'Number of Books by Author', 'xlabel': 'Author', 'availability': True},
+    'books_by_category': {'data': category_counts, 'columns': [('books', 'categories'), ('books', 'availability')],
+                          'title': 'Number of Books by Category', 'xlabel': 'Category', 'availability': True},
+    'books_by_store': {'data': lambda consider_availability: store_counts(), 'columns': [('books', 'bookstores')],
+                       'title': 'Number of Books by Store', 'xlabel': 'Store'},
+    'distribution_of_book_costs': {'data': cost_histogram, 'columns': [('books', 'cost'), ('books', 'availability')],
+                                   'title': 'Distribution of Available Book Costs', 'xlabel': 'Cost',
+                                   'ylabel': 'Frequency', 'histogram': True},
+    'users_by_city': {'data': lambda consider_availability: city_counts(), 'columns': [('users', 'city')],
+                      'title': 'Number of Users by City', 'xlabel': 'City', 'ylabel': 'Number of Users'},
+}
+
+
+# The versions of everything a report's data is computed from
+def report_versions(name):
+    report = REPORTS[name]
+    keys = report['columns'] + [(table, None) for table in sorted({table for table, column in report['columns']})]
+    return tuple(column_versions.get(key, 0) for key in keys)
+
+
+# The data of a report, recomputed only when a column it depends on changed since it was cached
+@instrumented
+def report_data(name, consider_availability=True):
+    consider_availability = consider_availability and REPORTS[name].get('availability', False)
+    versions = report_versions(name)
+    cached = report_cache.get((name, consider_availability))
+    if cached is not None and cached[0] == versions:
+        count_metric('cache_hits', 'reports')
+        return cached[1]
+    count_metric('cache_misses', 'reports')
+    data = REPORTS[name]['data'](consider_availability)
+    report_cache[(name, consider_availability)] = (versions, data)
+    return data
+
+
+def draw_report(axes, name, data):
+    report = REPORTS[name]
+    if report.get('histogram'):
+        edges = np.array(data['bins'])
+        axes.bar(edges[:-1], data['counts'], width=np.diff(edges), align='edge', edgecolor='k')
+    else:
+        axes.bar(range(len(data)), data.to_numpy())
+        axes.set_xticks(range(len(data)))
+        axes.set_xticklabels([str(label) for label in data.index], rotation=45, ha='right')
+    axes.set_title(report['title'])
+    axes.set_xlabel(report['xlabel'])
+    axes.set_ylabel(report.get('ylabel', 'Number of Books'))
+
+
+def report_json(name, data, consider_availability):
+    report = {'report': name, 'title': REPORTS[name]['title'], 'consider_availability': consider_availability}
+    if REPORTS[name].get('histogram'):
+        report.update(data)
     else:
-        df = books_df
-    category_counts = df.explode('categories')['categories'].value_counts()
-
-    plt.figure(figsize=(10, 6))
-    category_counts.plot(kind='bar')
-    plt.title('Number of Books by Category')
-    plt.xlabel('Category')
-    plt.ylabel('Number of Books')
-    plt.xticks(rotation=45, ha='right')
-    plt.tight_layout()
+        report['counts'] = {str(key): int(value) for key, value in data.items()}
+    return report
+
+
+# Write a report to directory as a png, svg or json file and return its path. A file is only written again
+# when the report's data changed since it was last written.
+@instrumented
+def render_report(name, fmt='png', directory=REPORT_DIRECTORY, consider_availability=True):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    if name not in REPORTS:
+        raise ValueError(f"Unknown report '{name}'.")
+    if fmt not in REPORT_FORMATS:
+        raise ValueError(f"Unknown report format '{fmt}'.")
+    consider_availability = consider_availability and REPORTS[name].get('availability', False)
+    suffix = '_all' if REPORTS[name].get('availability') and not consider_availability else ''
+    path = os.path.join(directory, f"{name}{suffix}.{fmt}")
+    data = report_data(name, consider_availability)
+    versions = report_versions(name)
+    if rendered_reports.get(path) == versions and os.path.exists(path):
+        count_metric('cache_hits', 'rendered_reports')
+        return path
+    count_metric('cache_misses', 'rendered_reports')
+
+    os.makedirs(directory, exist_ok=True)
+    # Written to a temporary file first, like the snapshot files, so readers never see a half-written report
+    if fmt == 'json':
+        with open(path + '.tmp', 'w', encoding='utf-8') as handle:
+            json.dump(report_json(name, data, consider_availability), handle, indent=2, default=to_builtin)
+    else:
+        figure = Figure(figsize=(10, 6))
+        FigureCanvasAgg(figure)
+        draw_report(figure.add_subplot(), name, data)
+        figure.tight_layout()
+        figure.savefig(path + '.tmp', format=fmt)
+    os.replace(path + '.tmp', path)
+    rendered_reports[path] = versions
+    return path
+
+
+# Write every report, with and without considering availability where that applies, in the given formats
+@instrumented
+def generate_all_reports(directory=REPORT_DIRECTORY, formats=('png', 'json')):
+    paths = []
+    for name, report in REPORTS.items():
+        for consider_availability in ([True, False] if report.get('availability') else [True]):
+            for fmt in formats:
+                paths.append(render_report(name, fmt, directory, consider_availability))
+    return paths
+
+
+# Show a report in a window
+def show_report(name, consider_availability=True):
+    # pyplot is only imported when a report is shown, so starting the program does not load matplotlib
+    import matplotlib.pyplot as plt
+
+    figure = plt.figure(figsize=(10, 6))
+    draw_report(figure.add_subplot(), name, report_data(name, consider_availability))
+    figure.tight_layout()
     plt.show()
 
 
-def books_by_store():
-    store_counts = {}
+def books_by_publisher(consider_availability=True):
+    show_report('books_by_publisher', consider_availability)
 
-    for bookstores in books_df['bookstores']:
-        for store, count in bookstores.items():
-            if store in store_counts:
-                store_counts[store] += count
-            else:
-                store_counts[store] = count
 
-    store_series = pd.Series(store_counts)
+def books_by_author(consider_availability=True):
+    show_report('books_by_author', consider_availability)
 
-    plt.figure(figsize=(10, 6))
-    store_series.plot(kind='bar')
-    plt.title('Number of Books by Store')
-    plt.xlabel('Store')
-    plt.ylabel('Number of Books')
-    plt.xticks(rotation=45, ha='right')
-    plt.tight_layout()
-    plt.show()
+
+def books_by_category(consider_availability=True):
+    show_report('books_by_category', consider_availability)
+
+
+def books_by_store():
+    show_report('books_by_store')
 
 
 def distribution_of_book_costs():
-    df = books_df[books_df['availability']]
-    costs = df['cost']
-
-    plt.figure(figsize=(10, 6))
-    plt.hist(costs, bins=10, edgecolor='k')
-    plt.title('Distribution of Available Book Costs')
-    plt.xlabel('Cost')
-    plt.ylabel('Frequency')
-    plt.tight_layout()
-    plt.show()
+    show_report('distribution_of_book_costs')
 
 
 def users_by_city():
-    city_counts = user_df['city'].value_counts()
-
-    plt.figure(figsize=(10, 6))
-    city_counts.plot(kind='bar')
-    plt.title('Number of Users by City')
-    plt.xlabel('City')
-    plt.ylabel('Number of Users')
-    plt.xticks(rotation=45, ha='right')
-    plt.tight_layout()
-    plt.show()
+    show_report('users_by_city')
 
 
 # Export books to CSV
+@instrumented
 def export_books_to_csv():
-    books_df.to_csv('exported_books.csv', index=False)
+    snapshot_frame('books').to_csv('exported_books.csv', index=False)
     print("Books exported to 'exported_books.csv' successfully.")
 
 
+# Available books whose field contains the text, found through the full-text index, optionally only
+# those listed in the given store, joined with their copies there as the store_copies column
+@instrumented
+def find_available_books(text, field='title', store_name=None):
+    books = books_df.loc[[find_book(book_id) for book_id in search_books(text, field)]]
+    count_metric('rows_scanned', 'find_available_books', len(books))
+    books = books[books['availability'].astype(bool)]
+    if store_name is not None:
+        stock = store_stock_counts(store_name).rename('store_copies')
+        books = books.join(stock, on='id', how='inner')
+    return books
+
+
 # Check book availability by title
 def check_book_availability_by_title():
     title = input("Enter book title to check availability: ")
-    available_books = books_df[(books_df['title'].str.contains(title, case=False)) & (books_df['availability'])]
+    available_books = find_available_books(title)
 
     if not available_books.empty:
         print(f"Books available for title '{title}':")
@@ -1014,16 +3485,14 @@ def check_book_availability_by_title():
 def check_book_availability_by_title_and_store():
     title = input("Enter book title to check availability: ")
     store_name = input("Enter store name to check availability: ")
-    available_books = books_df[(books_df['title'].str.contains(title, case=False)) & (books_df['availability'])]
+    available_books = find_available_books(title)
 
     if not available_books.empty:
-        found = False
-        for index, row in available_books.iterrows():
-            if store_name in row['bookstores']:
-                found = True
-                print(
-                    f"Book ID: {row['id']}, Title: {row['title']}, Store: {store_name}, Copies: {row['bookstores'][store_name]}")
-        if not found:
+        store_books = find_available_books(title, store_name=store_name)
+        for index, row in store_books.iterrows():
+            print(
+                f"Book ID: {row['id']}, Title: {row['title']}, Store: {store_name}, Copies: {row['store_copies']}")
+        if store_books.empty:
             print(f"No available books found for title '{title}' in store '{store_name}'.")
     else:
         print(f"No available books found for title '{title}'.")
@@ -1032,10 +3501,10 @@ def check_book_availability_by_title_and_store():
 # Calculate book cost (cost + shipping cost)
 def calculate_book_cost():
     book_id = int(input("Enter the book ID to calculate cost: "))
-    book = books_df[books_df['id'] == book_id]
+    book_index = find_book(book_id)
 
-    if not book.empty:
-        total_cost = book['cost'].values[0] + book['shipping_cost'].values[0]
+    if book_index is not None:
+        total_cost = books_df.at[book_index, 'cost'] + books_df.at[book_index, 'shipping_cost']
         print(f"Total cost of book ID {book_id}: ${total_cost}")
     else:
         print(f"No book found with ID {book_id}.")
@@ -1051,40 +3520,210 @@ def calculate_total_cost_of_available_books():
 
     if choice == '1':
         publisher = input("Enter publisher name: ")
-        books = books_df[(books_df['publisher'].str.contains(publisher, case=False)) & (books_df['availability'])]
-        total_cost = (books['cost'] + books['shipping_cost']).sum()
+        total_cost = round(available_cost('publisher', publisher), 2)
         print(f"Total cost of available books by publisher '{publisher}': ${total_cost}")
     elif choice == '2':
         author = input("Enter author name: ")
-        books = books_df[(books_df['author'].str.contains(author, case=False)) & (books_df['availability'])]
-        total_cost = (books['cost'] + books['shipping_cost']).sum()
+        total_cost = round(available_cost('author', author), 2)
         print(f"Total cost of available books by author '{author}': ${total_cost}")
     elif choice == '3':
-        total_cost = (books_df[books_df['availability']]['cost'] + books_df[books_df['availability']][
-            'shipping_cost']).sum()
+        total_cost = round(available_cost(), 2)
         print(f"Total cost of all available books: ${total_cost}")
     else:
         print("Invalid choice. Please try again.")
 
 
+# Service layer: the operations without prompts, for callers such as server.py that serve many clients
+# from one copy of the data. Readers share data_lock; the changes of a journal entry are applied to the
+# DataFrames holding it exclusively. The writer may take the lock again, for reading or writing; a reader
+# must never ask for the write lock (or the storage lock, which is held while it is taken).
+class ReadWriteLock:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = None
+        self.writer_depth = 0
+        self.writers_waiting = 0
+
+    @property
+    def writer_active(self):
+        return self.writer is not None
+
+    @contextmanager
+    def read_locked(self):
+        if self.writer == threading.get_ident():
+            yield
+            return
+        with self.condition:
+            # Waiting writers go first so a steady stream of readers cannot starve them
+            while self.writer_active or self.writers_waiting:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write_locked(self):
+        if self.writer == threading.get_ident():
+            self.writer_depth += 1
+            try:
+                yield
+            finally:
+                self.writer_depth -= 1
+            return
+        with self.condition:
+            self.writers_waiting += 1
+            while self.writer_active or self.readers:
+                self.condition.wait()
+            self.writers_waiting -= 1
+            self.writer = threading.get_ident()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = None
+                self.condition.notify_all()
+
+
+data_lock = ReadWriteLock()
+
+
+# In shared-storage mode, apply the commits of other processes; the commits apply them with the readers held
+# off. The journal's size and modification time tell cheaply whether there is anything new.
+def refresh_service_data():
+    if SHARED_STORAGE and journal_stat() != journal_seen:
+        refresh_shared_storage()
+
+
+# Changes run as transactions, which take data_lock themselves: the checks share it, so orders for different
+# users and books are validated side by side under their row locks, and only the apply excludes the readers
+@instrumented
+def api_place_order(user_id, book_id):
+    refresh_service_data()
+    ok, message = process_order(user_id, book_id)
+    return {'ok': ok, 'message': message}
+
+
+@instrumented
+def api_place_orders(user_id, book_ids, all_or_nothing=False):
+    refresh_service_data()
+    results = place_orders(user_id, book_ids, all_or_nothing)
+    return {'ok': any(ok for book_id, ok, message in results),
+            'items': [{'book_id': book_id, 'ok': ok, 'message': message} for book_id, ok, message in results]}
+
+
+@instrumented
+def api_add_review(user_id, book_id, rating, comment):
+    refresh_service_data()
+    with data_lock.read_locked():
+        if find_user(user_id) is None:
+            return {'ok': False, 'message': f"User with ID {user_id} not found."}
+    ok, message = submit_review(user_id, book_id, rating, comment)
+    return {'ok': ok, 'message': message}
+
+
+@instrumented
+def api_browse_books(page_size=BROWSE_PAGE_SIZE, cursor=None, sort_by='id', descending=False, filters=None):
+    refresh_service_data()
+    with data_lock.read_locked():
+        try:
+            page = browse_books(page_size, cursor, sort_by, descending, filters)
+        except ValueError as e:
+            return {'ok': False, 'message': str(e)}
+        books = page['books'][['id', 'title', 'author', 'publisher', 'cost', 'shipping_cost', 'copies']]
+        records = books.to_dict('records')
+        for record in records:
+            record['rating'] = book_rating(record['id'])['mean']
+    return {'ok': True, 'books': records, 'next_cursor': page['next_cursor'], 'total': page['total']}
+
+
+@instrumented
+def api_top_rated_books(k=10, min_reviews=1):
+    refresh_service_data()
+    with data_lock.read_locked():
+        books = [{'id': book_id, 'title': books_df.at[find_book(book_id), 'title'], 'rating': mean, 'reviews': count}
+                 for book_id, mean, count in top_rated_books(k, min_reviews)]
+    return {'ok': True, 'books': books}
+
+
+@instrumented
+def api_user_reviews(user_id):
+    refresh_service_data()
+    with data_lock.read_locked():
+        if find_user(user_id) is None:
+            return {'ok': False, 'message': f"User with ID {user_id} not found."}
+        reviews = [{'id': review.id, 'book_id': review.book_id, 'rating': review.rating, 'comment': review.comment}
+                   for review in user_reviews(user_id).itertuples()]
+    return {'ok': True, 'reviews': reviews}
+
+
+@instrumented
+def api_recommend_books(user_id, k=3):
+    refresh_service_data()
+    with data_lock.read_locked():
+        if find_user(user_id) is None:
+            return {'ok': False, 'message': f"User with ID {user_id} not found."}
+        books = []
+        for book_id, score in recommend_for_user(user_id, k):
+            book_index = find_book(book_id)
+            books.append({'id': book_id, 'title': books_df.at[book_index, 'title'],
+                          'cost': books_df.at[book_index, 'cost'], 'score': score})
+    return {'ok': True, 'books': books}
+
+
+@instrumented
+def api_check_availability(title, store_name=None):
+    refresh_service_data()
+    with data_lock.read_locked():
+        books = find_available_books(title, store_name=store_name)
+        records = [{'id': row.id, 'title': row.title, 'copies': row.copies} for row in books.itertuples()]
+        if store_name is not None:
+            for record, store_copies in zip(records, books['store_copies']):
+                record['store_copies'] = store_copies
+    return {'ok': True, 'books': records}
+
+
+@instrumented
+def api_report(name, consider_availability=True):
+    refresh_service_data()
+    with data_lock.read_locked():
+        if name not in REPORTS:
+            return {'ok': False, 'message': f"Unknown report '{name}'."}
+        data = report_data(name, consider_availability)
+        if REPORTS[name].get('histogram'):
+            return {'ok': True, 'bins': data['bins'], 'counts': data['counts']}
+    return {'ok': True, 'counts': {str(key): int(value) for key, value in data.items()}}
+
+
 # Delete user by username
 def delete_user_by_username():
     global user_df  # Ensure we modify the global variable
 
     username = input("Enter username of the user to delete: ")
 
-    if username in user_df['username'].values:
-        user_df = user_df[user_df['username'] != username]
-        save_dataframes()
-        print(f"User '{username}' deleted successfully.")
+    user_index = find_user_by_username(username)
+    if user_index is not None:
+        user_id = user_df.at[user_index, 'id']
+
+        def prepare():
+            user_index = find_user(user_id)
+            if user_index is None or find_user_by_username(username) != user_index:
+                return None, f"User '{username}' not found."
+            return [delete_change('users', user_id)], f"User '{username}' deleted successfully."
+
+        print(run_transaction([('users', user_id)], prepare))
     else:
         print(f"User '{username}' not found.")
 
 
 # Main function to run the program
 def main():
-    initialize_dataframes()
-
+    # The tables are loaded by the logins and menus that need them
     print("Welcome to the Library Management System!")
     print("1. User Login")
     print("2. Admin Login")
@@ -1108,4 +3747,18 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:2] == ['migrate']:
+        # python main.py migrate [source] [target]
+        migrate_storage(*sys.argv[2:4])
+    elif sys.argv[1:2] == ['reports']:
+        # python main.py reports [directory] [formats, e.g. png,svg,json]
+        initialize_dataframes()
+        formats = sys.argv[3].split(',') if len(sys.argv) > 3 else ('png', 'json')
+        for path in generate_all_reports(sys.argv[2] if len(sys.argv) > 2 else REPORT_DIRECTORY, formats):
+            print(path)
+    elif sys.argv[1:2] == ['memory']:
+        # python main.py memory
+        initialize_dataframes()
+        print_memory_report()
+    else:
+        main()
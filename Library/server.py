@@ -0,0 +1,215 @@
+import asyncio
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import main as library
+
+# Local HTTP/JSON server for the service layer in main.py. All clients share the one copy of the data
+# loaded at startup; the operations run in a thread pool and main.data_lock keeps the DataFrames consistent.
+#
+#   GET  /books[?page_size=20&cursor=<next_cursor of the previous page>&sort_by=title&descending=false
+#               &category=...&store=...&title=...&author=...&min_cost=...&max_cost=...&min_rating=...]
+#   GET  /books/available?title=...[&store=Store 1]
+#   GET  /users/<id>/recommendations[?k=3]
+#   POST /users/<id>/orders       {"book_id": 3} or {"book_ids": [3, 7, 9], "all_or_nothing": false}
+#   POST /users/<id>/reviews      {"book_id": 3, "rating": 5, "comment": "..."}
+#   GET  /users/<id>/reviews
+#   GET  /books/top-rated[?k=10&min_reviews=1]
+#   GET  /reports/<name>[?consider_availability=false]
+#   GET  /metrics                 Prometheus text format (run with LIBRARY_METRICS=1 to record metrics)
+#   GET  /metrics.json
+
+HOST = '127.0.0.1'
+PORT = 8080
+WORKERS = 8
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               500: 'Internal Server Error'}
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def route(method, path, query, body):
+    parts = [part for part in path.split('/') if part]
+
+    if parts == ['books']:
+        require_method(method, 'GET')
+        try:
+            cursor = json.loads(query['cursor']) if 'cursor' in query else None
+        except ValueError:
+            raise RequestError(400, "Invalid cursor.")
+        filters = {name: query[name] for name in ['title', 'author', 'publisher', 'category', 'store'] if name in query}
+        filters.update({name: parse_float(query[name], name) for name in ['min_cost', 'max_cost', 'min_rating']
+                        if name in query})
+        result = library.api_browse_books(parse_int(query.get('page_size', str(library.BROWSE_PAGE_SIZE)),
+                                                    'page_size'),
+                                          cursor, query.get('sort_by', 'id'),
+                                          query.get('descending', 'false').lower() == 'true', filters)
+        # An invalid page size, cursor or sort key is the client's mistake
+        if not result['ok']:
+            raise RequestError(400, result['message'])
+        return result
+
+    if parts == ['books', 'available']:
+        require_method(method, 'GET')
+        if 'title' not in query:
+            raise RequestError(400, "Missing 'title' parameter.")
+        return library.api_check_availability(query['title'], query.get('store'))
+
+    if parts == ['books', 'top-rated']:
+        require_method(method, 'GET')
+        return library.api_top_rated_books(parse_int(query.get('k', '10'), 'k'),
+                                           parse_int(query.get('min_reviews', '1'), 'min_reviews'))
+
+    if len(parts) == 3 and parts[0] == 'users':
+        user_id = parse_int(parts[1], 'user id')
+        if library.find_user(user_id) is None:
+            raise RequestError(404, f"User with ID {user_id} not found.")
+        if parts[2] == 'recommendations':
+            require_method(method, 'GET')
+            return library.api_recommend_books(user_id, parse_int(query.get('k', '3'), 'k'))
+        if parts[2] == 'orders':
+            require_method(method, 'POST')
+            if 'book_ids' in body:
+                if not isinstance(body['book_ids'], list):
+                    raise RequestError(400, "'book_ids' must be a list.")
+                book_ids = [parse_int(book_id, 'book_id') for book_id in body['book_ids']]
+                return library.api_place_orders(user_id, book_ids, bool(body.get('all_or_nothing', False)))
+            return library.api_place_order(user_id, parse_int(body.get('book_id'), 'book_id'))
+        if parts[2] == 'reviews':
+            if method == 'GET':
+                return library.api_user_reviews(user_id)
+            require_method(method, 'POST')
+            return library.api_add_review(user_id, parse_int(body.get('book_id'), 'book_id'),
+                                          parse_int(body.get('rating'), 'rating'), str(body.get('comment', '')))
+
+    if parts == ['metrics']:
+        require_method(method, 'GET')
+        return library.metrics_prometheus()
+
+    if parts == ['metrics.json']:
+        require_method(method, 'GET')
+        return library.metrics_registry()
+
+    if len(parts) == 2 and parts[0] == 'reports':
+        require_method(method, 'GET')
+        if parts[1] not in library.REPORTS:
+            raise RequestError(404, f"Unknown report '{parts[1]}'.")
+        consider_availability = query.get('consider_availability', 'true').lower() != 'false'
+        return library.api_report(parts[1], consider_availability)
+
+    raise RequestError(404, f"No route for {path}.")
+
+
+def require_method(method, expected):
+    if method != expected:
+        raise RequestError(405, f"Use {expected} for this route.")
+
+
+def parse_int(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RequestError(400, f"Invalid {name}: {value!r}.")
+
+
+def parse_float(value, name):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise RequestError(400, f"Invalid {name}: {value!r}.")
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, version = request_line.decode('latin-1').split()
+    except ValueError:
+        raise RequestError(400, "Malformed request line.")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    body = await reader.readexactly(int(headers.get('content-length', 0) or 0))
+    return method, target, version, headers, body
+
+
+async def handle_client(reader, writer):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            keep_alive = False
+            try:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, target, version, headers, body = request
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+
+                url = urlsplit(target)
+                query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                try:
+                    payload = json.loads(body) if body else {}
+                except ValueError:
+                    raise RequestError(400, "Body must be JSON.")
+                if not isinstance(payload, dict):
+                    raise RequestError(400, "Body must be a JSON object.")
+
+                # The pandas work runs in the thread pool so the event loop keeps serving other clients
+                result = await loop.run_in_executor(None, route, method, url.path, query, payload)
+                status = 200
+            except RequestError as e:
+                status, result = e.status, {'ok': False, 'message': str(e)}
+            except asyncio.IncompleteReadError:
+                break
+            except Exception as e:
+                status, result = 500, {'ok': False, 'message': f"Error: {e}"}
+
+            # Routes answer with JSON, except the metrics in the Prometheus text format
+            if isinstance(result, str):
+                data, content_type = result.encode('utf-8'), 'text/plain; version=0.0.4'
+            else:
+                data, content_type = json.dumps(result, default=library.to_builtin).encode('utf-8'), 'application/json'
+            writer.write(f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                         f"Content-Type: {content_type}\r\n"
+                         f"Content-Length: {len(data)}\r\n"
+                         f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + data)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host=HOST, port=PORT):
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=WORKERS))
+    server = await asyncio.start_server(handle_client, host, port)
+    print(f"Library service listening on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    library.initialize_dataframes()
+    host = sys.argv[1] if len(sys.argv) > 1 else HOST
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else PORT
+    try:
+        asyncio.run(serve(host, port))
+    except KeyboardInterrupt:
+        print("Server stopped.")
@@ -0,0 +1,26 @@
+import importlib
+import os
+import shutil
+import sys
+
+import pytest
+
+LIBRARY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LIBRARY_DIRECTORY)
+
+DATA_FILES = ['admins.csv', 'books.csv', 'stores.csv', 'users.csv']
+
+
+# A fresh copy of the sample data in a temporary directory and main.py reloaded on it, so every test starts
+# from empty indexes, caches and journal
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    for name in DATA_FILES:
+        shutil.copy(os.path.join(LIBRARY_DIRECTORY, name), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv('LIBRARY_SHARED', raising=False)
+    monkeypatch.delenv('LIBRARY_STORAGE', raising=False)
+    import main
+    main = importlib.reload(main)
+    main.initialize_dataframes()
+    return main
@@ -0,0 +1,39 @@
+import pytest
+
+import server
+
+
+def test_pages_follow_the_cursor(library):
+    first = library.api_browse_books(page_size=20, sort_by='title')
+    second = library.api_browse_books(page_size=20, cursor=list(first['next_cursor']), sort_by='title')
+
+    ids = [book['id'] for book in first['books'] + second['books']]
+    assert len(ids) == 40 and len(set(ids)) == 40
+
+
+@pytest.mark.parametrize('page_size', [0, -1, 2.5, True])
+def test_invalid_page_size_is_rejected(library, page_size):
+    with pytest.raises(ValueError):
+        library.browse_books(page_size)
+    assert library.api_browse_books(page_size)['ok'] is False
+
+
+@pytest.mark.parametrize('sort_by, cursor', [('id', 5), ('id', ['x']), ('id', ['x', 3]), ('id', [3, 'x']),
+                                             ('title', [3, 3]), ('cost', [True, 3]), ('id', [1, 2, 3])])
+def test_invalid_cursor_is_rejected(library, sort_by, cursor):
+    with pytest.raises(ValueError):
+        library.browse_books(cursor=cursor, sort_by=sort_by)
+    assert library.api_browse_books(cursor=cursor, sort_by=sort_by)['ok'] is False
+
+
+@pytest.mark.parametrize('query', [{'page_size': '0'}, {'page_size': '-1'}, {'cursor': '5'},
+                                   {'cursor': '["x"]'}, {'sort_by': 'isbn'}])
+def test_server_answers_invalid_browse_requests_with_400(library, query):
+    with pytest.raises(server.RequestError) as error:
+        server.route('GET', '/books', query, {})
+    assert error.value.status == 400
+
+
+def test_server_serves_a_page(library):
+    result = server.route('GET', '/books', {'page_size': '5', 'cursor': '[5, 5]'}, {})
+    assert [book['id'] for book in result['books']] == [6, 7, 8, 9, 10]
@@ -0,0 +1,77 @@
+import io
+import sys
+import threading
+from contextlib import redirect_stdout
+
+import pytest
+
+import benchmark
+
+
+@pytest.fixture
+def synthetic_library(library):
+    benchmark.write_library(2000, seed=0)
+    library.initialize_dataframes()
+    with redirect_stdout(io.StringIO()):
+        library.precompute_recommendations()
+    return library
+
+
+def book_state(library):
+    return {book_id: (copies, library.book_bookstores(book_id))
+            for book_id, copies in zip(library.books_df['id'].tolist(), library.books_df['copies'].tolist())}
+
+
+def user_state(library):
+    return {row.id: (round(row.balance, 6), list(row.orders)) for row in library.user_df.itertuples()}
+
+
+def test_orders_and_recommendations_in_threads_stay_consistent(synthetic_library):
+    library = synthetic_library
+    books, users = book_state(library), user_state(library)
+    prices = dict(zip(library.books_df['id'].tolist(),
+                      (library.books_df['cost'] + library.books_df['shipping_cost']).tolist()))
+    errors = []
+
+    def order(worker):
+        try:
+            for user_id in range(1 + worker, 401, 4):
+                library.api_place_order(user_id, (user_id * 7) % 50 + 1)
+        except Exception as e:
+            errors.append(e)
+
+    def recommend(worker):
+        try:
+            for user_id in range(1 + worker, 2001, 4):
+                library.api_recommend_books(user_id, 3)
+        except Exception as e:
+            errors.append(e)
+
+    # Switch threads often, so the orders' commits interleave with the recommendation reads
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    threads = [threading.Thread(target=target, args=(worker,)) for worker in range(4) for target in (order, recommend)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sys.setswitchinterval(switch_interval)
+    assert errors == []
+
+    # Every order that was recorded charged its user and took one copy of its book, and nothing else changed
+    taken = {}
+    for user_id, (balance, orders) in user_state(library).items():
+        new_orders = orders[len(users[user_id][1]):]
+        assert orders[:len(users[user_id][1])] == users[user_id][1]
+        assert balance == pytest.approx(users[user_id][0] - sum(prices[book_id] for book_id in new_orders))
+        for book_id in new_orders:
+            taken[book_id] = taken.get(book_id, 0) + 1
+    assert taken
+    for book_id, (copies, bookstores) in book_state(library).items():
+        assert copies == books[book_id][0] - taken.get(book_id, 0)
+        assert copies == sum(bookstores.values())
+
+    # The journal holds exactly what happened in memory
+    state = book_state(library), user_state(library)
+    library.initialize_dataframes()
+    assert (book_state(library), user_state(library)) == state
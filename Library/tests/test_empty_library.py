@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+
+# A fresh install: only the admins exist, users.csv and books.csv are created by the first commits
+@pytest.fixture
+def empty_library(library):
+    os.remove('users.csv')
+    os.remove('books.csv')
+    library.initialize_dataframes()
+    return library
+
+
+def answer(monkeypatch, *answers):
+    answers = iter(answers)
+    monkeypatch.setattr('builtins.input', lambda prompt='': next(answers))
+
+
+def test_first_user_and_book_on_a_fresh_install(empty_library, monkeypatch, capsys):
+    library = empty_library
+    answer(monkeypatch, 'alice', 'password123!', '1 Main St', 'Springfield', '50')
+    library.create_user_account()
+    answer(monkeypatch, 'Dune', 'Frank Herbert', 'Chilton', 'science fiction', '9.5', '1.5', 'True', '3')
+    library.add_book('johny')
+
+    assert 'successfully' in capsys.readouterr().out
+    assert library.user_df['city'].dtype == 'category'
+    assert library.books_df['publisher'].dtype == 'category'
+    assert library.process_order(1, 1) == (True, "Order placed successfully!")
+
+    library.initialize_dataframes()
+    assert library.user_df.at[library.find_user(1), 'orders'] == [1]
+    assert library.user_df.at[library.find_user(1), 'balance'] == 39.0
+    assert library.book_bookstores(1) == {'Store 1': 2}
+    assert library.search_books('dune') == [1]
@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+
+
+def book(book_id, title, **values):
+    return {'id': book_id, 'title': title, 'author': 'Frank Herbert', 'publisher': 'Chilton',
+            'categories': "['science fiction']", 'cost': 9.5, 'shipping_cost': 1.5, 'availability': 'True',
+            'copies': 3, 'bookstores': "{'Store 1': 3}", **values}
+
+
+def test_import_reports_every_rejected_row(library):
+    rows = pd.DataFrame([
+        book(100, 'Dune'),
+        book(101, '1984'),
+        book(3, 'Dune Messiah'),
+        book(102, 'Dune'),
+        book('x', 'Children of Dune'),
+        book(103, 'God Emperor of Dune', cost=-1),
+        book(104, 'Heretics of Dune', copies=4),
+        book(105, 'Chapterhouse: Dune', bookstores="{'Store 1': -3}"),
+        book(106, 'The Dosadi Experiment', categories='science fiction'),
+        book(107, 'Whipping Star', availability='maybe'),
+    ])
+
+    report = library.import_books(rows, set(library.books_df['title']))
+
+    assert report[['id', 'status', 'reason']].values.tolist() == [
+        [100, 'added', ''],
+        [101, 'skipped', 'title already exists'],
+        [3, 'skipped', 'id already exists'],
+        [102, 'skipped', 'duplicate title in file'],
+        ['x', 'error', 'invalid id'],
+        [103, 'error', 'invalid cost'],
+        [104, 'error', 'copies do not match bookstores'],
+        [105, 'error', 'invalid bookstores'],
+        [106, 'error', 'invalid categories'],
+        [107, 'error', 'invalid availability'],
+    ]
+    assert library.search_books('dune') == [100]
+    assert library.book_bookstores(100) == {'Store 1': 3}
+    assert library.books_df.at[library.find_book(100), 'categories'] == ['science fiction']
+
+
+def test_upload_prints_the_rejected_rows(library, tmp_path, capsys):
+    path = tmp_path / 'new_books.csv'
+    pd.DataFrame([book(100, 'Dune'), book(101, 'Dune'), book(102, 'Dune Messiah', cost='free')]).to_csv(path,
+                                                                                                        index=False)
+
+    report = library.upload_books_from_csv(str(path), chunksize=2)
+
+    assert report['status'].tolist() == ['skipped', 'error']
+    output = capsys.readouterr().out
+    assert "Row 1: Book ID 101 (Dune) skipped: duplicate title in file." in output
+    assert "Added 1 new books, skipped 1, 1 rows with errors." in output
+    library.initialize_dataframes()
+    assert library.search_books('dune') == [100]
+
+
+def test_file_without_the_required_columns_is_refused(library):
+    with pytest.raises(ValueError):
+        library.import_books(pd.DataFrame({'title': ['Dune']}), set())
@@ -0,0 +1,87 @@
+import copy
+
+import pytest
+
+
+def aggregates(library):
+    return copy.deepcopy((library.book_counts, library.cost_counts, library.cost_totals, library.city_totals))
+
+
+def assert_same_aggregates(incremental, rebuilt):
+    book_counts, cost_counts, cost_totals, city_totals = incremental
+    assert (book_counts, cost_counts, city_totals) == rebuilt[:2] + rebuilt[3:]
+    for column, totals in cost_totals.items():
+        assert totals.keys() == rebuilt[2][column].keys()
+        for key, (count, total) in totals.items():
+            assert count == rebuilt[2][column][key][0]
+            assert total == pytest.approx(rebuilt[2][column][key][1])
+
+
+def assert_copies_match_the_stores(library):
+    for book_id, copies in zip(library.books_df['id'], library.books_df['copies']):
+        assert copies == sum(library.book_bookstores(book_id).values())
+    counts = library.inventory_frame().groupby('store_id')['count'].sum()
+    assert library.store_totals == {store: total for store, total in counts.items() if total}
+
+
+def test_incremental_aggregates_match_a_rebuild(library):
+    assert library.process_order(4, 3)[0]
+    assert library.place_orders(3, [1, 5])[0][1]
+    library.commit_changes([library.update_change('books', 6, {'publisher': 'Chatto & Windus', 'cost': 20.0,
+                                                               'categories': ['drama']})])
+    library.commit_changes([library.update_change('books', 7, {'availability': False})])
+    library.commit_changes([library.update_change('users', 2, {'city': 'Capital City'})])
+    library.commit_changes([library.delete_change('books', 8), library.delete_change('users', 4)])
+
+    incremental = aggregates(library)
+    library.build_aggregates('books')
+    library.build_aggregates('users')
+    assert_same_aggregates(incremental, aggregates(library))
+    assert_copies_match_the_stores(library)
+
+
+def test_copies_are_the_sum_of_the_store_counts(library):
+    assert_copies_match_the_stores(library)
+    assert library.process_order(4, 1)[0]
+    assert library.restock_book(2, 3)[0]
+    library.commit_changes([library.update_change('books', 9, {'bookstores': {'Store 2': 1, 'Store 4': 6}})])
+    assert_copies_match_the_stores(library)
+    assert library.books_df.at[library.find_book(9), 'copies'] == 7
+
+    library.initialize_dataframes()
+    assert_copies_match_the_stores(library)
+    assert library.book_bookstores(9) == {'Store 2': 1, 'Store 4': 6}
+
+
+def test_allocation_policies(library):
+    # Book 4: Store 2 (Shelbyville) has 8, Store 3 (Springfield) has 7
+    assert library.allocate_store(4, 'Springfield', 'city') == 'Store 3'
+    assert library.allocate_store(4, 'Ogdenville', 'city') == 'Store 2'
+    assert library.allocate_store(4, 'Springfield', 'largest') == 'Store 2'
+    with pytest.raises(ValueError):
+        library.allocate_store(4, policy='nearest')
+
+    # Balanced takes from the store with the most copies relative to its highest stock
+    for expected in ['Store 3', 'Store 2', 'Store 2', 'Store 3']:
+        bookstores, store = library.take_copy(4, policy='balanced')
+        assert store == expected
+        library.commit_changes([library.update_change('books', 4, {'bookstores': bookstores})])
+    assert library.book_bookstores(4) == {'Store 2': 6, 'Store 3': 5}
+
+def test_cancelled_order_returns_the_copy_to_its_store(library):
+    assert library.process_order(4, 4)[0]
+    assert library.book_bookstores(4) == {'Store 2': 8, 'Store 3': 6}
+    assert library.user_df.at[library.find_user(4), 'order_stores'] == {'4': 'Store 3'}
+
+    assert library.process_order_cancellation(4, 4)[0]
+    assert library.book_bookstores(4) == {'Store 2': 8, 'Store 3': 7}
+    assert library.user_df.at[library.find_user(4), 'order_stores'] == {}
+
+
+def test_restock_book(library):
+    assert library.process_order(4, 4)[0]
+    # Without a store the copies go to the most depleted one
+    assert library.restock_book(4, 2) == (True, "Added 2 copies of Book ID 4 to Store 3.")
+    assert library.restock_book(4, 3, 'Store 2') == (True, "Added 3 copies of Book ID 4 to Store 2.")
+    assert library.book_bookstores(4) == {'Store 2': 11, 'Store 3': 8}
+    assert library.restock_book(999) == (False, "Book ID does not exist.")
@@ -0,0 +1,106 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+
+def balance(library, user_id):
+    return library.user_df.at[library.find_user(user_id), 'balance']
+
+
+def test_committed_changes_survive_a_crash(library):
+    assert library.process_order(1, 3)[0]
+    state = balance(library, 1), library.user_df.at[library.find_user(1), 'orders'], library.book_bookstores(3)
+
+    # A crash loses everything in memory; the snapshot files were never rewritten
+    assert pd.read_csv('users.csv').set_index('id').at[1, 'balance'] == 101.5
+    library.initialize_dataframes()
+
+    assert (balance(library, 1), library.user_df.at[library.find_user(1), 'orders'],
+            library.book_bookstores(3)) == state
+
+
+def test_torn_last_line_is_ignored_and_cut_off(library):
+    library.commit_changes([library.update_change('users', 1, {'balance': 200.0})])
+    entry = json.dumps([library.update_change('users', 2, {'balance': 300.0})])
+    with open(library.JOURNAL_FILE, 'a') as journal:
+        journal.write(entry[:len(entry) // 2])
+    size = os.path.getsize(library.JOURNAL_FILE)
+
+    library.initialize_dataframes()
+
+    assert balance(library, 1) == 200.0
+    assert balance(library, 2) == 50.5
+    assert os.path.getsize(library.JOURNAL_FILE) < size
+    # New entries start on a line of their own and replay as well
+    library.commit_changes([library.update_change('users', 2, {'balance': 400.0})])
+    library.initialize_dataframes()
+    assert balance(library, 2) == 400.0
+
+
+def test_replaying_an_entry_twice_is_harmless(library):
+    library.commit_changes([library.insert_change('users', {
+        'id': 99, 'username': 'carol', 'password': 'carolpass1!', 'address': '1 Oak St', 'city': 'Springfield',
+        'orders': [], 'favorites': [], 'balance': 10.0, 'order_stores': {}})])
+    with open(library.JOURNAL_FILE) as journal:
+        lines = journal.readlines()
+    with open(library.JOURNAL_FILE, 'a') as journal:
+        journal.writelines(lines)
+
+    library.initialize_dataframes()
+
+    assert (library.user_df['username'] == 'carol').sum() == 1
+    assert balance(library, 99) == 10.0
+
+
+def test_compaction_folds_the_journal_into_the_snapshot_files(library, monkeypatch, capsys):
+    monkeypatch.setattr(library, 'JOURNAL_COMPACT_THRESHOLD', 3)
+    for amount in [1.0, 2.0, 3.0, 4.0]:
+        library.commit_changes([library.update_change('users', 1, {'balance': 100.0 + amount})])
+
+    with open(library.JOURNAL_FILE) as journal:
+        lines = journal.readlines()
+    assert json.loads(lines[0]) == {'generation': 1}
+    assert len(lines) == 2
+    assert pd.read_csv('users.csv').set_index('id').at[1, 'balance'] == 103.0
+
+    library.initialize_dataframes()
+    assert balance(library, 1) == 104.0
+    assert library.journal_generation == 1 and library.journal_entries == 1
+
+
+def test_a_commit_that_fails_to_apply_is_taken_back_out_of_the_journal(library):
+    library.commit_changes([library.update_change('users', 1, {'balance': 200.0})])
+    size = os.path.getsize(library.JOURNAL_FILE)
+
+    # The first change applies, the second fails half-way through the entry
+    with pytest.raises(TypeError):
+        library.commit_changes([library.update_change('users', 2, {'balance': 300.0}),
+                                library.update_change('users', 3, {'balance': 'lots'})])
+
+    assert os.path.getsize(library.JOURNAL_FILE) == size
+    assert balance(library, 1) == 200.0
+    assert balance(library, 2) == 50.5
+    library.commit_changes([library.update_change('users', 2, {'balance': 400.0})])
+    library.initialize_dataframes()
+    assert balance(library, 2) == 400.0
+
+
+def test_an_entry_that_fails_to_replay_is_set_aside(library, capsys):
+    library.commit_changes([library.update_change('users', 1, {'balance': 200.0})])
+    with open(library.JOURNAL_FILE, 'a') as journal:
+        journal.write(json.dumps([library.update_change('users', 3, {'balance': 'lots'})]) + '\n')
+        journal.write(json.dumps([library.update_change('users', 2, {'balance': 300.0})]) + '\n')
+
+    library.initialize_dataframes()
+
+    assert 'could not be applied' in capsys.readouterr().out
+    assert balance(library, 1) == 200.0
+    assert balance(library, 2) == 50.5
+    with open(library.JOURNAL_FILE + '.rejected') as rejected:
+        assert len(rejected.readlines()) == 2
+    # The next start replays the journal without the rejected entries
+    library.initialize_dataframes()
+    assert 'could not be applied' not in capsys.readouterr().out
+    assert balance(library, 1) == 200.0
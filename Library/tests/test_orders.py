@@ -0,0 +1,40 @@
+def user(library, user_id):
+    row = library.user_df.loc[library.find_user(user_id)]
+    return row['orders'], row['balance']
+
+
+def test_cart_orders_the_books_that_can_be_ordered(library):
+    # User 4 has a balance of 50.5 and no orders; book 3 costs 9.0 + 2.0 and book 1 10.0 + 2.5
+    results = library.place_orders(4, [3, 999, 3, 1])
+
+    assert results == [(3, True, "Order placed successfully!"), (999, False, "Book ID does not exist."),
+                       (3, False, "This book is already in the cart."), (1, True, "Order placed successfully!")]
+    assert user(library, 4) == ([3, 1], 27.0)
+    assert library.book_bookstores(3) == {'Store 1': 4, 'Store 3': 3}
+    assert library.books_df.at[library.find_book(1), 'copies'] == 9
+
+    results = library.place_orders(4, [3, 2])
+    assert results == [(3, False, "You have already ordered this book."), (2, True, "Order placed successfully!")]
+    library.initialize_dataframes()
+    assert user(library, 4) == ([3, 1, 2], 17.5)
+
+
+def test_all_or_nothing_cart_is_refused_as_a_whole(library):
+    results = library.place_orders(4, [3, 999, 1], all_or_nothing=True)
+
+    assert results == [(3, False, "The cart was not ordered."), (999, False, "Book ID does not exist."),
+                       (1, False, "The cart was not ordered.")]
+    assert user(library, 4) == ([], 50.5)
+    assert library.book_bookstores(3) == {'Store 1': 4, 'Store 3': 4}
+
+    assert [ok for _, ok, _ in library.place_orders(4, [3, 1], all_or_nothing=True)] == [True, True]
+    assert user(library, 4) == ([3, 1], 27.0)
+
+
+def test_cart_over_the_balance_is_refused(library):
+    # 16.2 + 14.0 + 11.9 + 12.5 = 54.6 against a balance of 50.5
+    results = library.place_orders(4, [6, 5, 7, 1])
+
+    assert {message for _, ok, message in results} == {"Insufficient balance for this cart."}
+    assert user(library, 4) == ([], 50.5)
+    assert library.journal_entries == 0
@@ -0,0 +1,61 @@
+import io
+from contextlib import redirect_stdout
+
+import numpy as np
+
+
+def co_orders(model):
+    matrix = model['co_orders']
+    if model['co_order_changes'] is not None:
+        matrix = matrix + model['co_order_changes']
+    return matrix.toarray()
+
+
+def test_model_follows_orders_and_favorites_without_a_rebuild(library):
+    model = library.get_recommendation_model()
+    assert library.process_order(1, 7)[0]
+    assert library.process_order(2, 20)[0]
+    assert library.process_order_cancellation(2, 1)[0]
+    with redirect_stdout(io.StringIO()):
+        library.add_to_favorites(3, 9)
+
+    assert library.recommendation_model is model
+    rebuilt = library.build_recommendation_model()
+    assert np.array_equal(co_orders(model), co_orders(rebuilt))
+    for user_id in library.user_df['id'].tolist():
+        assert library.score_recommendations(model, [user_id], 10) == \
+            library.score_recommendations(rebuilt, [user_id], 10)
+
+
+def test_pending_co_order_changes_are_folded_into_the_model(library, monkeypatch):
+    monkeypatch.setattr(library, 'CO_ORDER_CHANGES_LIMIT', 1)
+    model = library.get_recommendation_model()
+    assert library.process_order(1, 7)[0]
+
+    assert model['co_order_changes'] is None
+    assert np.array_equal(co_orders(model), co_orders(library.build_recommendation_model()))
+
+
+def test_catalogue_change_rebuilds_the_model_when_next_needed(library):
+    library.get_recommendation_model()
+    library.commit_changes([library.update_change('books', 7, {'categories': ['poetry']})])
+
+    assert library.recommendation_model is None
+    assert library.recommend_for_user(1) == \
+        library.score_recommendations(library.build_recommendation_model(), [1], 10)[0]
+
+
+def test_order_only_drops_the_cached_recommendations_that_depend_on_it(library):
+    with redirect_stdout(io.StringIO()):
+        library.precompute_recommendations()
+    cached = set(library.recommendation_cache)
+    dependent = {user_id for user_id in cached
+                 if user_id == 5 or 50 in library.recommendation_cache[user_id]['items']
+                 or 50 in [book_id for book_id, score in library.recommendation_cache[user_id]['books']]
+                 or not library.recommendation_cache[user_id]['items'].isdisjoint(library.user_items(5))}
+
+    assert library.process_order(5, 50)[0]
+    assert set(library.recommendation_cache) == cached - dependent
+    assert 5 not in library.recommendation_cache
+    assert all(library.cached_by_book.get(book_id, set()) <= set(library.recommendation_cache)
+               for book_id in library.cached_by_book)
@@ -0,0 +1,23 @@
+def insert_reviews(library, book_id, ratings):
+    first_id = library.next_review_id()
+    rows = [{'id': first_id + offset, 'book_id': book_id, 'user_id': 1, 'rating': rating, 'comment': ''}
+            for offset, rating in enumerate(ratings)]
+    library.commit_changes([library.insert_rows_change('reviews', rows)])
+
+
+def test_rating_sum_does_not_overflow_the_compact_rating_dtype(library):
+    insert_reviews(library, 3, [5] * 41)
+
+    assert library.reviews_df['rating'].dtype == 'Int8'
+    assert library.book_rating(3) == {'count': 41, 'sum': 205, 'mean': 5.0}
+    assert library.top_rated_books(1, min_reviews=41) == [(3, 5.0, 41)]
+
+
+def test_rating_sum_does_not_overflow_after_reload(library):
+    insert_reviews(library, 3, [5] * 30 + [4] * 30)
+    library.save_dataframes()
+    library.initialize_dataframes()
+
+    assert library.book_rating(3) == {'count': 60, 'sum': 270, 'mean': 4.5}
+    page = library.api_browse_books(page_size=50, filters={'min_rating': 4.5})
+    assert 3 in [book['id'] for book in page['books']]
@@ -0,0 +1,27 @@
+import pytest
+
+
+def test_substring_and_prefix_search(library):
+    assert library.search_books('ring') == [49, 11, 14]
+    assert library.search_books('the', field='publisher', limit=2) == [6, 7]
+    assert library.search_books('j.r.r', field='author') == [9, 11, 49]
+    assert library.search_books('fel ri', mode='prefix') == [11]
+    assert library.search_books('ring fel', mode='prefix') == [11]
+    assert library.search_books('xyz', mode='prefix') == []
+
+
+@pytest.mark.parametrize('mode', ['substring', 'prefix'])
+def test_search_follows_inserts_updates_and_deletes(library, mode):
+    library.commit_changes([library.update_change('books', 11, {'title': 'The Two Towers'})])
+    assert library.search_books('fell', mode=mode) == []
+    assert library.search_books('towers', mode=mode) == [11]
+
+    # Emptying the catalogue empties the index; the first book added afterwards is searchable again
+    ids = library.books_df['id'].tolist()
+    library.commit_changes([library.delete_change('books', book_id) for book_id in ids])
+    assert library.search_books('towers', mode=mode) == []
+    library.commit_changes([library.insert_change('books', {
+        'id': 100, 'title': 'Dune', 'author': 'Frank Herbert', 'publisher': 'Chilton', 'categories': ['science fiction'],
+        'cost': 9.5, 'shipping_cost': 1.5, 'availability': True, 'copies': 1, 'bookstores': {'Store 1': 1}})])
+    assert library.search_books('dun', mode=mode) == [100]
+    assert library.search_books('herb', field='author', mode=mode) == [100]
@@ -0,0 +1,24 @@
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize('method, path, body', [('GET', '/users/999/recommendations', {}),
+                                                ('GET', '/users/999/reviews', {}),
+                                                ('POST', '/users/999/orders', {'book_id': 1}),
+                                                ('POST', '/users/999/reviews', {'book_id': 1, 'rating': 5}),
+                                                ('GET', '/reports/books_by_isbn', {}),
+                                                ('GET', '/shelves', {})])
+def test_unknown_users_reports_and_routes_are_404(library, method, path, body):
+    with pytest.raises(server.RequestError) as error:
+        server.route(method, path, {}, body)
+    assert error.value.status == 404
+
+
+def test_known_user_and_report(library):
+    assert server.route('GET', '/users/1/recommendations', {'k': '2'}, {})['ok'] is True
+    result = server.route('GET', '/reports/books_by_publisher', {'consider_availability': 'false'}, {})
+    assert result['counts']['The Russian Messenger'] == 4
+    # A refused order of a known user is an answer, not an error
+    assert server.route('POST', '/users/1/orders', {}, {'book_id': 999}) == {
+        'ok': False, 'message': "Book ID does not exist."}
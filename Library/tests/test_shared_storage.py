@@ -0,0 +1,108 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import LIBRARY_DIRECTORY
+
+
+def balance(library, user_id):
+    return library.user_df.at[library.find_user(user_id), 'balance']
+
+
+# Run a script in another process that shares the data files in this directory
+def run_process(script, amount=1, **arguments):
+    script = script.format(amount=amount, **arguments)
+    code = f"import sys\nsys.path.insert(0, {LIBRARY_DIRECTORY!r})\nimport main\n{script}"
+    return subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.DEVNULL,
+                            env=dict(os.environ, LIBRARY_SHARED='1'))
+
+
+# Add amount (default 1) to user 1's balance `count` times, each as its own transaction
+DEPOSITS = """
+main.initialize_dataframes()
+for _ in range({count}):
+    main.run_transaction([('users', 1)], lambda: (
+        [main.update_change('users', 1, {{'balance': main.user_df.at[main.find_user(1), 'balance'] + {amount}}})],
+        None))
+"""
+
+
+@pytest.fixture
+def shared_library(library, monkeypatch):
+    monkeypatch.setattr(library, 'SHARED_STORAGE', True)
+    library.initialize_dataframes()
+    return library
+
+
+def deposit(library, amount):
+    def prepare():
+        return [library.update_change('users', 1, {'balance': balance(library, 1) + amount})], amount
+    return prepare
+
+
+def test_transaction_retries_on_a_conflicting_writer(shared_library):
+    library = shared_library
+    attempts = []
+
+    # Another process deposits 10 after the transaction read the balance, on the first attempt only
+    def prepare():
+        attempts.append(balance(library, 1))
+        if len(attempts) == 1:
+            assert run_process(DEPOSITS, count=1, amount=10).wait(timeout=120) == 0
+        return deposit(library, 1)()
+
+    assert library.run_transaction([('users', 1)], prepare) == 1
+    assert attempts == [101.5, 111.5]
+    assert balance(library, 1) == 112.5
+
+
+def test_last_attempt_holds_the_storage_lock(shared_library):
+    library = shared_library
+    attempts = []
+
+    # Every attempt but the last conflicts with another process; the last one keeps the others out
+    def prepare():
+        attempts.append(balance(library, 1))
+        if len(attempts) <= library.TRANSACTION_RETRIES:
+            assert run_process(DEPOSITS, count=1, amount=10).wait(timeout=120) == 0
+        return deposit(library, 1)()
+
+    assert library.run_transaction([('users', 1)], prepare) == 1
+    assert attempts == [101.5 + 10 * attempt for attempt in range(library.TRANSACTION_RETRIES + 1)]
+    assert balance(library, 1) == 101.5 + 10 * library.TRANSACTION_RETRIES + 1
+
+
+def test_insert_of_an_id_taken_meanwhile_conflicts(library):
+    row = {'id': 7, 'username': 'dave', 'password': 'davepass1!', 'address': '', 'city': 'Springfield',
+           'orders': [], 'favorites': [], 'balance': 0.0, 'order_stores': {}}
+    expected = library.version_stamps(('users', 7))
+    library.commit_changes([library.insert_change('users', row)])
+
+    with pytest.raises(library.TransactionConflict):
+        library.commit_changes([library.insert_change('users', dict(row, username='erin'))], expected)
+
+
+def test_processes_sharing_the_files_lose_no_update(shared_library):
+    processes = [run_process(DEPOSITS, count=15) for _ in range(3)]
+    for process in processes:
+        assert process.wait(timeout=120) == 0
+
+    # This process still holds the data it loaded and catches up before its own transaction
+    shared_library.run_transaction([('users', 1)], deposit(shared_library, 100))
+    assert balance(shared_library, 1) == 101.5 + 45 + 100
+    shared_library.initialize_dataframes()
+    assert balance(shared_library, 1) == 101.5 + 45 + 100
+
+
+def test_refresh_picks_up_another_process_compaction(shared_library):
+    process = run_process("main.JOURNAL_COMPACT_THRESHOLD = 3" + DEPOSITS, count=4)
+    assert process.wait(timeout=120) == 0
+
+    assert shared_library.sync_journal()
+    assert shared_library.journal_generation == 1
+    assert balance(shared_library, 1) == 105.5
+    assert shared_library.api_place_order(1, 3)['ok']
+    shared_library.initialize_dataframes()
+    assert 3 in shared_library.user_df.at[shared_library.find_user(1), 'orders']
@@ -0,0 +1,102 @@
+import os
+
+import pandas as pd
+import pytest
+
+
+def state(library):
+    user = library.user_df.loc[library.find_user(1)]
+    book = library.books_df.loc[library.find_book(1)]
+    return (user['orders'], user['favorites'], user['balance'], user['order_stores'], book['categories'],
+            book['copies'], library.book_bookstores(1), library.book_rating(1), len(library.books_df))
+
+
+def test_parquet_migration_and_round_trip(library, monkeypatch, capsys):
+    pytest.importorskip('pyarrow')
+    assert library.process_order(4, 1)[0]
+    library.save_dataframes()
+    expected = state(library)
+
+    # The first start with the parquet backend converts the snapshot files
+    monkeypatch.setattr(library, 'STORAGE_BACKEND', 'parquet')
+    library.initialize_dataframes()
+    assert 'Migrated books.csv to books.parquet.' in capsys.readouterr().out
+    assert state(library) == expected
+    assert library.books_df['publisher'].dtype == 'category'
+
+    library.commit_changes([library.update_change('users', 1, {'favorites': [3], 'order_stores': {'2': 'Store 2'}})])
+    library.save_dataframes()
+    library.initialize_dataframes()
+    user = library.user_df.loc[library.find_user(1)]
+    assert (user['favorites'], user['order_stores']) == ([3], {'2': 'Store 2'})
+    assert 'Migrated' not in capsys.readouterr().out
+
+    # And back to CSV
+    os.remove('users.csv')
+    library.migrate_storage('parquet', 'csv')
+    monkeypatch.setattr(library, 'STORAGE_BACKEND', 'csv')
+    library.initialize_dataframes()
+    assert library.user_df.at[library.find_user(1), 'favorites'] == [3]
+
+
+def rewrite_balance(path, old, new, keep_mtime):
+    stat = os.stat(path)
+    with open(path) as handle:
+        text = handle.read()
+    with open(path, 'w') as handle:
+        handle.write(text.replace(old, new, 1))
+    if keep_mtime:
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+@pytest.mark.parametrize('keep_mtime', [False, True])
+def test_changed_snapshot_file_invalidates_the_cache(library, keep_mtime):
+    assert os.path.exists(library.snapshot_cache_path('users.csv'))
+    # Same size, and possibly the same mtime: only the content hash tells the files apart
+    rewrite_balance('users.csv', '101.5', '111.5', keep_mtime)
+
+    library.initialize_dataframes()
+
+    assert library.user_df.at[library.find_user(1), 'balance'] == 111.5
+
+
+def test_changed_books_file_invalidates_the_cached_indexes(library):
+    rewrite_balance('books.csv', 'To Kill a Mockingbird', 'To Kill a Nightingale', False)
+
+    library.initialize_dataframes()
+
+    assert library.search_books('nightingale') == [1]
+    assert library.search_books('mockingbird') == []
+
+
+@pytest.mark.parametrize('name', ['users.csv', 'books.group'])
+def test_corrupt_cache_file_is_replaced(library, name):
+    expected = state(library)
+    cache_path = library.snapshot_cache_path(name)
+    with open(cache_path, 'wb') as handle:
+        handle.write(b'not a pickle')
+
+    library.initialize_dataframes()
+
+    assert state(library) == expected
+    assert library.search_books('mockingbird') == [1]
+    assert library.read_snapshot_cache(name, [name] if name == 'users.csv' else ['books.csv', 'reviews.csv'],
+                                       object) is not None
+
+
+def test_cache_is_used_while_the_files_are_unchanged(library, monkeypatch):
+    read_csv = pd.read_csv
+
+    # Only the store cities are read; the snapshot files come from the cache
+    def read_stores(path, *args, **kwargs):
+        assert path == library.STORES_FILE
+        return read_csv(path, *args, **kwargs)
+
+    def build_book_group():
+        raise AssertionError("The books group was built again.")
+
+    monkeypatch.setattr(pd, 'read_csv', read_stores)
+    monkeypatch.setattr(library, 'build_book_group', build_book_group)
+    library.initialize_dataframes()
+
+    assert library.search_books('mockingbird') == [1]